@@ -0,0 +1,70 @@
+"""
+Feature extraction throughput: the original decode-then-predict loop vs the
+pipelined mode with decode workers and prefetch.
+
+For every configuration the report gives images/sec over the whole
+directory and per-stage utilization:
+  decode  busy time of the decode workers / (wall time * workers)
+  infer   time inside model.predict / wall time
+  stall   time the model sat waiting for decoded images / wall time
+
+Usage:
+    python bench_extract.py <images_dir> [model_path] [batch_size]
+"""
+
+import os
+import sys
+from pathlib import Path
+from extract_features import DECODE_WORKERS, PREFETCH_BATCHES, FeatureExtractor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MODEL_PATH = 'models/custom_encoder_feature_extractor.keras'
+
+
+def run(extractor, image_paths, batch_size, workers, prefetch):
+    stats = {}
+    extractor.extract_features_batch(image_paths, batch_size, workers=workers, prefetch=prefetch, stats=stats)
+    return stats
+
+
+def main(images_dir, model_path=MODEL_PATH, batch_size=32):
+    image_paths = sorted(str(path) for path in Path(images_dir).iterdir()
+                         if path.suffix.lower() in IMAGE_EXTENSIONS)
+    extractor = FeatureExtractor(model_path)
+    if extractor.model is None or not image_paths:
+        print(__doc__)
+        sys.exit(1)
+
+    # one untimed batch so graph building is not charged to the first configuration
+    extractor.extract_features_batch(image_paths[:batch_size], batch_size, workers=0)
+
+    configurations = [('original loop', 0, 0)]
+    for workers in sorted({2, 4, DECODE_WORKERS}):
+        if workers <= (os.cpu_count() or 1):
+            configurations.append((f'{workers} workers', workers, PREFETCH_BATCHES))
+
+    results = [(label, run(extractor, image_paths, batch_size, workers, prefetch))
+               for label, workers, prefetch in configurations]
+
+    print("\n" + "="*60)
+    print(f"FEATURE EXTRACTION ({len(image_paths)} images, batch {batch_size}, prefetch {PREFETCH_BATCHES})")
+    print("="*60)
+    baseline = results[0][1]['images'] / results[0][1]['seconds']
+    for label, stats in results:
+        seconds = stats['seconds']
+        rate = stats['images'] / seconds
+        decode = stats['decode_seconds'] / (seconds * max(stats['workers'], 1))
+        # in the original loop the model waits for every decode
+        stall = stats['decode_seconds'] if not stats['workers'] else stats['stall_seconds']
+        print(f"{label:<14} {rate:8.1f} img/s ({rate / baseline:4.2f}x)  decode {decode:6.1%}  "
+              f"infer {stats['infer_seconds'] / seconds:6.1%}  stall {stall / seconds:6.1%}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else MODEL_PATH,
+             int(sys.argv[3]) if len(sys.argv) > 3 else 32)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,69 @@
+"""
+Sharded extraction scaling: the same images extracted by 1, 2, 4, ... N
+worker processes, each pinned to an even share of the CPUs.
+
+Every configuration starts from an empty store in a temporary directory
+and is timed end to end, including spawning the workers, loading one
+model per worker and merging the shards. The report gives images/sec,
+speedup over one worker, parallel efficiency (speedup / workers) and the
+mean time a worker spent loading its model.
+
+Usage:
+    python bench_shards.py <images_dir> [max_workers] [model_path] [batch_size]
+"""
+
+import sys
+import time
+import tempfile
+from pathlib import Path
+from binary_store import BinaryFeatureStore
+from extract_features import available_cpus, extract_sharded
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MODEL_PATH = 'models/custom_encoder_feature_extractor.keras'
+
+
+def run(image_paths, model_path, batch_size, processes):
+    with tempfile.TemporaryDirectory() as directory:
+        store = BinaryFeatureStore(Path(directory) / 'features')
+        store.plan_update(image_paths)
+        start = time.perf_counter()
+        workers = extract_sharded(store, image_paths, model_path, batch_size, processes)
+        seconds = time.perf_counter() - start
+        images = len(store)
+        store.close()
+    return {'images': images, 'seconds': seconds, 'threads': max(1, len(available_cpus()) // processes),
+            'load_seconds': sum(worker['load_seconds'] for worker in workers) / len(workers)}
+
+
+def main(images_dir, max_workers=None, model_path=MODEL_PATH, batch_size=32):
+    image_paths = sorted(str(path) for path in Path(images_dir).iterdir()
+                         if path.suffix.lower() in IMAGE_EXTENSIONS)
+    if not image_paths or not Path(model_path).exists():
+        print(__doc__)
+        sys.exit(1)
+
+    max_workers = max_workers or len(available_cpus())
+    counts = sorted({1, max_workers} | {2 ** i for i in range(1, max_workers.bit_length()) if 2 ** i < max_workers})
+    results = [(processes, run(image_paths, model_path, batch_size, processes)) for processes in counts]
+
+    print("\n" + "="*60)
+    print(f"SHARDED EXTRACTION ({len(image_paths)} images, batch {batch_size}, {len(available_cpus())} CPUs)")
+    print("="*60)
+    baseline = results[0][1]['images'] / results[0][1]['seconds']
+    for processes, stats in results:
+        rate = stats['images'] / stats['seconds']
+        print(f"{processes:3d} workers x {stats['threads']:2d} threads {rate:8.1f} img/s "
+              f"({rate / baseline:5.2f}x, efficiency {rate / baseline / processes:6.1%})  "
+              f"model load {stats['load_seconds']:5.1f}s")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None,
+             sys.argv[3] if len(sys.argv) > 3 else MODEL_PATH,
+             int(sys.argv[4]) if len(sys.argv) > 4 else 32)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,366 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import numpy as np
+from pathlib import Path
+
+# columns kept for every stored path, used to tell unchanged files from changed ones
+KEY_COLUMNS = (('size', 'INTEGER'), ('mtime', 'INTEGER'), ('hash', 'TEXT'))
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_key(path, content_hash=False):
+    """(size, mtime in ns, sha256 or None) of a file; raises OSError if it is gone."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, file_sha256(path) if content_hash else None
+
+class BinaryFeatureStore:
+    def __init__(self, prefix, feature_dim=None):
+        """
+        Appendable on-disk store of float32 feature vectors keyed by image path.
+
+        Two files share the prefix:
+          <prefix>.f32           raw float32 matrix, one feature vector per row,
+                                 opened with np.memmap so rows are paged in on demand
+          <prefix>_index.sqlite  path -> row index with each file's size, mtime and
+                                 optional content hash, plus the feature dimension
+
+        Appending writes new rows at the end of the matrix and then records
+        them in the index, so a crash part-way through leaves at most some
+        unindexed rows that the next append overwrites. Storing a path again
+        points it at its new row; compact() reclaims the old ones by writing
+        the live rows to a new generation of the matrix, <prefix>.<n>.f32,
+        which the index switches to in the same commit that renumbers rows.
+
+        Args:
+            prefix (str): Path prefix of the store files
+            feature_dim (int): Vector length; read from the index if the store exists
+        """
+        self.prefix = str(prefix)
+        self.matrix_path = Path(self.prefix + '.f32')
+        self.index_path = Path(self.prefix + '_index.sqlite')
+        self.matrix_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(str(self.index_path))
+        self.db.execute('CREATE TABLE IF NOT EXISTS features (path TEXT PRIMARY KEY, row INTEGER NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        # stores written before file keys were tracked get the columns, empty, and are re-extracted once
+        columns = {info[1] for info in self.db.execute('PRAGMA table_info(features)')}
+        for name, kind in KEY_COLUMNS:
+            if name not in columns:
+                self.db.execute(f'ALTER TABLE features ADD COLUMN {name} {kind}')
+        stored_dim = self.db.execute("SELECT value FROM meta WHERE key = 'feature_dim'").fetchone()
+        if stored_dim is not None:
+            if feature_dim is not None and int(stored_dim[0]) != feature_dim:
+                raise ValueError(f"{self.prefix} holds {stored_dim[0]}-d features, not {feature_dim}-d")
+            feature_dim = int(stored_dim[0])
+        elif feature_dim is not None:
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('feature_dim', ?)", (str(feature_dim),))
+        self.feature_dim = feature_dim
+        current = self.db.execute("SELECT value FROM meta WHERE key = 'matrix_file'").fetchone()
+        if current is not None:
+            self.matrix_path = self.matrix_path.with_name(current[0])
+        # generations other than the indexed one are left over from an interrupted compact()
+        generation_file = re.compile(re.escape(Path(self.prefix).name) + r'(\.\d+)?\.f32')
+        for stale in self.matrix_path.parent.iterdir():
+            if generation_file.fullmatch(stale.name) and stale != self.matrix_path:
+                stale.unlink(missing_ok=True)
+        # rows past the highest indexed one are left over from an interrupted append
+        self.num_rows = self._indexed_rows()
+        self._matrix = None
+
+    @property
+    def row_bytes(self):
+        return self.feature_dim * 4
+
+    def _indexed_rows(self):
+        """Number of rows the index refers to (one past the highest indexed row)."""
+        highest = self.db.execute('SELECT MAX(row) FROM features').fetchone()[0]
+        return 0 if highest is None else highest + 1
+
+    @property
+    def matrix(self):
+        """Read-only memory-mapped (rows, feature_dim) matrix; rows are views, nothing is copied."""
+        if self.feature_dim is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        rows = self.num_rows
+        if self._matrix is None or len(self._matrix) != rows:
+            self._matrix = (np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(rows, self.feature_dim))
+                            if rows else np.zeros((0, self.feature_dim), dtype=np.float32))
+        return self._matrix
+
+    def append(self, paths, vectors, keys=None):
+        """
+        Add feature vectors for image paths, replacing any already stored for the same paths.
+
+        Args:
+            paths (list): Image paths, one per vector
+            vectors: Array-like of shape (len(paths), feature_dim)
+            keys (list): Optional (size, mtime, hash) per path, see file_key
+
+        Returns:
+            int: Number of vectors written
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(paths), -1)
+        if not len(paths):
+            return 0
+        if self.feature_dim is None:
+            self.feature_dim = vectors.shape[1]
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('feature_dim', ?)", (str(self.feature_dim),))
+        if vectors.shape[1] != self.feature_dim:
+            raise ValueError(f"Expected {self.feature_dim}-d features, got {vectors.shape[1]}-d")
+
+        first_row = self.num_rows
+        with open(self.matrix_path, 'r+b' if self.matrix_path.exists() else 'wb') as f:
+            f.truncate(first_row * self.row_bytes)
+            f.seek(first_row * self.row_bytes)
+            f.write(vectors.tobytes())
+        keys = keys or [(None, None, None)] * len(paths)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO features (path, row, size, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                                [(str(path), first_row + i) + tuple(key)
+                                 for i, (path, key) in enumerate(zip(paths, keys))])
+        self.num_rows = first_row + len(paths)
+        return len(paths)
+
+    def row(self, path):
+        """Row of a path in the matrix, or None if it is not stored."""
+        found = self.db.execute('SELECT row FROM features WHERE path = ?', (str(path),)).fetchone()
+        return None if found is None else found[0]
+
+    def get(self, path):
+        """Feature vector of one image path as a view into the mapped matrix, or None."""
+        row = self.row(path)
+        return None if row is None else self.matrix[row]
+
+    def __contains__(self, path):
+        return self.row(path) is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def items(self):
+        """Iterate over (path, vector) pairs in row order without loading the matrix."""
+        matrix = self.matrix
+        for path, row in self.db.execute('SELECT path, row FROM features ORDER BY row'):
+            yield path, matrix[row]
+
+    def chunks(self, chunk_size=65536):
+        """
+        Iterate over (paths, vectors) for up to chunk_size stored paths at a time, in row order.
+
+        Each vectors array is a copy gathered from the matrix, for batch work
+        such as statistics; use items() for views.
+        """
+        matrix = self.matrix
+        cursor = self.db.execute('SELECT path, row FROM features ORDER BY row')
+        while True:
+            entries = cursor.fetchmany(chunk_size)
+            if not entries:
+                return
+            yield [path for path, _ in entries], matrix[[row for _, row in entries]]
+
+    def merge(self, other, chunk_size=65536):
+        """
+        Append every vector of another store, with its file keys.
+
+        Returns:
+            int: Number of vectors merged
+        """
+        matrix = other.matrix
+        cursor = other.db.execute('SELECT path, row, size, mtime, hash FROM features ORDER BY row')
+        merged = 0
+        while True:
+            entries = cursor.fetchmany(chunk_size)
+            if not entries:
+                return merged
+            merged += self.append([entry[0] for entry in entries], matrix[[entry[1] for entry in entries]],
+                                  [entry[2:] for entry in entries])
+
+    def clear(self):
+        """Drop every vector and the feature dimension, e.g. when the model that made them changed."""
+        with self.db:
+            self.db.execute('DELETE FROM features')
+            self.db.execute("DELETE FROM meta WHERE key = 'feature_dim'")
+        self._matrix = None
+        self.matrix_path.unlink(missing_ok=True)
+        self.feature_dim = None
+        self.num_rows = 0
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def get_meta(self, key, default=None):
+        found = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if found is None else found[0]
+
+    def plan_update(self, paths, content_hash=False, chunk_size=10000, prune=False):
+        """
+        Compare image files on disk with the stored vectors and drop vectors of deleted files.
+
+        Files whose size and mtime match what was stored are unchanged. With
+        content_hash, a file whose size or mtime changed but whose SHA-256 is
+        the stored one only has its keys refreshed. The comparison runs in
+        SQLite against a temporary table, so only the paths to extract are
+        held in memory. Stored paths that are not in paths are only dropped
+        once their files are gone, so planning a subset of the dataset keeps
+        the other vectors; with prune, every path not in paths is dropped.
+
+        Args:
+            paths (list): Current image paths of the dataset
+            content_hash (bool): Hash file contents to detect real changes
+            chunk_size (int): Paths stat()ed and inserted per statement
+            prune (bool): Treat paths as the whole dataset and drop every other stored vector
+
+        Returns:
+            tuple: (paths to extract, counts of unchanged, new, changed, touched, removed and missing files)
+        """
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS current '
+                        '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+        self.db.execute('DELETE FROM current')
+        missing = 0
+        for i in range(0, len(paths), chunk_size):
+            rows = []
+            for path in paths[i:i + chunk_size]:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    missing += 1
+                    continue
+                rows.append((str(path), stat.st_size, stat.st_mtime_ns))
+            self.db.executemany('INSERT OR REPLACE INTO current (path, size, mtime) VALUES (?, ?, ?)', rows)
+
+        others = 'SELECT path FROM features WHERE path NOT IN (SELECT path FROM current)'
+        if prune:
+            with self.db:
+                removed = self.db.execute(f'DELETE FROM features WHERE path IN ({others})').rowcount
+        else:
+            gone = [path for (path,) in self.db.execute(others).fetchall() if not os.path.exists(path)]
+            self.remove(gone)
+            removed = len(gone)
+        unchanged = self.db.execute('SELECT COUNT(*) FROM current c JOIN features f ON f.path = c.path '
+                                    'WHERE f.size = c.size AND f.mtime = c.mtime').fetchone()[0]
+        candidates = self.db.execute('SELECT c.path, f.path IS NULL, f.hash FROM current c '
+                                     'LEFT JOIN features f ON f.path = c.path '
+                                     'WHERE f.path IS NULL OR f.size IS NOT c.size OR f.mtime IS NOT c.mtime').fetchall()
+
+        to_extract, touched, new = [], [], 0
+        hashes = []
+        for path, is_new, stored_hash in candidates:
+            new += is_new
+            if content_hash:
+                try:
+                    digest = file_sha256(path)
+                except OSError:
+                    missing += 1
+                    continue
+                hashes.append((digest, path))
+                if stored_hash is not None and digest == stored_hash:
+                    touched.append(path)
+                    continue
+            to_extract.append(path)
+        with self.db:
+            self.db.executemany('UPDATE current SET hash = ? WHERE path = ?', hashes)
+            # same contents under a new mtime: keep the vector, take the new keys
+            self.db.executemany('UPDATE features SET (size, mtime) = (SELECT size, mtime FROM current c '
+                                'WHERE c.path = features.path) WHERE path = ?', [(path,) for path in touched])
+        counts = {'unchanged': unchanged, 'new': new, 'changed': len(candidates) - new - len(touched),
+                  'touched': len(touched), 'removed': removed, 'missing': missing}
+        return to_extract, counts
+
+    def planned_keys(self, paths):
+        """(size, mtime, hash) recorded by the last plan_update for each path."""
+        keys = {}
+        for i in range(0, len(paths), 500):
+            chunk = [str(path) for path in paths[i:i + 500]]
+            query = f"SELECT path, size, mtime, hash FROM current WHERE path IN ({','.join('?' * len(chunk))})"
+            keys.update((path, (size, mtime, digest)) for path, size, mtime, digest in self.db.execute(query, chunk))
+        return [keys.get(str(path), (None, None, None)) for path in paths]
+
+    def remove(self, paths):
+        """Drop paths from the index; their rows stay in the matrix until compact()."""
+        with self.db:
+            self.db.executemany('DELETE FROM features WHERE path = ?', [(str(path),) for path in paths])
+
+    def compact(self):
+        """
+        Rewrite the matrix with only the rows the index still refers to.
+
+        Returns:
+            int: Number of rows reclaimed
+        """
+        if self.feature_dim is None:
+            return 0
+        old_rows = self.num_rows
+        entries = self.db.execute('SELECT path, row FROM features ORDER BY row').fetchall()
+        if len(entries) == old_rows:
+            return 0
+        matrix = self.matrix
+        generation = int(self.get_meta('generation', 0)) + 1
+        target = self.matrix_path.with_name(f'{Path(self.prefix).name}.{generation}.f32')
+        with open(target, 'wb') as f:
+            for _, row in entries:
+                f.write(matrix[row].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._matrix = None
+        del matrix
+        # the renumbered rows and the new file become current in one commit; until it succeeds
+        # the index still refers to the old file, which is only deleted afterwards
+        with self.db:
+            self.db.executemany('UPDATE features SET row = ? WHERE path = ?',
+                                [(new_row, path) for new_row, (path, _) in enumerate(entries)])
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(generation),))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('matrix_file', ?)", (target.name,))
+        old, self.matrix_path = self.matrix_path, target
+        old.unlink(missing_ok=True)
+        self.num_rows = len(entries)
+        return old_rows - len(entries)
+
+    def export_json(self, output_path):
+        """Write {path: [floats]} JSON, the old save_features format; for debugging only."""
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump({path: vector.tolist() for path, vector in self.items()}, f, indent=2)
+
+    def statistics(self, chunk_size=65536):
+        """Per-dimension mean, std, min and max over the stored vectors, computed chunk by chunk."""
+        count, total, squares, low, high = 0, 0.0, 0.0, None, None
+        for _, vectors in self.chunks(chunk_size):
+            vectors = vectors.astype(np.float64)
+            count += len(vectors)
+            total = total + vectors.sum(axis=0)
+            squares = squares + (vectors ** 2).sum(axis=0)
+            low = vectors.min(axis=0) if low is None else np.minimum(low, vectors.min(axis=0))
+            high = vectors.max(axis=0) if high is None else np.maximum(high, vectors.max(axis=0))
+        if not count:
+            return {}
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean ** 2, 0.0))
+        overall_mean = total.sum() / (count * self.feature_dim)
+        overall_std = np.sqrt(max(squares.sum() / (count * self.feature_dim) - overall_mean ** 2, 0.0))
+        return {
+            'num_images': count,
+            'feature_dim': self.feature_dim,
+            'mean_values': mean.tolist(),
+            'std_values': std.tolist(),
+            'min_values': low.tolist(),
+            'max_values': high.tolist(),
+            'overall_mean': float(overall_mean),
+            'overall_std': float(overall_std)
+        }
+
+    def close(self):
+        self._matrix = None
+        self.db.close()
@@ -1,10 +1,27 @@
 import tensorflow as tf
 import numpy as np
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import json
+import os
+import time
 from utils import preprocess_image
+from binary_store import BinaryFeatureStore
 from encoder import CustomImageEncoder
 
+# images are decoded by this many threads while the model runs; 0 decodes inline
+DECODE_WORKERS = int(os.environ.get('ENCODER_DECODE_WORKERS', min(8, os.cpu_count() or 1)))
+# batches decoded ahead of the one being inferred
+PREFETCH_BATCHES = int(os.environ.get('ENCODER_PREFETCH_BATCHES', 2))
+# worker processes for dataset extraction, each with its own model and shard of the images
+EXTRACT_PROCESSES = int(os.environ.get('ENCODER_PROCESSES', 1))
+
+def store_prefix(output_path):
+    """Store prefix for an output path; a trailing .json from the old default is dropped."""
+    return output_path[:-len('.json')] if output_path.endswith('.json') else output_path
+
 class FeatureExtractor:
     def __init__(self, model_path='models/custom_encoder_feature_extractor.keras'):
         """
@@ -66,13 +83,105 @@ class FeatureExtractor:
             print(f"Error extracting features from {image_path}: {str(e)}")
             return None
     
-    def extract_features_batch(self, image_paths, batch_size=32):
+    def iter_feature_batches(self, image_paths, batch_size=32, workers=DECODE_WORKERS, prefetch=PREFETCH_BATCHES,
+                             stats=None):
+        """
+        Extract features batch by batch, decoding upcoming batches while the current one runs.
+        
+        A pool of decode workers preprocesses images (cv2 releases the GIL)
+        for up to `prefetch` batches ahead of the one being inferred, so
+        decoding and model.predict overlap and memory stays bounded to
+        (prefetch + 1) * batch_size decoded images. workers=0 decodes on the
+        calling thread before each batch, like the original loop.
+        
+        Args:
+            image_paths (list): List of image file paths
+            batch_size (int): Batch size for processing
+            workers (int): Decode worker threads, 0 for no pipelining
+            prefetch (int): Batches decoded ahead of the current one
+            stats (dict): Optional dict filled with images, workers, seconds (wall time),
+                decode_seconds (summed over workers), infer_seconds and stall_seconds
+                (time the model waited for decoding)
+        
+        Yields:
+            tuple: (valid_paths, batch_features) for every batch with at least one decodable image
+        """
+        timings = stats if stats is not None else {}
+        timings.update(images=0, workers=workers, decode_seconds=0.0, infer_seconds=0.0, stall_seconds=0.0)
+        start = time.perf_counter()
+        # float += is not atomic across threads, but list.append is
+        decode_times = []
+        
+        def decode(path):
+            began = time.perf_counter()
+            image = preprocess_image(path, target_size=(224, 224))
+            decode_times.append(time.perf_counter() - began)
+            return image
+        
+        batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode') if workers else None
+        pending = deque()
+        
+        def submit(batch_paths):
+            if pool is None:
+                pending.append((batch_paths, None))
+            else:
+                pending.append((batch_paths, [pool.submit(decode, path) for path in batch_paths]))
+        
+        try:
+            next_batch = 0
+            while next_batch < len(batches) and len(pending) <= prefetch:
+                submit(batches[next_batch])
+                next_batch += 1
+            
+            processed = 0
+            while pending:
+                batch_paths, futures = pending.popleft()
+                waited = time.perf_counter()
+                if futures is None:
+                    images = [decode(path) for path in batch_paths]
+                else:
+                    images = [future.result() for future in futures]
+                    timings['stall_seconds'] += time.perf_counter() - waited
+                
+                # keep the workers busy with the next batch while this one is inferred
+                if next_batch < len(batches):
+                    submit(batches[next_batch])
+                    next_batch += 1
+                
+                valid_paths = [path for path, image in zip(batch_paths, images) if image is not None]
+                if valid_paths:
+                    # Remove batch dimension of each preprocessed image
+                    batch_array = np.array([image[0] for image in images if image is not None])
+                    began = time.perf_counter()
+                    batch_features = self.model.predict(batch_array, verbose=0)
+                    timings['infer_seconds'] += time.perf_counter() - began
+                    timings['images'] += len(valid_paths)
+                    yield valid_paths, batch_features.reshape(len(valid_paths), -1)
+                
+                # Progress update
+                processed += len(batch_paths)
+                print(f"Processed {processed}/{len(image_paths)} images")
+        finally:
+            if pool is not None:
+                for _, futures in pending:
+                    for future in futures or ():
+                        future.cancel()
+                pool.shutdown(wait=True)
+            timings['decode_seconds'] = sum(decode_times)
+            timings['seconds'] = time.perf_counter() - start
+    
+    def extract_features_batch(self, image_paths, batch_size=32, workers=DECODE_WORKERS, prefetch=PREFETCH_BATCHES,
+                               stats=None):
         """
         Extract features from multiple images in batches.
         
         Args:
             image_paths (list): List of image file paths
             batch_size (int): Batch size for processing
+            workers (int): Decode worker threads, 0 to decode on this thread between batches
+            prefetch (int): Batches decoded ahead while the current one is inferred
+            stats (dict): Optional dict filled with images, seconds and per-stage timings
         
         Returns:
             dict: Dictionary mapping image paths to feature vectors
@@ -85,78 +194,65 @@ class FeatureExtractor:
         
         print(f"Extracting features from {len(image_paths)} images...")
         
-        for i in range(0, len(image_paths), batch_size):
-            batch_paths = image_paths[i:i + batch_size]
-            batch_images = []
-            valid_paths = []
-            
-            # Preprocess batch
-            for path in batch_paths:
-                processed_img = preprocess_image(path, target_size=(224, 224))
-                if processed_img is not None:
-                    batch_images.append(processed_img[0])  # Remove batch dimension
-                    valid_paths.append(path)
-            
-            if batch_images:
-                # Convert to numpy array
-                batch_array = np.array(batch_images)
-                
-                # Extract features
-                batch_features = self.model.predict(batch_array, verbose=0)
-                
-                # Store features
-                for path, features in zip(valid_paths, batch_features):
-                    features_dict[path] = features.flatten()
-            
-            # Progress update
-            processed = min(i + batch_size, len(image_paths))
-            print(f"Processed {processed}/{len(image_paths)} images")
+        for valid_paths, batch_features in self.iter_feature_batches(image_paths, batch_size, workers, prefetch, stats):
+            # Store features
+            for path, features in zip(valid_paths, batch_features):
+                features_dict[path] = features
         
         return features_dict
     
-    def save_features(self, features_dict, output_path='outputs/extracted_features.json'):
+    def save_features(self, features_dict, output_path='outputs/extracted_features', export_json=False):
         """
-        Save extracted features to a JSON file.
+        Append extracted features to a binary feature store.
         
         Args:
             features_dict (dict): Dictionary of image paths to feature vectors
-            output_path (str): Path to save the features
+            output_path (str): Path prefix of the store (<prefix>.f32 and <prefix>_index.sqlite)
+            export_json (bool): Also write the whole store to <prefix>.json for debugging
+        
+        Returns:
+            BinaryFeatureStore: The store the features were written to
         """
-        # Convert numpy arrays to lists for JSON serialization
-        serializable_features = {}
-        for path, features in features_dict.items():
-            if isinstance(features, np.ndarray):
-                serializable_features[path] = features.tolist()
-            else:
-                serializable_features[path] = features
+        store = BinaryFeatureStore(store_prefix(output_path), self.feature_dim)
+        if features_dict:
+            store.append(list(features_dict), np.stack([np.asarray(f, dtype=np.float32).flatten()
+                                                        for f in features_dict.values()]))
         
-        # Create output directory
-        Path(output_path).parent.mkdir(exist_ok=True)
+        print(f"Features saved to {store.matrix_path} (index {store.index_path})")
+        print(f"Total features in store: {len(store)}")
         
-        # Save to JSON
-        with open(output_path, 'w') as f:
-            json.dump(serializable_features, f, indent=2)
+        if export_json:
+            json_path = store.prefix + '.json'
+            store.export_json(json_path)
+            print(f"JSON export written to {json_path}")
         
-        print(f"Features saved to {output_path}")
-        print(f"Total features saved: {len(serializable_features)}")
+        return store
     
-    def load_features(self, features_path='outputs/extracted_features.json'):
+    def load_features(self, features_path='outputs/extracted_features'):
         """
-        Load previously extracted features from JSON file.
+        Load previously extracted features.
+        
+        Vectors from a binary store are read-only views into the memory-mapped
+        matrix, so nothing is copied until they are used. A .json path is read
+        as the old JSON format.
         
         Args:
-            features_path (str): Path to the features JSON file
+            features_path (str): Store prefix, or a JSON file written by an older version
         
         Returns:
             dict: Dictionary of image paths to feature vectors
         """
         try:
-            with open(features_path, 'r') as f:
-                features_dict = json.load(f)
-            
-            # Convert lists back to numpy arrays
-            for path in features_dict:
-                features_dict[path] = np.array(features_dict[path])
+            if features_path.endswith('.json'):
+                with open(features_path, 'r') as f:
+                    features_dict = json.load(f)
+                
+                # Convert lists back to numpy arrays
+                for path in features_dict:
+                    features_dict[path] = np.array(features_dict[path])
+            else:
+                store = BinaryFeatureStore(features_path)
+                features_dict = dict(store.items())
             
             print(f"Loaded {len(features_dict)} feature vectors from {features_path}")
             return features_dict
@@ -170,11 +266,14 @@ class FeatureExtractor:
         Get statistics about the extracted features.
         
         Args:
-            features_dict (dict): Dictionary of image paths to feature vectors
+            features_dict (dict): Dictionary of image paths to feature vectors, or a BinaryFeatureStore
         
         Returns:
             dict: Statistics about the features
         """
+        if isinstance(features_dict, BinaryFeatureStore):
+            # computed chunk by chunk, the store may not fit in memory
+            return features_dict.statistics()
         if not features_dict:
             return {}
         
@@ -195,21 +294,23 @@ class FeatureExtractor:
     
     def print_feature_info(self, features_dict):
         """Print information about extracted features."""
-        stats = self.get_feature_statistics(features_dict)
-        
-        if not stats:
-            print("No feature statistics available.")
-            return
-        
-        print("\n" + "="*50)
-        print("FEATURE EXTRACTION RESULTS")
-        print("="*50)
-        print(f"Number of images processed: {stats['num_images']}")
-        print(f"Feature vector dimension: {stats['feature_dim']}")
-        print(f"Overall feature mean: {stats['overall_mean']:.4f}")
-        print(f"Overall feature std: {stats['overall_std']:.4f}")
-        print(f"Feature range: [{min(stats['min_values']):.4f}, {max(stats['max_values']):.4f}]")
-        print("="*50 + "\n")
+        print_statistics(self.get_feature_statistics(features_dict))
+
+def print_statistics(stats):
+    """Print feature statistics as returned by get_feature_statistics."""
+    if not stats:
+        print("No feature statistics available.")
+        return
+    
+    print("\n" + "="*50)
+    print("FEATURE EXTRACTION RESULTS")
+    print("="*50)
+    print(f"Number of images processed: {stats['num_images']}")
+    print(f"Feature vector dimension: {stats['feature_dim']}")
+    print(f"Overall feature mean: {stats['overall_mean']:.4f}")
+    print(f"Overall feature std: {stats['overall_std']:.4f}")
+    print(f"Feature range: [{min(stats['min_values']):.4f}, {max(stats['max_values']):.4f}]")
+    print("="*50 + "\n")
 
 def extract_single_image_features(image_path, model_path='models/custom_encoder_feature_extractor.keras'):
     """
@@ -235,47 +336,230 @@ def extract_single_image_features(image_path, model_path='models/custom_encoder_
     return features
 
 def extract_dataset_features(image_paths, model_path='models/custom_encoder_feature_extractor.keras',
-                           output_path='outputs/extracted_features.json', batch_size=32):
+                           output_path='outputs/extracted_features', batch_size=32, export_json=False,
+                           content_hash=False, processes=EXTRACT_PROCESSES, prune=False):
     """
-    Extract features from a dataset of images.
+    Extract features from a dataset of images, incrementally.
+    
+    Every stored vector is keyed by its image's path, size and mtime (and
+    SHA-256 with content_hash), so running again on the same dataset only
+    extracts new or changed images and drops the vectors of images deleted
+    from disk (with prune, of every image not in image_paths). The store also records the model that made its
+    vectors: if the model file or its feature dimension changed (e.g. after
+    retraining), every image is extracted again. Each batch is committed to the store as soon as it is extracted:
+    an interrupted run resumes where it stopped, and vectors are never all
+    held in memory. With processes > 1 the images are split across worker
+    processes, see extract_sharded.
     
     Args:
         image_paths (list): List of image file paths
         model_path (str): Path to the trained model
-        output_path (str): Path to save extracted features
+        output_path (str): Path prefix of the binary feature store
         batch_size (int): Batch size for processing
+        export_json (bool): Also export the features as JSON for debugging
+        content_hash (bool): Hash image contents, so files that were only touched are not re-extracted
+        processes (int): Worker processes, each writing its own shard
+        prune (bool): image_paths is the whole dataset; drop stored vectors of every other image
     
     Returns:
-        dict: Dictionary of image paths to feature vectors
+        BinaryFeatureStore: Store of image paths to feature vectors (supports len, in, get and items)
     """
     print("\n" + "="*60)
     print("EXTRACTING FEATURES FROM DATASET")
     print("="*60)
     
-    extractor = FeatureExtractor(model_path)
+    store = BinaryFeatureStore(store_prefix(output_path))
+    started, finished = store.get_meta('run_started'), store.get_meta('run_finished')
+    if started is not None and (finished is None or float(finished) < float(started)):
+        merged = merge_shards(store)
+        print(f"Resuming interrupted run ({len(store)} images already stored, {merged} merged from its shards)")
     
-    if extractor.model is None:
-        print("Failed to load model. Cannot extract features.")
-        return {}
+    if os.path.exists(model_path):
+        model = model_identity(model_path)
+        stored = json.loads(store.get_meta('model', 'null'))
+        if len(store) and (stored is None or any(stored.get(key) != value for key, value in model.items())):
+            print("Model changed since the features were stored; re-extracting every image")
+            store.clear()
+        store.set_meta('model', json.dumps(model))
     
-    # Extract features
-    features_dict = extractor.extract_features_batch(image_paths, batch_size)
+    image_paths = [str(path) for path in image_paths]
+    to_extract, counts = store.plan_update(image_paths, content_hash, prune=prune)
+    print(f"{counts['unchanged'] + counts['touched']} unchanged, {counts['new']} new, {counts['changed']} changed, "
+          f"{counts['removed']} removed, {counts['missing']} missing")
     
-    if features_dict:
+    if to_extract and processes > 1:
+        store.set_meta('run_started', time.time())
+        print(f"Extracting features from {len(to_extract)} images in {processes} processes...")
+        stored_dim = store.feature_dim
+        extract_sharded(store, to_extract, model_path, batch_size, processes)
+        if stored_dim is not None and store.feature_dim != stored_dim:
+            print(f"Stored features were {stored_dim}-d, the model makes {store.feature_dim}-d; "
+                  "re-extracting every image")
+            to_extract, _ = store.plan_update(image_paths, content_hash, prune=prune)
+            extract_sharded(store, to_extract, model_path, batch_size, processes)
+        store.set_meta('run_finished', time.time())
+    elif to_extract:
+        extractor = FeatureExtractor(model_path)
+        if extractor.model is None:
+            print("Failed to load model. Cannot extract features.")
+            return store
+        if store.feature_dim is not None and store.feature_dim != extractor.feature_dim:
+            print(f"Stored features are {store.feature_dim}-d, the model makes {extractor.feature_dim}-d; "
+                  "re-extracting every image")
+            store.clear()
+            to_extract, _ = store.plan_update(image_paths, content_hash, prune=prune)
+        
+        store.set_meta('run_started', time.time())
+        print(f"Extracting features from {len(to_extract)} images...")
+        for valid_paths, batch_features in extractor.iter_feature_batches(to_extract, batch_size):
+            store.append(valid_paths, batch_features, store.planned_keys(valid_paths))
+        store.set_meta('run_finished', time.time())
+    
+    # re-extracted and removed images leave dead rows behind
+    if store.num_rows > 2 * len(store):
+        store.compact()
+    
+    if store:
         # Print feature information
-        extractor.print_feature_info(features_dict)
+        stats = store.statistics()
+        print_statistics(stats)
+        
+        print(f"Features saved to {store.matrix_path} (index {store.index_path})")
+        print(f"Total features in store: {len(store)}")
         
-        # Save features
-        extractor.save_features(features_dict, output_path)
+        if export_json:
+            json_path = store.prefix + '.json'
+            store.export_json(json_path)
+            print(f"JSON export written to {json_path}")
         
         # Save feature statistics
-        stats = extractor.get_feature_statistics(features_dict)
-        stats_path = output_path.replace('.json', '_stats.json')
+        stats_path = store_prefix(output_path) + '_stats.json'
         with open(stats_path, 'w') as f:
             json.dump(stats, f, indent=2)
         print(f"Feature statistics saved to {stats_path}")
     
-    return features_dict
+    return store
+
+def model_identity(model_path):
+    """Absolute path, size and mtime of a model; vectors stored by any other model are stale."""
+    stat = os.stat(model_path)
+    return {'path': os.path.abspath(model_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def shard_prefix(prefix, index):
+    return f'{prefix}_shard{index}'
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def extract_shard(image_paths, keys, model_path, prefix, batch_size, threads, cpus=None):
+    """
+    Worker process: extract one shard of a dataset into its own feature store.
+    
+    TensorFlow's thread pools are sized before the model is loaded, so the
+    workers share the machine instead of each starting a pool per core.
+    
+    Args:
+        image_paths (list): Image paths of this shard
+        keys (list): (size, mtime, hash) per path, stored with the vectors
+        model_path (str): Path to the trained model
+        prefix (str): Path prefix of the shard store
+        batch_size (int): Batch size for processing
+        threads (int): TensorFlow intra-op threads, also used as decode workers
+        cpus (list): CPUs to pin the process to, if the platform supports it
+    
+    Returns:
+        dict: iter_feature_batches stats plus load_seconds, pid and the model's feature_dim
+    """
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    
+    start = time.perf_counter()
+    extractor = FeatureExtractor(model_path)
+    if extractor.model is None:
+        raise RuntimeError(f"Feature extractor could not be loaded from {model_path}")
+    load_seconds = time.perf_counter() - start
+    
+    store = BinaryFeatureStore(prefix, extractor.feature_dim)
+    keys = dict(zip(image_paths, keys))
+    stats = {}
+    try:
+        for valid_paths, batch_features in extractor.iter_feature_batches(image_paths, batch_size, threads,
+                                                                          stats=stats):
+            store.append(valid_paths, batch_features, [keys[path] for path in valid_paths])
+    finally:
+        store.close()
+    stats.update(load_seconds=load_seconds, pid=os.getpid(), feature_dim=extractor.feature_dim)
+    return stats
+
+def merge_shards(store):
+    """
+    Move the vectors of every shard store next to store into it, then delete the shards.
+    
+    Shards left by an interrupted run are merged too; the next plan_update
+    re-extracts any of their images that changed in the meantime.
+    
+    Returns:
+        int: Number of vectors merged
+    """
+    merged = 0
+    prefix = Path(store.prefix)
+    for index_path in sorted(prefix.parent.glob(prefix.name + '_shard*_index.sqlite')):
+        shard = BinaryFeatureStore(str(index_path)[:-len('_index.sqlite')])
+        merged += store.merge(shard)
+        shard.close()
+        shard.matrix_path.unlink(missing_ok=True)
+        shard.index_path.unlink()
+    return merged
+
+def extract_sharded(store, image_paths, model_path='models/custom_encoder_feature_extractor.keras', batch_size=32,
+                    processes=EXTRACT_PROCESSES, threads=None):
+    """
+    Extract features in several processes, one contiguous shard of image_paths each, and merge them into store.
+    
+    Each worker loads its own copy of the model, uses `threads` intra-op
+    threads pinned to its own CPUs where possible, and writes its own
+    shard store, so workers never contend on a lock. The shards are merged
+    into store once every worker is done.
+    
+    Args:
+        store (BinaryFeatureStore): Store to merge into; plan_update must have run for image_paths
+        image_paths (list): Image paths to extract
+        model_path (str): Path to the trained model
+        batch_size (int): Batch size for processing
+        processes (int): Worker processes
+        threads (int): Intra-op threads per worker, default the available CPUs split evenly
+    
+    Returns:
+        list: Stats of each worker, see extract_shard
+    """
+    if not image_paths:
+        return []
+    cpus = available_cpus()
+    processes = max(1, min(processes, len(image_paths)))
+    threads = threads or max(1, len(cpus) // processes)
+    shard_size = -(-len(image_paths) // processes)
+    shards = [image_paths[i:i + shard_size] for i in range(0, len(image_paths), shard_size)]
+    
+    # TensorFlow is not fork-safe; spawned workers import this module afresh
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as pool:
+        futures = []
+        for i, shard in enumerate(shards):
+            pinned = cpus[i * threads:(i + 1) * threads] if (i + 1) * threads <= len(cpus) else None
+            futures.append(pool.submit(extract_shard, shard, store.planned_keys(shard), model_path,
+                                       shard_prefix(store.prefix, i), batch_size, threads, pinned))
+        results = [future.result() for future in futures]
+    
+    if store.feature_dim is not None and store.feature_dim != results[0]['feature_dim']:
+        # the stored vectors came from a model with another output size
+        store.clear()
+    merge_shards(store)
+    return results
 
 def demonstrate_feature_extraction(test_image_path, model_path='models/custom_encoder_feature_extractor.keras'):
     """
@@ -118,7 +118,7 @@ def main_pipeline(
         sample_features = extract_dataset_features(
             image_paths=sample_images,
             model_path=model_path,
-            output_path='outputs/sample_features.json',
+            output_path='outputs/sample_features',
             batch_size=min(batch_size, len(sample_images))
         )
         
@@ -155,7 +155,7 @@ def main_pipeline(
         
         print("\n📁 Output files:")
         print(f"  🔧 Trained model: models/custom_encoder_feature_extractor.keras")
-        print(f"  📊 Sample features: outputs/sample_features.json")
+        print(f"  📊 Sample features: {sample_features.matrix_path}")
         print(f"  🎯 Demo features: outputs/demo_features.json")
         print(f"  📈 Training history: outputs/training_history.png")
         
@@ -208,7 +208,7 @@ def extract_only_mode(image_path=None):
     else:
         # Extract from dataset
         image_paths = prepare_dataset()
-        features = extract_dataset_features(image_paths)
+        features = extract_dataset_features(image_paths, prune=True)
         return len(features) > 0
 
 if __name__ == "__main__":
@@ -1,45 +1,103 @@
 import numpy as np
 import cv2
+from PIL import Image
 from tensorflow.keras.applications.imagenet_utils import preprocess_input
 from tensorflow.keras.preprocessing.image import img_to_array
 import os
 
-def preprocess_image(image_path, target_size=(224, 224)):
+# cv2 flags that decode a JPEG at reduced scale in the DCT domain, largest reduction first
+REDUCED_READ_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+def reduced_read_flag(image_path, target_size):
+    """
+    Pick the cv2.imread flag for loading an image that will be resized to target_size.
+
+    JPEGs at least twice the target size in both dimensions are decoded at
+    the largest 1/2, 1/4 or 1/8 scale that still covers it; only the header
+    is read to find the source size.
+    
+    Args:
+        image_path (str): Path to the image file
+        target_size (tuple): (width, height) the image is resized to afterwards
+    
+    Returns:
+        int: cv2.IMREAD_REDUCED_COLOR_* or cv2.IMREAD_COLOR
+    """
+    try:
+        with Image.open(image_path) as image:
+            if image.format != 'JPEG':
+                return cv2.IMREAD_COLOR
+            width, height = image.size
+    except OSError:
+        return cv2.IMREAD_COLOR
+    for factor, flag in REDUCED_READ_FLAGS:
+        if width // factor >= target_size[0] and height // factor >= target_size[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def preprocess_image(image_path, target_size=(224, 224), reduced=True):
     """
     Load and preprocess an image for the CNN encoder.
     
     Args:
         image_path (str): Path to the image file
         target_size (tuple): Target dimensions for resizing
+        reduced (bool): Decode large JPEGs at reduced scale before resizing
     
     Returns:
         np.ndarray: Preprocessed image array
     """
     try:
-        # Load image
-        image = cv2.imread(image_path)
+        # Load image, at reduced scale when it is much larger than the target
+        flag = reduced_read_flag(image_path, target_size) if reduced else cv2.IMREAD_COLOR
+        image = cv2.imread(image_path, flag)
         if image is None:
             raise ValueError(f"Could not load image from {image_path}")
         
-        # Convert BGR to RGB
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Resize image
-        image = cv2.resize(image, target_size)
-        
-        # Convert to array and expand dimensions
-        image = img_to_array(image)
-        image = np.expand_dims(image, axis=0)
-        
-        # Normalize pixel values to [0, 1]
-        image = image.astype('float32') / 255.0
-        
-        return image
+        return normalize_image(image, target_size)
     
     except Exception as e:
         print(f"Error preprocessing image {image_path}: {str(e)}")
         return None
 
+def preprocess_image_bytes(data, target_size=(224, 224)):
+    """
+    Decode uploaded image bytes and preprocess them like preprocess_image.
+    
+    Args:
+        data (bytes): Encoded image file contents
+        target_size (tuple): Target dimensions for resizing
+    
+    Returns:
+        np.ndarray: Preprocessed image array
+    
+    Raises:
+        ValueError: If the bytes are not a decodable image
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return normalize_image(image, target_size)
+
+def normalize_image(image, target_size=(224, 224)):
+    """Turn a decoded BGR image into a (1, height, width, 3) RGB float32 batch in [0, 1]."""
+    # Convert BGR to RGB
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
+    # Resize image
+    image = cv2.resize(image, target_size)
+    
+    # Convert to array and expand dimensions
+    image = img_to_array(image)
+    image = np.expand_dims(image, axis=0)
+    
+    # Normalize pixel values to [0, 1]
+    return image.astype('float32') / 255.0
+
 def batch_preprocess_images(image_paths, target_size=(224, 224), batch_size=32):
     """
     Preprocess multiple images in batches.
@@ -1,9 +1,11 @@
 from flask import Flask, request, jsonify
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from PIL import Image
 import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 import pickle
 import numpy as np
@@ -17,71 +19,443 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.utils import to_categorical,plot_model
 from tensorflow.keras.layers import Input,Dense,LSTM,Embedding, Dropout,add
 from tensorflow.keras.models import load_model
+from decoding import CaptionDecoder, StatefulCaptionDecoder
+from scheduler import BatchScheduler
+from compiled import compile_model
+from quantized import DenseQuantizedModel
+from caption_cache import CaptionCache, model_identity
+from feature_store import FeatureStore
+from image_io import DEFAULT_MAX_UPLOAD_MB, decode_image
+from loading import ModelLoader, ModelsNotReady
+from streaming import sse_stream
+from deadlines import deadline_after, limit_reached, parse_limits
+from metrics import CONTENT_TYPE, METRICS, instrument
 api = Flask(__name__)
 CORS(api)
 
-UPLOAD_FOLDER = './uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-vgg_model = VGG16()
-# restructure the model
-vgg_model = Model(inputs=vgg_model.inputs,
-                  outputs=vgg_model.layers[-2].output)
+# uploads are decoded from the request body in memory; larger bodies get a 413
+api.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('CAPTION_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024)
 max_length = 35
-model = load_model('models/my_model.keras',compile=False)
-model.compile(loss='categorical_crossentropy', optimizer='adam')
-with open('models/features.pkl', 'rb') as file:
-    features = pickle.load(file)
-with open('models/tokenizer.pkl', 'rb') as file:
-    tokenizer = pickle.load(file)
-def idx_to_word(integer, tokenizer):
-    for word, index in tokenizer.word_index.items():
-        if index == integer:
-            return word
-    return None
-def predict_caption(model, image, tokenizer, max_length):
-    # add start tag for generation process
-    in_text = 'startseq'
-    # iterate over the max length of sequence
-    for i in range(max_length):
-        # encode input sequence
-        sequence = tokenizer.texts_to_sequences([in_text])[0]
-        # pad the sequence
-        sequence = pad_sequences([sequence], max_length, padding='post')
-        # predict next word
-        yhat = model.predict([image, sequence], verbose=0)
-        # get index with high probability
-        yhat = np.argmax(yhat)
-        # convert index to word
-        word = idx_to_word(yhat, tokenizer)
-        # stop if word not found
-        if word is None:
-            break
-        # append word as input for generating next word
-        in_text += " " + word
-        # stop if we reach end tag
-        if word == 'endseq':
-            break
-    return in_text
-
-def generate_caption(image_path):
+# label for this app's metrics
+BACKEND = 'vgg16-lstm'
+MAX_BEAM_WIDTH = 10
+# cross-request micro-batching of VGG16 and decoder inference
+BATCHING = os.environ.get('CAPTION_BATCHING', '0') == '1'
+BATCH_MAX_SIZE = int(os.environ.get('CAPTION_BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('CAPTION_BATCH_MAX_WAIT_MS', 5))
+# fixed-signature graph functions with batch buckets instead of model.predict
+COMPILED = os.environ.get('CAPTION_COMPILED', '1') == '1'
+VGG_BUCKETS = (1, 2, 4, 8, 16)
+# int8 dynamic-range quantized VGG16 dense layers and caption model for CPU serving
+QUANTIZE = os.environ.get('CAPTION_QUANTIZE', '0') == '1'
+# 'native' runs TensorFlow; 'onnx' runs the graphs written by export_onnx.py with ONNX Runtime
+RUNTIME = os.environ.get('CAPTION_RUNTIME', 'native')
+if RUNTIME == 'onnx':
+    from onnx_runtime import ONNX_DIR, ORT_THREADS, OnnxFunction, onnx_path
+# content-addressed caption cache; an empty CAPTION_CACHE_DIR keeps it in memory only
+CACHE_ENABLED = os.environ.get('CAPTION_CACHE', '1') == '1'
+CACHE_SIZE = int(os.environ.get('CAPTION_CACHE_SIZE', 1024))
+CACHE_DIR = os.environ.get('CAPTION_CACHE_DIR', './caption_cache')
+# memory-mapped dataset features (see feature_store.py) used to skip VGG16 for known images
+FEATURE_STORE_PREFIX = os.environ.get('CAPTION_FEATURE_STORE', 'models/features')
+# 'stateful' steps the LSTM one token at a time, 'full' re-runs the padded sequence
+DECODER_MODE = os.environ.get('CAPTION_DECODER_MODE', 'stateful')
+# /upload_batch limits and image decode parallelism
+MAX_BATCH_FILES = int(os.environ.get('CAPTION_MAX_BATCH_FILES', 64))
+PREPROCESS_WORKERS = int(os.environ.get('CAPTION_PREPROCESS_WORKERS', min(8, os.cpu_count() or 1)))
+# load models on a background thread so the app can answer /ready immediately
+LAZY_LOAD = os.environ.get('CAPTION_LAZY_LOAD', '0') == '1'
+# caption a blank image once after loading so the first request is not the slow one
+WARMUP = os.environ.get('CAPTION_WARMUP', '0') == '1'
+
+vgg_model = None
+encode_images = None
+model = None
+tokenizer = None
+decoder = None
+feature_store = None
+scheduler = None
+
+preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+caption_cache = None
+if CACHE_ENABLED:
+    # quantized and ONNX Runtime captions can differ from fp32 ones, so they are cached separately
+    if RUNTIME == 'onnx':
+        cache_model_id = model_identity('vgg16-lstm-onnx', 'models/tokenizer.pkl', ONNX_DIR)
+    else:
+        cache_model_id = model_identity('vgg16-lstm-int8' if QUANTIZE else 'vgg16-lstm',
+                                        'models/my_model.keras', 'models/tokenizer.pkl')
+    caption_cache = CaptionCache(cache_model_id,
+                                 capacity=CACHE_SIZE, directory=CACHE_DIR or None)
+
+def load_vgg16():
+    global vgg_model, encode_images
+    if RUNTIME == 'onnx':
+        # the exported graph replaces the Keras weights entirely
+        encode_images = OnnxFunction(onnx_path('vgg16'))
+        encode_images.warm_up()
+    else:
+        vgg_model = VGG16()
+        # restructure the model
+        vgg_model = Model(inputs=vgg_model.inputs,
+                          outputs=vgg_model.layers[-2].output)
+        encode_images = lambda images: vgg_model.predict(images, verbose=0)
+        if QUANTIZE:
+            encode_images = DenseQuantizedModel(vgg_model, buckets=VGG_BUCKETS)
+            encode_images.warm_up()
+        elif COMPILED:
+            # trace every batch bucket and run it once now so requests never retrace
+            encode_images = compile_model(vgg_model, buckets=VGG_BUCKETS)
+            encode_images.warm_up()
+    # every VGG16 pass, batched or not, is timed as the encoder stage
+    encode_images = METRICS.timed('encoder', BACKEND, encode_images)
+
+def load_caption_model():
+    global model, tokenizer, decoder, scheduler
+    model = load_model('models/my_model.keras',compile=False)
+    model.compile(loss='categorical_crossentropy', optimizer='adam')
+    with open('models/tokenizer.pkl', 'rb') as file:
+        tokenizer = pickle.load(file)
+    # id -> word table is built once here instead of on every decode step
+    decoder = CaptionDecoder(model, tokenizer, max_length)
+    if DECODER_MODE == 'stateful':
+        try:
+            decoder = StatefulCaptionDecoder(model, tokenizer, max_length)
+        except ValueError as e:
+            print(f"Stateful decoder unavailable, using full-sequence decoding: {str(e)}")
+    decoder.on_step = METRICS.step_observer(BACKEND)
+    if RUNTIME == 'onnx':
+        decoder.use_onnx(ONNX_DIR, ORT_THREADS)
+    elif QUANTIZE:
+        decoder.quantize()
+    elif COMPILED:
+        decoder.compile()
+    if BATCHING:
+        scheduler = BatchScheduler(encode_images, decoder,
+                                   max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+def load_feature_store():
+    global feature_store
+    if os.path.exists(FEATURE_STORE_PREFIX + '.npy'):
+        feature_store = FeatureStore(FEATURE_STORE_PREFIX)
+
+def warm_up():
+    blank = np.zeros((1, 224, 224, 3), dtype='float32')
+    decoder.predict_caption(encode_images(preprocess_input(blank)))
+
+def shutdown():
+    """Stop this module's background threads so an unloaded model can be freed."""
+    if scheduler is not None:
+        scheduler.close()
+    preprocess_pool.shutdown(wait=True)
+
+loader = ModelLoader()
+loader.add('vgg16', load_vgg16)
+loader.add('caption_model', load_caption_model)
+loader.add('feature_store', load_feature_store)
+if WARMUP:
+    loader.add('warmup', warm_up)
+loader.start(background=LAZY_LOAD)
+
+def load_image(data):
+    with METRICS.time('image_decode', BACKEND):
+        image = decode_image(data, target_size=(224, 224))
+    with METRICS.time('preprocess', BACKEND):
+        image = img_to_array(image)
+        # reshape data for model
+        image = image.reshape((1, image.shape[0], image.shape[1], image.shape[2]))
+        # preprocess image from vgg
+        return preprocess_input(image)
+
+def generate_caption(data, beam_width=1, length_penalty=1.0, feature=None, deadline=None, max_tokens=None,
+                     cancel=None):
 
 
     # Placeholder for the actual image captioning model
     # In reality, you would load a model and generate a caption here
-    image = load_img(image_path, target_size=(224, 224))
-    image = img_to_array(image)
-    # reshape data for model
-    image = image.reshape((1, image.shape[0], image.shape[1], image.shape[2]))
-    # preprocess image from vgg
-    image = preprocess_input(image)
-    # extract features
-    feature = vgg_model.predict(image, verbose=0)
-    # predict from the trained model
-    text = predict_caption(model, feature, tokenizer, max_length)
+    image = load_image(data) if feature is None else None
+    truncated = False
+    if scheduler is not None:
+        # encoder and decoder run batched with other in-flight requests
+        future = scheduler.submit(image, beam_width, length_penalty, feature=feature,
+                                  deadline=deadline, max_tokens=max_tokens, cancel=cancel)
+        words = future.result()
+        truncated = future.truncated
+        text = " ".join([decoder.start_token] + words)
+    else:
+        # extract features unless the image is a known dataset image
+        if feature is None:
+            feature = encode_images(image)
+        # predict from the trained model
+        if beam_width == 1 and (deadline is not None or max_tokens is not None or cancel is not None):
+            words, truncated = decoder.decode_within(feature, deadline, max_tokens, cancel)
+            text = " ".join([decoder.start_token] + words)
+        elif cancel is not None:
+            words = decoder.beam_search(feature, beam_width, length_penalty, cancel=cancel)
+            # a cancelled search is cut short and must not be cached
+            truncated = cancel.is_set()
+            text = " ".join([decoder.start_token] + words)
+        else:
+            text = decoder.predict_caption(feature, beam_width, length_penalty=length_penalty)
     text = text.split(" ")
-    text = text[1:-1]
+    # a truncated caption has no end tag to drop
+    text = text[1:] if truncated else text[1:-1]
     text = " ".join(text)
-    return text
+    return text, truncated
+
+def generate_captions(items, beam_width=1, length_penalty=1.0):
+    """
+    Caption several uploads with batched encoder and decoder passes.
+
+    Args:
+        items (list): (data, feature) pairs; feature is None unless known from the feature store
+        beam_width (int): Beam width, 1 for greedy decoding
+        length_penalty (float): Length penalty used by beam search
+
+    Returns:
+        list: One caption string or Exception per item
+    """
+    results = [None] * len(items)
+    features = [feature for _, feature in items]
+
+    # decode and preprocess images in parallel
+    pending = [i for i, feature in enumerate(features) if feature is None]
+    images = {}
+    for i, image in zip(pending, preprocess_pool.map(lambda i: capture_errors(load_image, items[i][0]), pending)):
+        if isinstance(image, Exception):
+            results[i] = image
+        else:
+            images[i] = image
+
+    if scheduler is not None:
+        # the scheduler batches these with each other and with concurrent requests
+        futures = {i: scheduler.submit(images.get(i), beam_width, length_penalty, feature=features[i])
+                   for i in range(len(items)) if results[i] is None}
+        for i, future in futures.items():
+            results[i] = capture_errors(lambda: " ".join(future.result()[:-1]))
+        return results
+
+    if images:
+        # one VGG16 forward pass for every image that needs it
+        indices = list(images)
+        encoded = capture_errors(encode_images, np.concatenate([images[i] for i in indices]))
+        for n, i in enumerate(indices):
+            if isinstance(encoded, Exception):
+                results[i] = encoded
+            else:
+                features[i] = encoded[n:n + 1]
+
+    ready = [i for i in range(len(items)) if results[i] is None]
+    if beam_width > 1:
+        for i in ready:
+            results[i] = capture_errors(lambda: " ".join(decoder.beam_search(features[i], beam_width, length_penalty)[:-1]))
+    elif ready:
+        captions = capture_errors(decoder.decode_batch, np.concatenate([features[i] for i in ready]))
+        for n, i in enumerate(ready):
+            results[i] = captions if isinstance(captions, Exception) else " ".join(captions[n][:-1])
+    return results
+
+def parse_options(form):
+    """Read optional decoding options from form fields; raises ValueError on bad values."""
+    # optional beam search; beam_width=1 keeps greedy decoding
+    try:
+        beam_width = int(form.get('beam_width', 1))
+        length_penalty = float(form.get('length_penalty', 1.0))
+    except ValueError:
+        raise ValueError('beam_width must be an integer and length_penalty a number')
+    if not 1 <= beam_width <= MAX_BEAM_WIDTH:
+        raise ValueError(f'beam_width must be between 1 and {MAX_BEAM_WIDTH}')
+    # optional latency budget and length cap; beam search always runs to completion
+    limits = parse_limits(form)
+    if beam_width > 1 and any(value is not None for value in limits.values()):
+        raise ValueError('budget_ms and max_tokens need greedy decoding (beam_width=1)')
+    return dict(limits, beam_width=beam_width, length_penalty=length_penalty)
+
+def cache_key_for(data, beam_width=1, length_penalty=1.0, max_tokens=None):
+    options = {'beam_width': beam_width, 'length_penalty': length_penalty}
+    if max_tokens is not None:
+        # a full caption is only a valid answer under the cap it was generated with
+        options['max_tokens'] = max_tokens
+    return caption_cache.key(data, **options)
+
+def caption_upload(data, beam_width=1, length_penalty=1.0, budget_ms=None, max_tokens=None, cancel=None):
+    """
+    Caption uploaded image bytes, using the cache and feature store when possible.
+
+    Args:
+        budget_ms (float): Optional latency budget; decoding stops when it runs out
+        max_tokens (int): Optional caption length cap in words
+        cancel (threading.Event): Set to stop decoding, e.g. when the client went away
+
+    Returns:
+        tuple: (caption, truncated); truncated is True if the budget, cap or cancel cut decoding short
+
+    Raises:
+        ModelsNotReady: If the models are still loading and the caption is not cached
+        ValueError: If the bytes are not a decodable image
+    """
+    deadline = deadline_after(budget_ms)
+    # repeat uploads are answered from the cache without running the models
+    cache_key = None
+    if caption_cache is not None:
+        cache_key = cache_key_for(data, beam_width, length_penalty, max_tokens)
+        cached = caption_cache.get(cache_key)
+        if cached is not None:
+            METRICS.count('captions', BACKEND)
+            return cached, False
+    loader.require()
+    # known dataset images take their feature from the mmap instead of VGG16
+    feature = feature_store.lookup_bytes(data) if feature_store is not None else None
+    caption, truncated = generate_caption(data, beam_width, length_penalty, feature, deadline, max_tokens, cancel)
+    # a caption cut short is not the model's full answer, so it is not cached
+    if cache_key is not None and not truncated:
+        caption_cache.put(cache_key, caption)
+    METRICS.count('captions', BACKEND)
+    return caption, truncated
+
+def caption_stream(data, beam_width=1, length_penalty=1.0, budget_ms=None, max_tokens=None):
+    """
+    Start captioning uploaded image bytes and return a generator of stream events.
+
+    The image is decoded and encoded before this returns, so bad uploads and
+    unloaded models fail here rather than part-way through the stream.
+
+    Returns:
+        generator: ('token', word) for each decoded word (greedy decoding only),
+            then ('caption', {'caption': text, 'truncated': bool}) like /upload returns
+
+    Raises:
+        ModelsNotReady: If the models are still loading and the caption is not cached
+        ValueError: If the bytes are not a decodable image
+    """
+    deadline = deadline_after(budget_ms)
+    cache_key = None
+    if caption_cache is not None:
+        cache_key = cache_key_for(data, beam_width, length_penalty, max_tokens)
+        cached = caption_cache.get(cache_key)
+        if cached is not None:
+            METRICS.count('captions', BACKEND)
+            return iter([('caption', {'caption': cached, 'truncated': False})])
+    loader.require()
+    feature = feature_store.lookup_bytes(data) if feature_store is not None else None
+    image = load_image(data) if feature is None else None
+    if scheduler is not None:
+        # words arrive from the scheduler thread; None marks the end of the caption
+        words = queue.Queue()
+        future = scheduler.submit(image, beam_width, length_penalty, feature=feature, on_token=words.put,
+                                  deadline=deadline, max_tokens=max_tokens)
+        future.add_done_callback(lambda _: words.put(None))
+    elif feature is None:
+        feature = encode_images(image)
+
+    def events():
+        truncated = False
+        if scheduler is not None:
+            for word in iter(words.get, None):
+                if word != decoder.end_token:
+                    yield 'token', word
+            caption = future.result()
+            truncated = future.truncated
+        elif beam_width > 1:
+            # beams are only final once the search ends, so there is nothing to stream
+            caption = decoder.beam_search(feature, beam_width, length_penalty)
+        else:
+            caption = []
+            for word in decoder.stream(feature):
+                caption.append(word)
+                if word != decoder.end_token:
+                    yield 'token', word
+                    if limit_reached(caption, deadline, max_tokens):
+                        truncated = True
+                        break
+        caption = " ".join(caption if truncated else caption[:-1])
+        if cache_key is not None and not truncated:
+            caption_cache.put(cache_key, caption)
+        METRICS.count('captions', BACKEND)
+        yield 'caption', {'caption': caption, 'truncated': truncated}
+    return events()
+
+def caption_batch(uploads, beam_width=1, length_penalty=1.0, budget_ms=None, max_tokens=None):
+    """
+    Caption several uploads with batched model passes, using the cache when possible.
+
+    Args:
+        uploads (list): (filename, data) pairs
+        beam_width (int): Beam width, 1 for greedy decoding
+        length_penalty (float): Length penalty used by beam search
+
+    Returns:
+        list: One dict per upload with its filename and either 'caption' or 'error'
+
+    Raises:
+        ValueError: If budget_ms or max_tokens is set
+    """
+    # batched decoding runs every caption to completion, so per-request limits cannot be honoured
+    if budget_ms is not None or max_tokens is not None:
+        raise ValueError('budget_ms and max_tokens are not supported by /upload_batch')
+
+    results = [{'filename': filename} for filename, _ in uploads]
+    items, keys, positions = [], [], []
+    for position, (_, data) in enumerate(uploads):
+        cache_key = None
+        if caption_cache is not None:
+            cache_key = caption_cache.key(data, beam_width=beam_width, length_penalty=length_penalty)
+            cached = caption_cache.get(cache_key)
+            if cached is not None:
+                results[position]['caption'] = cached
+                continue
+        if not loader.ready:
+            results[position]['error'] = 'Models are still loading'
+            continue
+        feature = feature_store.lookup_bytes(data) if feature_store is not None else None
+        items.append((data, feature))
+        keys.append(cache_key)
+        positions.append(position)
+
+    if items:
+        for position, cache_key, caption in zip(positions, keys, generate_captions(items, beam_width, length_penalty)):
+            if isinstance(caption, Exception):
+                results[position]['error'] = str(caption)
+                continue
+            results[position]['caption'] = caption
+            if cache_key is not None:
+                caption_cache.put(cache_key, caption)
+    METRICS.count('captions', BACKEND, sum('caption' in result for result in results))
+    return results
+
+def capture_errors(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as e:
+        return e
+
+instrument(api, BACKEND, ('upload_file', 'upload_stream', 'upload_batch'))
+
+@api.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f"File too large (limit {api.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)"}), 413
+
+@api.route('/ready', methods=['GET'])
+def ready():
+    status = loader.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@api.route('/cache', methods=['GET'])
+def cache_stats():
+    if caption_cache is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(enabled=True, **caption_cache.stats())), 200
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+@api.route('/scheduler', methods=['GET'])
+def scheduler_metrics():
+    if scheduler is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(enabled=True, **scheduler.metrics())), 200
 
 @api.route('/upload', methods=['POST'])
 def upload_file():
@@ -90,11 +464,49 @@ def upload_file():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
+    try:
+        options = parse_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     if file:
-        file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(file_path)
-        caption = generate_caption(file_path)
-        os.remove(file_path)
-        return jsonify({'caption': caption}), 200
+        try:
+            caption, truncated = caption_upload(file.read(), **options)
+        except ModelsNotReady as e:
+            return jsonify({'error': str(e), 'status': loader.status()}), 503
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'caption': caption, 'truncated': truncated}), 200
+
+@api.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    file = request.files['file']
+    if not file or file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    try:
+        options = parse_options(request.form)
+        events = caption_stream(file.read(), **options)
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e), 'status': loader.status()}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # server-sent events: one message per word, then a 'done' event with the caption
+    return Response(sse_stream(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'error': 'No files part'}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({'error': f'At most {MAX_BATCH_FILES} files per batch'}), 400
+    try:
+        results = caption_batch([(file.filename, file.read()) for file in files], **parse_options(request.form))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results}), 200
+
 if __name__=="__main__":
     api.run()
@@ -0,0 +1,214 @@
+"""
+ASGI serving mode for the caption APIs.
+
+HTTP handling stays on the event loop; captioning runs on a bounded,
+dedicated inference executor of CAPTION_INFERENCE_THREADS threads. All of
+them share the one loaded model, with the intra-op threads split between
+them; they overlap image decoding and preprocessing, and model calls only
+where the backend allows it (compiled TensorFlow functions, PyTorch and
+ONNX Runtime release the GIL; quantized interpreters and the batching
+scheduler run one call at a time). This is not a set of model replicas:
+memory stays that of one model. If a client disconnects while its request is still queued, the
+request is cancelled before it reaches the model; if inference is already
+running, its cancel event stops decoding at the next step.
+
+Requires starlette, python-multipart and an ASGI server such as uvicorn:
+    CAPTION_BACKEND=vgg16-lstm uvicorn asgi:app --port 5000
+    CAPTION_BACKEND=blip CAPTION_INFERENCE_THREADS=2 uvicorn asgi:app --port 5000
+"""
+
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from image_io import DEFAULT_MAX_UPLOAD_MB
+from loading import load_app
+from metrics import CONTENT_TYPE, METRICS
+
+BACKEND = os.environ.get('CAPTION_BACKEND', 'vgg16-lstm')
+# threads running inference on the shared model and the most requests allowed to wait for one
+INFERENCE_THREADS = int(os.environ.get('CAPTION_INFERENCE_THREADS', 1))
+MAX_PENDING = int(os.environ.get('CAPTION_MAX_PENDING', 64))
+INTRA_OP_THREADS = int(os.environ.get('CAPTION_INTRA_OP_THREADS', max(1, (os.cpu_count() or 1) // INFERENCE_THREADS)))
+MAX_UPLOAD_BYTES = int(float(os.environ.get('CAPTION_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024)
+# how often a waiting request checks whether its client went away
+DISCONNECT_POLL_SECONDS = 0.05
+
+
+class Overloaded(RuntimeError):
+    """Raised when the executor already has MAX_PENDING requests."""
+
+
+class ClientDisconnected(RuntimeError):
+    """Raised when the client went away before its caption was ready."""
+
+
+class UploadTooLarge(ValueError):
+    """Raised when a request body grows past MAX_UPLOAD_BYTES."""
+
+
+class InferenceExecutor:
+    def __init__(self, threads=1, max_pending=64):
+        """
+        Bounded executor that runs blocking inference off the event loop.
+
+        Args:
+            threads (int): Number of inference threads, all sharing the loaded model
+            max_pending (int): Maximum queued plus running requests
+        """
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='inference')
+        self.threads = threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cancelled = 0
+
+    async def run(self, request, fn, *args, **kwargs):
+        """
+        Run fn on the executor, cancelling it if the client disconnects first.
+
+        fn is called with an extra cancel keyword, a threading.Event that is
+        set on disconnect so inference already running can stop early.
+
+        Raises:
+            Overloaded: If max_pending requests are already queued or running
+            ClientDisconnected: If the client went away before the result was ready
+        """
+        if self.pending >= self.max_pending:
+            raise Overloaded(f"Too many pending requests ({self.max_pending})")
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        cancel = threading.Event()
+        future = self.pool.submit(fn, *args, cancel=cancel, **kwargs)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        result = asyncio.wrap_future(future)
+        watcher = asyncio.ensure_future(self._wait_disconnect(request))
+        done, _ = await asyncio.wait({result, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if result in done:
+            watcher.cancel()
+            return result.result()
+
+        # a queued request is dropped; a running one stops at its next decode step
+        cancel.set()
+        if future.cancel():
+            self.cancelled += 1
+        result.cancel()
+        raise ClientDisconnected("Client disconnected")
+
+    def _release(self):
+        self.pending -= 1
+
+    @staticmethod
+    async def _wait_disconnect(request):
+        while not await request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+    def stats(self):
+        return {'inference_threads': self.threads, 'pending': self.pending,
+                'max_pending': self.max_pending, 'cancelled': self.cancelled}
+
+
+backend = load_app(BACKEND, INTRA_OP_THREADS)
+executor = InferenceExecutor(INFERENCE_THREADS, MAX_PENDING)
+
+
+async def read_body(request, limit=MAX_UPLOAD_BYTES):
+    """
+    Read the whole request body, counting bytes as they arrive.
+
+    Chunked uploads carry no Content-Length, so the limit is enforced here
+    rather than trusted from the header.
+
+    Raises:
+        UploadTooLarge: As soon as more than limit bytes have been received
+    """
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise UploadTooLarge(f"File too large (limit {limit // (1024 * 1024)} MB)")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def parse_form(request, body):
+    """Parse a multipart form from a body that has already been read."""
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return await Request(request.scope, receive).form()
+
+
+def error_response(body, status_code):
+    METRICS.count('errors', BACKEND)
+    return JSONResponse(body, status_code=status_code)
+
+
+async def upload(request):
+    arrived = time.perf_counter()
+    # a declared size over the limit is rejected before reading anything
+    try:
+        declared = int(request.headers.get('content-length', 0))
+    except ValueError:
+        return error_response({'error': 'Invalid Content-Length header'}, 400)
+    if declared > MAX_UPLOAD_BYTES:
+        return error_response({'error': f"File too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"}, 413)
+    try:
+        body = await read_body(request)
+    except UploadTooLarge as e:
+        return error_response({'error': str(e)}, 413)
+    form = await parse_form(request, body)
+    file = form.get('file')
+    if file is None or not getattr(file, 'filename', ''):
+        return error_response({'error': 'No file part'}, 400)
+    options = {}
+    if hasattr(backend, 'parse_options'):
+        try:
+            options = backend.parse_options(form)
+        except ValueError as e:
+            return error_response({'error': str(e)}, 400)
+    data = await file.read()
+    METRICS.observe('request_read', BACKEND, time.perf_counter() - arrived)
+
+    def caption_within_budget(data, budget_ms=None, **options):
+        # the latency budget also covers the wait for an inference worker
+        if budget_ms is not None:
+            budget_ms -= (time.perf_counter() - arrived) * 1000.0
+        return backend.caption_upload(data, budget_ms=budget_ms, **options)
+
+    try:
+        caption, truncated = await executor.run(request, caption_within_budget, data, **options)
+    except Overloaded as e:
+        return error_response({'error': str(e)}, 503)
+    except ClientDisconnected as e:
+        # nobody is listening, but keep the status meaningful for access logs
+        return error_response({'error': str(e)}, 499)
+    except backend.ModelsNotReady as e:
+        return error_response({'error': str(e), 'status': backend.loader.status()}, 503)
+    except ValueError as e:
+        return error_response({'error': str(e)}, 400)
+    METRICS.observe('total', BACKEND, time.perf_counter() - arrived)
+    return JSONResponse({'caption': caption, 'truncated': truncated})
+
+
+async def ready(request):
+    status = backend.loader.status()
+    return JSONResponse(dict(status, executor=executor.stats()), status_code=200 if status['ready'] else 503)
+
+
+async def metrics(request):
+    # the same process-wide metrics the Flask apps serve at /metrics
+    return Response(METRICS.render(), media_type=CONTENT_TYPE)
+
+
+app = Starlette(routes=[
+    Route('/upload', upload, methods=['POST']),
+    Route('/ready', ready, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+])
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
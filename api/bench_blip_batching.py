@@ -0,0 +1,118 @@
+"""
+Load benchmark for BLIP continuous batching on CPU.
+
+Runs the same closed-loop load in-process twice: once with every client
+thread calling model.generate on its own image (what concurrent /upload
+requests do without batching), and once through the BatchScheduler with
+BlipStepDecoder, where concurrent requests share each decoder step.
+Reports requests/sec, generated tokens/sec, latency percentiles and how
+many captions match between the two modes.
+
+Usage:
+    python bench_blip_batching.py <images_dir> [requests] [concurrency] [max_batch_size]
+"""
+
+import os
+import sys
+import time
+import threading
+import numpy as np
+
+# measure the CPU path even on machines with a GPU
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import torch
+from PIL import Image
+from transformers import BlipProcessor, BlipForConditionalGeneration
+from blip_decoding import BlipStepDecoder
+from scheduler import BatchScheduler
+
+MODEL_PATH = os.path.abspath("models/blip-image-captioning-base")
+
+
+def run_load(caption_fn, inputs, total, concurrency):
+    """
+    Caption total inputs (cycling through them) from concurrency client threads.
+
+    Returns:
+        tuple: (results dict, captions by input index)
+    """
+    latencies, tokens, captions = [], [0], {}
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            ids = caption_fn(inputs[index % len(inputs)])
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                tokens[0] += len(ids)
+                captions[index % len(inputs)] = ids
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests_per_second': total / wall,
+        'tokens_per_second': tokens[0] / wall,
+        'p50': np.percentile(latencies, 50),
+        'p99': np.percentile(latencies, 99),
+    }, captions
+
+
+def main(images_dir, total=64, concurrency=8, max_batch_size=16):
+    processor = BlipProcessor.from_pretrained(MODEL_PATH)
+    model = BlipForConditionalGeneration.from_pretrained(MODEL_PATH).eval()
+    paths = sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    inputs = [processor(Image.open(path).convert('RGB'), return_tensors="pt")['pixel_values'] for path in paths]
+
+    def generate(pixel_values):
+        with torch.no_grad():
+            output = model.generate(pixel_values=pixel_values)[0].tolist()
+        # count generated tokens only, without BOS and trailing padding
+        return [token for token in output[1:] if token != model.config.text_config.pad_token_id]
+
+    decoder = BlipStepDecoder(model)
+    scheduler = BatchScheduler(decoder.encode, decoder, max_batch_size=max_batch_size)
+
+    def batched(pixel_values):
+        return scheduler.caption(pixel_values.numpy())
+
+    print("\n" + "="*60)
+    print(f"BLIP BATCHING: {total} requests, {concurrency} clients, "
+          f"{len(inputs)} images, {torch.get_num_threads()} threads")
+    print("="*60)
+    results = {}
+    for name, fn in (('generate', generate), ('batched', batched)):
+        # warm up so one-off allocation costs are not measured
+        run_load(fn, inputs, min(concurrency, total), concurrency)
+        result, results[name] = run_load(fn, inputs, total, concurrency)
+        print(f"{name:<10} {result['requests_per_second']:7.2f} req/s  {result['tokens_per_second']:8.1f} tok/s  "
+              f"p50 {result['p50']:8.1f} ms  p99 {result['p99']:8.1f} ms")
+
+    agree = sum(processor.decode(results['generate'][i], skip_special_tokens=True) ==
+                processor.decode(results['batched'][i], skip_special_tokens=True) for i in results['generate'])
+    metrics = scheduler.metrics()
+    print(f"\nCaption agreement: {agree}/{len(results['generate'])}")
+    print(f"Mean decode batch size: {metrics['decode_batch_size'].get('mean', 0):.2f}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1], *(int(arg) for arg in sys.argv[2:5]))
@@ -0,0 +1,124 @@
+"""
+Micro-benchmark for the caption decoding loop.
+
+Measures the pure Python overhead per caption of the old text-based
+predict_caption loop against CaptionDecoder. The caption model is replaced
+by a scripted stub that returns precomputed scores, so only tokenization,
+padding and id -> word lookup are timed.
+
+Usage:
+    python bench_decoding.py [tokenizer_path] [repeats]
+"""
+
+import sys
+import time
+import pickle
+import numpy as np
+from tensorflow.keras.preprocessing.sequence import pad_sequences
+from decoding import CaptionDecoder
+
+MAX_LENGTH = 35
+
+
+def idx_to_word(integer, tokenizer):
+    for word, index in tokenizer.word_index.items():
+        if index == integer:
+            return word
+    return None
+
+
+def legacy_predict_caption(model, image, tokenizer, max_length):
+    """The original re-tokenizing decode loop from api.py."""
+    in_text = 'startseq'
+    for i in range(max_length):
+        sequence = tokenizer.texts_to_sequences([in_text])[0]
+        sequence = pad_sequences([sequence], max_length, padding='post')
+        yhat = model.predict([image, sequence], verbose=0)
+        yhat = np.argmax(yhat)
+        word = idx_to_word(yhat, tokenizer)
+        if word is None:
+            break
+        in_text += " " + word
+        if word == 'endseq':
+            break
+    return in_text
+
+
+class ScriptedModel:
+    def __init__(self, token_ids, vocab_size):
+        """
+        Stand-in caption model that emits a fixed token sequence.
+
+        Args:
+            token_ids (list): Ids returned by successive predict calls
+            vocab_size (int): Width of the returned score vector
+        """
+        self.scores = np.zeros((len(token_ids), 1, vocab_size), dtype='float32')
+        for step, index in enumerate(token_ids):
+            self.scores[step, 0, index] = 1.0
+        self.step = 0
+
+    def reset(self):
+        self.step = 0
+
+    def predict(self, inputs, verbose=0):
+        scores = self.scores[min(self.step, len(self.scores) - 1)]
+        self.step += 1
+        return scores
+
+
+def pick_caption_ids(tokenizer, length):
+    """Pick a full-length caption from the least frequent words (worst case for the linear scan)."""
+    skip = {'startseq', 'endseq', tokenizer.oov_token}
+    words = [w for w in reversed(list(tokenizer.word_index)) if w not in skip]
+    ids = [tokenizer.word_index[w] for w in words[:length - 1]]
+    return ids + [tokenizer.word_index['endseq']]
+
+
+def time_captions(fn, model, repeats):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        model.reset()
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000, result
+
+
+def main(tokenizer_path='models/tokenizer.pkl', repeats=50):
+    with open(tokenizer_path, 'rb') as file:
+        tokenizer = pickle.load(file)
+
+    vocab_size = max(tokenizer.word_index.values()) + 1
+    caption_ids = pick_caption_ids(tokenizer, MAX_LENGTH)
+    model = ScriptedModel(caption_ids, vocab_size)
+    image = np.zeros((1, 4096), dtype='float32')
+
+    print("\n" + "="*60)
+    print("CAPTION DECODING OVERHEAD")
+    print("="*60)
+    print(f"Vocabulary size: {vocab_size}")
+    print(f"Caption length: {len(caption_ids)} tokens")
+    print(f"Repeats: {repeats}")
+
+    legacy_ms, legacy_text = time_captions(
+        lambda: legacy_predict_caption(model, image, tokenizer, MAX_LENGTH), model, repeats)
+
+    start = time.perf_counter()
+    decoder = CaptionDecoder(model, tokenizer, MAX_LENGTH)
+    build_ms = (time.perf_counter() - start) * 1000
+    new_ms, new_text = time_captions(lambda: decoder.predict_caption(image), model, repeats)
+
+    print(f"\nLegacy loop:    mean {legacy_ms.mean():8.3f} ms  p50 {np.median(legacy_ms):8.3f} ms  per caption")
+    print(f"CaptionDecoder: mean {new_ms.mean():8.3f} ms  p50 {np.median(new_ms):8.3f} ms  per caption")
+    print(f"Lookup table build (once at load): {build_ms:.3f} ms")
+    print(f"Speedup: {legacy_ms.mean() / new_ms.mean():.1f}x")
+    print(f"Outputs identical: {legacy_text == new_text}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    tokenizer_path = sys.argv[1] if len(sys.argv) > 1 else 'models/tokenizer.pkl'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    main(tokenizer_path, repeats)
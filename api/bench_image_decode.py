@@ -0,0 +1,106 @@
+"""
+Decode benchmark for large JPEGs: full decode vs reduced-scale DCT decode.
+
+Compares the loaders used before reduced-scale decoding (keras load_img,
+PIL decode without draft, cv2.imread in CNN_encoder/utils.py) with their
+reduced-scale counterparts, for the VGG16 (224x224) and BLIP (384x384)
+input sizes. Decode time is the mean over several runs; peak memory is
+the growth in peak RSS while decoding, measured in a fresh process per
+loader and image.
+
+Usage:
+    python bench_image_decode.py <image.jpg> [image.jpg ...]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import numpy as np
+
+CNN_ENCODER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'CNN_encoder')
+LOADERS = ('load_img', 'pil', 'pil-draft', 'cv2', 'cv2-reduced')
+SIZES = ((224, 224), (384, 384))
+RUNS = 5
+
+
+def make_loader(name, size):
+    """Return a function decoding an image path to the given (height, width)."""
+    if name == 'load_img':
+        from tensorflow.keras.preprocessing.image import load_img
+        return lambda path: load_img(path, target_size=size)
+    if name in ('pil', 'pil-draft'):
+        from image_io import decode_image
+        draft = name == 'pil-draft'
+        def load(path):
+            with open(path, 'rb') as f:
+                image = decode_image(f.read(), target_size=size, draft=draft)
+            image.load()
+            return image
+        return load
+    sys.path.insert(0, CNN_ENCODER_DIR)
+    from utils import preprocess_image
+    reduced = name == 'cv2-reduced'
+    return lambda path: preprocess_image(path, target_size=(size[1], size[0]), reduced=reduced)
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def measure(name, path, size):
+    load = make_loader(name, size)
+    before = rss_mb()
+    start = time.perf_counter()
+    load(path)
+    first = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - before
+
+    times = [first]
+    for _ in range(RUNS - 1):
+        start = time.perf_counter()
+        load(path)
+        times.append(time.perf_counter() - start)
+    return {'ms': float(np.mean(times)) * 1000, 'peak_mb': max(peak, 0.0)}
+
+
+def run_child(name, path, size):
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1')
+    output = subprocess.run([sys.executable, __file__, '--child', name, path, str(size[0]), str(size[1])],
+                            capture_output=True, text=True, env=env, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(paths):
+    from PIL import Image
+    print("\n" + "="*60)
+    print(f"IMAGE DECODE ({RUNS} runs per loader, fresh process each)")
+    print("="*60)
+    for path in paths:
+        with Image.open(path) as image:
+            width, height = image.size
+        print(f"\n{os.path.basename(path)} ({width}x{height}, {os.path.getsize(path) / 1e6:.1f} MB)")
+        for size in SIZES:
+            print(f"  -> {size[0]}x{size[1]}")
+            for name in LOADERS:
+                result = run_child(name, path, size)
+                print(f"    {name:<12} {result['ms']:8.1f} ms  peak +{result['peak_mb']:7.1f} MB")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 5 and sys.argv[1] == '--child':
+        size = (int(sys.argv[4]), int(sys.argv[5]))
+        print(json.dumps(measure(sys.argv[2], sys.argv[3], size)))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,145 @@
+"""
+CPU latency comparison for the caption inference paths.
+
+Reports:
+  - per-call overhead of model.predict against the compiled bucketed
+    functions for VGG16 and the caption model at batch size 1
+  - per-caption latency of the decoder modes (full-sequence and stateful,
+    each with predict and compiled execution), and whether their captions
+    agree with the original full-sequence predict path
+
+Usage:
+    python bench_inference.py [num_images] [calls]
+"""
+
+import os
+# benchmark the CPU path even on machines with a GPU
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+
+import sys
+import time
+import pickle
+import numpy as np
+from tensorflow.keras.applications.vgg16 import VGG16
+from tensorflow.keras.models import Model, load_model
+from decoding import CaptionDecoder, StatefulCaptionDecoder
+from compiled import compile_model
+
+MAX_LENGTH = 35
+MODEL_PATH = 'models/my_model.keras'
+TOKENIZER_PATH = 'models/tokenizer.pkl'
+FEATURES_PATH = 'models/features.pkl'
+
+
+def load_sample_features(num_images, feature_dim):
+    """Take features from features.pkl if available, otherwise random ones."""
+    if os.path.exists(FEATURES_PATH):
+        with open(FEATURES_PATH, 'rb') as file:
+            features = pickle.load(file)
+        return [np.asarray(f).reshape(1, -1) for f in list(features.values())[:num_images]]
+    rng = np.random.default_rng(42)
+    return [rng.random((1, feature_dim), dtype='float32') for _ in range(num_images)]
+
+
+def time_calls(fn, calls):
+    fn()
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000
+
+
+def time_decoder(decoder, images):
+    timings = []
+    captions = []
+    for image in images:
+        start = time.perf_counter()
+        captions.append(decoder.predict_caption(image))
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000, captions
+
+
+def report(name, timings, extra=""):
+    print(f"{name:<22} mean {timings.mean():8.2f} ms  p50 {np.median(timings):8.2f} ms  "
+          f"p95 {np.percentile(timings, 95):8.2f} ms  {extra}")
+
+
+def bench_calls(model, tokenizer, images, calls):
+    print("\nPer-call latency at batch size 1")
+    print("-"*60)
+
+    vgg = VGG16()
+    vgg = Model(inputs=vgg.inputs, outputs=vgg.layers[-2].output)
+    pixels = np.random.rand(1, 224, 224, 3).astype('float32')
+    compiled_vgg = compile_model(vgg, buckets=(1,))
+    compiled_vgg.warm_up()
+    predict_ms = time_calls(lambda: vgg.predict(pixels, verbose=0), calls)
+    compiled_ms = time_calls(lambda: compiled_vgg(pixels), calls)
+    report("vgg16 predict", predict_ms)
+    report("vgg16 compiled", compiled_ms,
+           f"overhead saved {predict_ms.mean() - compiled_ms.mean():.2f} ms/call")
+
+    sequence = np.zeros((1, MAX_LENGTH), dtype='int32')
+    sequence[0, 0] = tokenizer.word_index['startseq']
+    compiled_model = compile_model(model)
+    compiled_model.warm_up()
+    predict_ms = time_calls(lambda: model.predict([images[0], sequence], verbose=0), calls)
+    compiled_ms = time_calls(lambda: compiled_model(images[0], sequence), calls)
+    report("caption predict", predict_ms)
+    report("caption compiled", compiled_ms,
+           f"overhead saved {predict_ms.mean() - compiled_ms.mean():.2f} ms/call")
+    print(f"Retraces after warm-up: vgg16 {compiled_vgg.tracing_count() - len(compiled_vgg.buckets)}, "
+          f"caption {compiled_model.tracing_count() - len(compiled_model.buckets)}")
+
+
+def bench_decoders(model, tokenizer, images):
+    print("\nPer-caption latency")
+    print("-"*60)
+    decoders = [
+        ('full predict', CaptionDecoder(model, tokenizer, MAX_LENGTH)),
+        ('full compiled', CaptionDecoder(model, tokenizer, MAX_LENGTH).compile()),
+        ('stateful eager', StatefulCaptionDecoder(model, tokenizer, MAX_LENGTH)),
+        ('stateful compiled', StatefulCaptionDecoder(model, tokenizer, MAX_LENGTH).compile()),
+    ]
+
+    results = {}
+    for name, decoder in decoders:
+        # warm up so graph building is not counted
+        decoder.predict_caption(images[0])
+        timings, captions = time_decoder(decoder, images)
+        results[name] = (timings, captions)
+        tokens = sum(len(c.split()) - 1 for c in captions)
+        report(name, timings, f"{tokens / (timings.sum() / 1000):7.1f} tokens/s")
+
+    baseline_timings, baseline_captions = results['full predict']
+    print()
+    for name, (timings, captions) in results.items():
+        if name == 'full predict':
+            continue
+        agree = sum(a == b for a, b in zip(baseline_captions, captions))
+        print(f"{name} vs full predict: {baseline_timings.mean() / timings.mean():.1f}x faster, "
+              f"{agree}/{len(captions)} captions identical")
+
+
+def main(num_images=20, calls=100):
+    model = load_model(MODEL_PATH, compile=False)
+    with open(TOKENIZER_PATH, 'rb') as file:
+        tokenizer = pickle.load(file)
+    images = load_sample_features(num_images, model.inputs[0].shape[-1])
+
+    print("\n" + "="*60)
+    print("CAPTION INFERENCE LATENCY (CPU)")
+    print("="*60)
+    print(f"Images: {len(images)}, calls per measurement: {calls}")
+
+    bench_calls(model, tokenizer, images, calls)
+    bench_decoders(model, tokenizer, images)
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    num_images = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    main(num_images, calls)
@@ -0,0 +1,94 @@
+"""
+Closed-loop load test for the caption /upload endpoint.
+
+Runs the same load against each target and reports throughput and tail
+latency, e.g. to compare the Flask dev server with the ASGI mode. Every
+request uploads the same image, so start the servers with the caption
+cache disabled:
+
+    CAPTION_CACHE=0 python api.py                                   # Flask on :5000
+    CAPTION_CACHE=0 CAPTION_INFERENCE_THREADS=2 uvicorn asgi:app --port 5001  # ASGI on :5001
+    python bench_load.py image.jpg 200 8 flask=http://127.0.0.1:5000 asgi=http://127.0.0.1:5001
+
+Usage:
+    python bench_load.py <image> <requests> <concurrency> name=url [name=url ...]
+"""
+
+import sys
+import time
+import threading
+import requests
+import numpy as np
+
+
+def run_load(url, data, total, concurrency, form=None):
+    """
+    Send total uploads from concurrency client threads, each waiting for its previous reply.
+
+    Returns:
+        dict: Throughput, latency percentiles (ms) and error count
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                response = session.post(url + '/upload', files={'file': ('image.jpg', data)}, data=form or {})
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'throughput': (total - errors[0]) / wall,
+        'p50': np.percentile(latencies, 50),
+        'p95': np.percentile(latencies, 95),
+        'p99': np.percentile(latencies, 99),
+        'errors': errors[0],
+    }
+
+
+def main(image_path, total, concurrency, targets):
+    with open(image_path, 'rb') as f:
+        data = f.read()
+
+    print("\n" + "="*60)
+    print(f"LOAD TEST: {total} requests, {concurrency} concurrent clients")
+    print("="*60)
+    for name, url in targets:
+        # a few warm-up requests so first-call setup is not measured
+        run_load(url, data, min(concurrency, total), concurrency)
+        result = run_load(url, data, total, concurrency)
+        print(f"{name:<10} {result['throughput']:7.2f} req/s  p50 {result['p50']:8.1f} ms  "
+              f"p95 {result['p95']:8.1f} ms  p99 {result['p99']:8.1f} ms  errors {result['errors']}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print(__doc__)
+        sys.exit(1)
+    targets = [arg.split('=', 1) for arg in sys.argv[4:]]
+    main(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), targets)
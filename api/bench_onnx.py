@@ -0,0 +1,110 @@
+"""
+Native (TensorFlow / PyTorch) vs ONNX Runtime (CAPTION_RUNTIME=onnx) on CPU.
+
+Each backend is loaded once per runtime in a fresh CPU-only process. The
+report gives single-image latency through caption_upload (batch 1), batch
+throughput in images/sec captioning BATCH_SIZE images per call, RSS after
+loading, and how closely the ONNX Runtime captions agree with the native
+ones. Run export_onnx.py first.
+
+Usage:
+    python bench_onnx.py <images_dir> [backend ...]     backends: vgg16-lstm, blip
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+from loading import load_app
+from eval_quantized import IMAGE_EXTENSIONS, rss_mb, word_f1
+
+BACKENDS = ('vgg16-lstm', 'blip')
+BATCH_SIZE = 16
+ROUNDS = 3
+
+
+def caption_batch(app, backend, batch):
+    """Caption a list of upload bytes with one batched encoder call and one batched decode."""
+    if backend == 'vgg16-lstm':
+        features = app.encode_images(np.concatenate([app.load_image(data) for data in batch]))
+        return [len(caption) for caption in app.decoder.decode_batch(features)]
+    pixel_values = np.concatenate([app.preprocess(data).numpy() for data in batch])
+    if app.onnx_generator is not None:
+        return [len(ids) for ids, _ in app.onnx_generator.generate(pixel_values)]
+    import torch
+    with torch.no_grad():
+        return [len(ids) for ids in app.model.generate(pixel_values=torch.from_numpy(pixel_values).to(app.device))]
+
+
+def measure(backend, images_dir):
+    app = load_app(backend)
+    loaded_rss = rss_mb()
+    uploads = {}
+    for name in sorted(os.listdir(images_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(images_dir, name), 'rb') as f:
+                uploads[name] = f.read()
+
+    app.caption_upload(next(iter(uploads.values())))
+    captions, latencies = {}, []
+    for name, data in uploads.items():
+        start = time.perf_counter()
+        captions[name], _ = app.caption_upload(data)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # cycle the images up to a full batch so small directories still fill it
+    batch = [list(uploads.values())[i % len(uploads)] for i in range(BATCH_SIZE)]
+    caption_batch(app, backend, batch)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        caption_batch(app, backend, batch)
+    throughput = ROUNDS * BATCH_SIZE / (time.perf_counter() - start)
+
+    return {'captions': captions, 'latency_ms': latencies, 'images_per_sec': throughput, 'rss_mb': loaded_rss}
+
+
+def run_child(backend, images_dir, runtime):
+    # the cache would answer repeat images without running either model
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1', CAPTION_CACHE='0', CAPTION_BATCHING='0',
+               CAPTION_QUANTIZE='0', CAPTION_RUNTIME=runtime)
+    output = subprocess.run([sys.executable, __file__, '--child', backend, images_dir],
+                            capture_output=True, text=True, env=env, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(images_dir, backends=BACKENDS):
+    print("\n" + "="*60)
+    print(f"NATIVE vs ONNX RUNTIME (CPU, throughput at batch {BATCH_SIZE})")
+    print("="*60)
+    for backend in backends:
+        native = run_child(backend, images_dir, 'native')
+        onnx = run_child(backend, images_dir, 'onnx')
+        names = sorted(native['captions'])
+
+        print(f"\n{backend} ({len(names)} images)")
+        for label, result in (('native', native), ('onnx', onnx)):
+            latencies = np.array(result['latency_ms'])
+            print(f"  {label:<6}  latency p50 {np.percentile(latencies, 50):8.1f} ms  "
+                  f"p99 {np.percentile(latencies, 99):8.1f} ms  "
+                  f"throughput {result['images_per_sec']:7.2f} img/s  RSS {result['rss_mb']:7.0f} MB")
+
+        exact = sum(native['captions'][name] == onnx['captions'][name] for name in names)
+        f1 = np.mean([word_f1(native['captions'][name], onnx['captions'][name]) for name in names])
+        speedup = np.median(native['latency_ms']) / np.median(onnx['latency_ms'])
+        print(f"  exact agreement {exact}/{len(names)}  word F1 {f1:.3f}  latency speedup {speedup:.2f}x  "
+              f"throughput speedup {onnx['images_per_sec'] / native['images_per_sec']:.2f}x")
+        for name in [name for name in names if native['captions'][name] != onnx['captions'][name]][:5]:
+            print(f"    {name}\n      native: {native['captions'][name]}\n      onnx:   {onnx['captions'][name]}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == '--child':
+        print(json.dumps(measure(sys.argv[2], sys.argv[3])))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1], sys.argv[2:] or BACKENDS)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,111 @@
+"""
+Cold-start benchmark for the caption APIs.
+
+Each measurement runs in a fresh Python process and breaks startup down
+into library import, weight loading, graph compilation (VGG16+LSTM only)
+and the first inference, which is what a restarted worker pays before it
+can serve its first caption.
+
+Usage:
+    python bench_startup.py [runs] [backend ...]     backends: vgg16-lstm, blip
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+
+BACKENDS = ('vgg16-lstm', 'blip')
+
+
+def measure_vgg16_lstm():
+    phases = {}
+    start = time.perf_counter()
+    import pickle
+    import tensorflow as tf
+    from tensorflow.keras.applications.vgg16 import VGG16, preprocess_input
+    from tensorflow.keras.models import Model, load_model
+    from decoding import StatefulCaptionDecoder
+    from compiled import compile_model
+    phases['import'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vgg = VGG16()
+    vgg = Model(inputs=vgg.inputs, outputs=vgg.layers[-2].output)
+    phases['vgg16_weights'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = load_model('models/my_model.keras', compile=False)
+    with open('models/tokenizer.pkl', 'rb') as file:
+        tokenizer = pickle.load(file)
+    decoder = StatefulCaptionDecoder(model, tokenizer, 35)
+    phases['caption_weights'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encode_images = compile_model(vgg, buckets=(1, 2, 4, 8, 16))
+    encode_images.warm_up()
+    decoder.compile()
+    phases['compile'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    blank = preprocess_input(np.zeros((1, 224, 224, 3), dtype='float32'))
+    decoder.predict_caption(encode_images(blank))
+    phases['first_inference'] = time.perf_counter() - start
+    return phases
+
+
+def measure_blip():
+    phases = {}
+    start = time.perf_counter()
+    import torch
+    from PIL import Image
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    phases['import'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model_path = os.path.abspath("models/blip-image-captioning-base")
+    processor = BlipProcessor.from_pretrained(model_path)
+    model = BlipForConditionalGeneration.from_pretrained(model_path)
+    phases['weights'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    inputs = processor(Image.new('RGB', (384, 384)), return_tensors="pt")
+    with torch.no_grad():
+        model.generate(**inputs)
+    phases['first_inference'] = time.perf_counter() - start
+    return phases
+
+
+def run_child(backend):
+    """Measure one backend in a fresh interpreter and return its phase timings."""
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, __file__, '--child', backend],
+                            capture_output=True, text=True, env=env, check=True).stdout
+    phases = json.loads(output.strip().splitlines()[-1])
+    phases['process_total'] = time.perf_counter() - start
+    return phases
+
+
+def main(runs=3, backends=BACKENDS):
+    print("\n" + "="*60)
+    print("COLD-START BREAKDOWN (seconds, fresh process per run)")
+    print("="*60)
+    for backend in backends:
+        results = [run_child(backend) for _ in range(runs)]
+        print(f"\n{backend} ({runs} runs)")
+        for phase in results[0]:
+            values = np.array([r[phase] for r in results])
+            print(f"  {phase:<16} mean {values.mean():7.2f}  min {values.min():7.2f}  max {values.max():7.2f}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        measure = measure_vgg16_lstm if sys.argv[2] == 'vgg16-lstm' else measure_blip
+        print(json.dumps(measure()))
+    else:
+        runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+        main(runs, sys.argv[2:] or BACKENDS)
@@ -0,0 +1,265 @@
+import time
+import numpy as np
+import torch
+from deadlines import limit_reached
+
+
+class BlipStepDecoder:
+    def __init__(self, model, device='cpu', max_length=None):
+        """
+        Token-at-a-time greedy decoder for BLIP with a shared, growable KV cache.
+
+        Implements the start/greedy_step/concat interface used by
+        BatchScheduler, so captions from different requests share one
+        padded text-decoder call per step: finished rows are dropped from the
+        batch immediately and new rows join between steps. Rows that join
+        later get masked cache slots for the steps they missed and their own
+        position ids, so each row decodes exactly as it would alone.
+
+        Args:
+            model: BlipForConditionalGeneration
+            device (str): Torch device the model lives on
+            max_length (int): Maximum caption length in tokens including BOS;
+                defaults to the model's generation config (20)
+        """
+        self.model = model
+        self.device = device
+        text_config = model.config.text_config
+        self.bos_id = text_config.bos_token_id
+        self.eos_id = text_config.sep_token_id
+        self.max_length = max_length or getattr(model.generation_config, 'max_length', None) or 20
+        # called with (seconds, rows) after every step, for metrics
+        self.on_step = None
+
+    def encode(self, pixel_values):
+        """Run the vision tower on a batch of pixel values and return image embeddings as numpy."""
+        with torch.no_grad():
+            pixel_values = torch.as_tensor(pixel_values, device=self.device)
+            return self.model.vision_model(pixel_values=pixel_values)[0].cpu().numpy()
+
+    def start(self, images):
+        """Create decoding state for a batch of image embeddings; every row starts with BOS."""
+        embeds = torch.as_tensor(np.asarray(images), device=self.device)
+        batch_size = embeds.shape[0]
+        return {
+            'embeds': embeds,
+            'past': None,
+            'mask': torch.zeros((batch_size, 0), dtype=torch.long, device=self.device),
+            'positions': torch.zeros(batch_size, dtype=torch.long, device=self.device),
+            'next': torch.full((batch_size,), self.bos_id, dtype=torch.long, device=self.device),
+        }
+
+    @staticmethod
+    def _pad_past(past, batch_size, length):
+        """Left-pad cached keys/values with length masked slots."""
+        padded = []
+        for key, value in past:
+            pad = key.new_zeros((batch_size, key.shape[1], length, key.shape[3]))
+            padded.append((torch.cat([pad, key], dim=2), torch.cat([pad, value], dim=2)))
+        return padded
+
+    def concat(self, states):
+        """Merge decoding states, aligning cache lengths by left-padding with masked slots."""
+        length = max(state['mask'].shape[1] for state in states)
+        template = next((state['past'] for state in states if state['past'] is not None), None)
+        past, masks = [], []
+        for state in states:
+            batch_size, missing = state['mask'].shape[0], length - state['mask'].shape[1]
+            state_past = state['past']
+            if state_past is None and template is not None:
+                # rows that have not stepped yet have no cache at all
+                state_past = [(k.new_zeros((batch_size, k.shape[1], 0, k.shape[3])),) * 2 for k, _ in template]
+            if state_past is not None and missing:
+                state_past = self._pad_past(state_past, batch_size, missing)
+            past.append(state_past)
+            masks.append(torch.cat([state['mask'].new_zeros((batch_size, missing)), state['mask']], dim=1))
+
+        merged = {key: torch.cat([state[key] for state in states]) for key in ('embeds', 'positions', 'next')}
+        merged['mask'] = torch.cat(masks)
+        merged['past'] = None if template is None else [
+            (torch.cat([p[layer][0] for p in past]), torch.cat([p[layer][1] for p in past]))
+            for layer in range(len(template))
+        ]
+        return merged
+
+    @staticmethod
+    def select(state, indices):
+        """Keep only the given rows and drop cache slots no remaining row attends to."""
+        indices = torch.as_tensor(indices, dtype=torch.long, device=state['mask'].device)
+        selected = {key: state[key].index_select(0, indices) for key in ('embeds', 'mask', 'positions', 'next')}
+        past = state['past']
+        if past is not None:
+            past = [(k.index_select(0, indices), v.index_select(0, indices)) for k, v in past]
+
+        used = selected['mask'].any(dim=0).nonzero()
+        trim = int(used[0]) if len(used) else selected['mask'].shape[1]
+        if trim:
+            selected['mask'] = selected['mask'][:, trim:]
+            if past is not None:
+                past = [(k[:, :, trim:], v[:, :, trim:]) for k, v in past]
+        selected['past'] = past
+        return selected
+
+    def step(self, state):
+        """Feed each row's next token and return next-token logits of shape (batch, vocab)."""
+        batch_size = state['next'].shape[0]
+        mask = torch.cat([state['mask'], state['mask'].new_ones((batch_size, 1))], dim=1)
+        with torch.no_grad():
+            output = self.model.text_decoder(
+                input_ids=state['next'][:, None],
+                position_ids=state['positions'][:, None],
+                attention_mask=mask,
+                encoder_hidden_states=state['embeds'],
+                encoder_attention_mask=torch.ones(state['embeds'].shape[:2], dtype=torch.long, device=self.device),
+                past_key_values=state['past'],
+                use_cache=True,
+                return_dict=True,
+            )
+        past = output.past_key_values
+        if hasattr(past, 'to_legacy_cache'):
+            past = past.to_legacy_cache()
+        state['past'] = [(layer[0], layer[1]) for layer in past]
+        state['mask'] = mask
+        state['positions'] = state['positions'] + 1
+        return output.logits[:, -1, :]
+
+    def greedy_step(self, state, captions):
+        """
+        Advance every row by one greedy token.
+
+        Args:
+            state (dict): Decoding state with one row per caption
+            captions (list): Token id lists aligned with the state rows; new ids are appended
+
+        Returns:
+            tuple: (state, keep) where keep holds the indices of rows still decoding
+        """
+        start = time.perf_counter()
+        indices = self.step(state).argmax(dim=-1)
+        keep = []
+        for row, index in enumerate(indices.tolist()):
+            captions[row].append(index)
+            # BOS plus generated tokens may not exceed max_length, like generate()
+            if index == self.eos_id or len(captions[row]) + 1 >= self.max_length:
+                continue
+            keep.append(row)
+        if self.on_step is not None:
+            self.on_step(time.perf_counter() - start, len(indices))
+
+        state['next'] = indices
+        keep = np.array(keep, dtype='int64')
+        if len(keep) < len(indices):
+            state = self.select(state, keep)
+        return state, keep
+
+    def decode_batch(self, images):
+        """Generate token ids for a batch of image embeddings, dropping rows as they finish."""
+        captions = [[] for _ in range(len(images))]
+        active = np.arange(len(images))
+        state = self.start(images)
+        while len(active):
+            state, keep = self.greedy_step(state, [captions[row] for row in active])
+            active = active[keep]
+        return captions
+
+
+class TokenStreamer:
+    def __init__(self, on_token=None, on_step=None):
+        """
+        Minimal streamer for generate() that passes each new token id to on_token.
+
+        generate() calls put() once before the first decoder step and once
+        after every step, so the time between calls is one step.
+
+        Args:
+            on_token (callable): Called with every generated token id, in order
+            on_step (callable): Called with (seconds, tokens) after every decoder step
+        """
+        self.on_token = on_token
+        self.on_step = on_step
+        self.prompt = True
+        self.last = None
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.on_step is not None and self.last is not None:
+            self.on_step(now - self.last, value.numel())
+        self.last = now
+        # the first call carries the prompt (BOS), not generated tokens
+        if self.prompt:
+            self.prompt = False
+            return
+        if self.on_token is not None:
+            for token in value.reshape(-1).tolist():
+                self.on_token(token)
+
+    def end(self):
+        pass
+
+
+class OnnxBlipGenerator:
+    def __init__(self, vision_fn, decoder_fn, bos_id, eos_id, max_length=20):
+        """
+        Greedy BLIP captioning on the graphs written by export_onnx.py.
+
+        The exported text decoder has no KV cache, so every step re-runs the
+        (at most max_length tokens) prefix; captions leave the batch as soon
+        as they emit [SEP].
+
+        Args:
+            vision_fn (callable): pixel_values -> vision embeddings
+            decoder_fn (callable): (input_ids, attention_mask, embeddings) -> logits
+            bos_id (int): Token every caption starts with
+            eos_id (int): Token that ends a caption ([SEP])
+            max_length (int): Maximum caption length in tokens including BOS
+        """
+        self.vision_fn = vision_fn
+        self.decoder_fn = decoder_fn
+        self.bos_id = bos_id
+        self.eos_id = eos_id
+        self.max_length = max_length
+        # called with (seconds, rows) after every step, for metrics
+        self.on_step = None
+
+    def generate(self, pixel_values, deadline=None, max_tokens=None, on_token=None, cancel=None):
+        """
+        Caption a batch of preprocessed images.
+
+        Args:
+            pixel_values (np.ndarray): Batch of shape (batch, 3, height, width)
+            deadline (float): time.perf_counter() value after which decoding stops
+            max_tokens (int): Maximum number of generated tokens
+            on_token (callable): Called with each token id as it is generated (batch of one only)
+            cancel (threading.Event): Set to stop decoding; captions so far are returned as truncated
+
+        Returns:
+            list: (token ids without BOS, truncated) per image
+        """
+        embeddings = np.asarray(self.vision_fn(pixel_values))
+        batch_size = len(embeddings)
+        captions = [[] for _ in range(batch_size)]
+        truncated = [False] * batch_size
+        active = np.arange(batch_size)
+        ids = np.full((batch_size, 1), self.bos_id, dtype='int64')
+        while len(active):
+            start = time.perf_counter()
+            logits = self.decoder_fn(ids, np.ones_like(ids), embeddings)
+            tokens = np.argmax(logits[:, -1], axis=-1)
+            if self.on_step is not None:
+                self.on_step(time.perf_counter() - start, len(tokens))
+            keep = []
+            for row, token in enumerate(tokens.tolist()):
+                caption = captions[active[row]]
+                caption.append(token)
+                if on_token is not None and batch_size == 1:
+                    on_token(token)
+                if token == self.eos_id or len(caption) + 1 >= self.max_length:
+                    continue
+                if limit_reached(caption, deadline, max_tokens, cancel):
+                    truncated[active[row]] = True
+                    continue
+                keep.append(row)
+            ids = np.concatenate([ids, tokens[:, None].astype('int64')], axis=1)[keep]
+            embeddings = embeddings[keep]
+            active = active[keep]
+        return list(zip(captions, truncated))
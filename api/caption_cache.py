@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def model_identity(name, *paths):
+    """
+    Build a string identifying a model from its name and weight files.
+
+    File size and modification time are included, so replacing a weight file
+    changes the identity and old cache entries stop matching.
+
+    Args:
+        name (str): Human-readable model name
+        *paths (str): Files (or directories) the model is loaded from
+
+    Returns:
+        str: Identity string used as part of cache keys
+    """
+    parts = [name]
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path))
+        else:
+            files = [path]
+        for file in files:
+            if os.path.isfile(file):
+                stat = os.stat(file)
+                parts.append(f"{os.path.basename(file)}:{stat.st_size}:{int(stat.st_mtime)}")
+    return "|".join(parts)
+
+
+class CaptionCache:
+    def __init__(self, model_id, capacity=1024, directory=None):
+        """
+        Content-addressed caption cache with a memory LRU and an on-disk tier.
+
+        Keys are a SHA-256 of the uploaded bytes, the model identity and any
+        decoding options, so the same image captioned by a different model
+        or with different options is a different entry.
+
+        Args:
+            model_id (str): Identity of the model producing the captions (see model_identity)
+            capacity (int): Maximum number of entries kept in memory
+            directory (str): Directory for the persistent tier, or None for memory only
+        """
+        self.model_id = model_id
+        self.capacity = capacity
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'disk_writes': 0,
+            'disk_errors': 0,
+        }
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, data, **options):
+        """Return the cache key for uploaded bytes and decoding options."""
+        digest = hashlib.sha256()
+        digest.update(self.model_id.encode())
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        # two-level fan-out keeps directories small
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def get(self, key):
+        """Return the cached value for a key, or None on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self.entries[key]
+
+        if self.directory:
+            try:
+                with open(self._path(key), 'r') as f:
+                    value = json.load(f)
+                self._remember(key, value)
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                return value
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError):
+                with self.lock:
+                    self.counters['disk_errors'] += 1
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """Store a JSON-serializable value in memory and on disk."""
+        self._remember(key, value)
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.counters['disk_writes'] += 1
+        except OSError:
+            with self.lock:
+                self.counters['disk_errors'] += 1
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current sizes."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self.entries)
+        stats['capacity'] = self.capacity
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,89 @@
+import numpy as np
+import tensorflow as tf
+
+# batch sizes that get their own traced graph; other sizes are padded up to the next one
+DEFAULT_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+
+class CompiledFunction:
+    def __init__(self, fn, input_specs, buckets=DEFAULT_BUCKETS, name=None):
+        """
+        Retrace-free graph function with padded batch buckets.
+
+        One concrete function is traced per bucket with a fixed input
+        signature. Calls pad the batch up to the nearest bucket (or split it
+        into chunks of the largest one), so serving never triggers a retrace
+        and never goes through the per-call overhead of model.predict.
+
+        Args:
+            fn (callable): Function of batch-first tensors, e.g. lambda x: model(x, training=False)
+            input_specs (list): (shape_without_batch, dtype) per positional input
+            buckets (tuple): Batch sizes to trace
+            name (str): Name used in logs
+        """
+        self.name = name or getattr(fn, '__name__', 'function')
+        self.input_specs = [(tuple(shape), tf.as_dtype(dtype)) for shape, dtype in input_specs]
+        self.buckets = tuple(sorted(buckets))
+        self.function = tf.function(fn)
+        self.concrete = {}
+        for bucket in self.buckets:
+            signature = [tf.TensorSpec((bucket,) + shape, dtype) for shape, dtype in self.input_specs]
+            self.concrete[bucket] = self.function.get_concrete_function(*signature)
+
+    def tracing_count(self):
+        """Number of times the underlying tf.function has been traced."""
+        return self.function.experimental_get_tracing_count()
+
+    def bucket_for(self, batch_size):
+        for bucket in self.buckets:
+            if bucket >= batch_size:
+                return bucket
+        return self.buckets[-1]
+
+    def _run(self, inputs, batch_size):
+        bucket = self.bucket_for(batch_size)
+        padded = []
+        for value, (shape, dtype) in zip(inputs, self.input_specs):
+            buffer = np.zeros((bucket,) + shape, dtype=dtype.as_numpy_dtype)
+            buffer[:batch_size] = value
+            padded.append(tf.constant(buffer))
+        outputs = self.concrete[bucket](*padded)
+        return tf.nest.map_structure(lambda t: t.numpy()[:batch_size], outputs)
+
+    def __call__(self, *inputs):
+        batch_size = len(inputs[0])
+        largest = self.buckets[-1]
+        if batch_size <= largest:
+            return self._run(inputs, batch_size)
+
+        # split oversized batches into chunks of the largest bucket
+        chunks = []
+        for start in range(0, batch_size, largest):
+            chunk = [value[start:start + largest] for value in inputs]
+            chunks.append(self._run(chunk, len(chunk[0])))
+        return tf.nest.map_structure(lambda *parts: np.concatenate(parts), *chunks)
+
+    def warm_up(self):
+        """Run every bucket once so the first real request does not pay graph setup."""
+        for bucket in self.buckets:
+            self._run([np.zeros((bucket,) + shape, dtype=dtype.as_numpy_dtype)
+                       for shape, dtype in self.input_specs], bucket)
+
+
+def compile_model(model, buckets=DEFAULT_BUCKETS):
+    """
+    Compile a Keras model for inference with one concrete function per bucket.
+
+    Args:
+        model: Keras model with fully defined input shapes (apart from the batch)
+        buckets (tuple): Batch sizes to trace
+
+    Returns:
+        CompiledFunction: Callable taking one array per model input
+    """
+    specs = [(tensor.shape[1:], tensor.dtype) for tensor in model.inputs]
+    if len(specs) == 1:
+        fn = lambda x: model(x, training=False)
+    else:
+        fn = lambda *xs: model(list(xs), training=False)
+    return CompiledFunction(fn, specs, buckets, name=model.name)
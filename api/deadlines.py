@@ -0,0 +1,35 @@
+import time
+
+
+def parse_limits(form):
+    """
+    Read the optional per-request latency budget and caption length cap from form fields.
+
+    Returns:
+        dict: budget_ms (float or None) and max_tokens (int or None)
+
+    Raises:
+        ValueError: If a field is present but not a positive number
+    """
+    try:
+        budget_ms = float(form['budget_ms']) if form.get('budget_ms') else None
+        max_tokens = int(form['max_tokens']) if form.get('max_tokens') else None
+    except ValueError:
+        raise ValueError('budget_ms must be a number and max_tokens an integer')
+    if budget_ms is not None and budget_ms <= 0:
+        raise ValueError('budget_ms must be positive')
+    if max_tokens is not None and max_tokens < 1:
+        raise ValueError('max_tokens must be at least 1')
+    return {'budget_ms': budget_ms, 'max_tokens': max_tokens}
+
+
+def deadline_after(budget_ms):
+    """Absolute time.perf_counter() deadline for a budget starting now, or None."""
+    return None if budget_ms is None else time.perf_counter() + budget_ms / 1000.0
+
+
+def limit_reached(tokens, deadline=None, max_tokens=None, cancel=None):
+    """True once a caption has max_tokens tokens, its deadline has passed or its cancel event is set."""
+    return ((max_tokens is not None and len(tokens) >= max_tokens) or
+            (deadline is not None and time.perf_counter() >= deadline) or
+            (cancel is not None and cancel.is_set()))
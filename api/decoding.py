@@ -0,0 +1,531 @@
+import time
+import contextlib
+import numpy as np
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+from compiled import DEFAULT_BUCKETS, CompiledFunction, compile_model
+from quantized import QuantizedFunction, quantize_model
+from deadlines import limit_reached
+
+
+def build_index_to_word(tokenizer):
+    """
+    Build a dense id -> word lookup table from a fitted Keras tokenizer.
+
+    Args:
+        tokenizer: Fitted tensorflow.keras Tokenizer
+
+    Returns:
+        list: Table where table[index] is the word for that token id (None for unused ids)
+    """
+    table = [None] * (max(tokenizer.word_index.values(), default=0) + 1)
+    for word, index in tokenizer.word_index.items():
+        # keep the first word seen for an id, like the old linear scan did
+        if table[index] is None:
+            table[index] = word
+    return table
+
+
+class CaptionDecoder:
+    def __init__(self, model, tokenizer, max_length,
+                 start_token='startseq', end_token='endseq'):
+        """
+        Greedy caption decoder that works directly on token ids.
+
+        The lookup tables are built once here, so decoding a caption never
+        re-tokenizes text or scans the tokenizer vocabulary. Decoding state
+        is a dict of arrays with the batch on the first axis, so rows can be
+        reordered or dropped with select().
+
+        Args:
+            model: Caption model taking [image_feature, padded_sequence]
+            tokenizer: Fitted Keras tokenizer used to train the model
+            max_length (int): Padded sequence length the model was trained with
+            start_token (str): Word that starts every caption
+            end_token (str): Word that ends a caption
+        """
+        self.model = model
+        self.max_length = max_length
+        self.start_token = start_token
+        self.end_token = end_token
+        self.index_to_word = build_index_to_word(tokenizer)
+        self.start_id = tokenizer.word_index[start_token]
+        self.end_id = tokenizer.word_index.get(end_token)
+
+        # texts_to_sequences drops (or maps to OOV) ids outside num_words,
+        # so mirror that when feeding predicted ids back into the model
+        self.num_words = tokenizer.num_words
+        self.oov_id = tokenizer.word_index.get(tokenizer.oov_token) if tokenizer.oov_token else None
+
+        # model calls go through this so compile() can swap in graph functions
+        self.model_fn = lambda image, sequence: self.model.predict([image, sequence], verbose=0)
+        # called with (seconds, rows) after every greedy step, for metrics
+        self.on_step = None
+
+    def lookup(self, index):
+        """Return the word for a token id, or None if the id is unknown."""
+        if 0 <= index < len(self.index_to_word):
+            return self.index_to_word[index]
+        return None
+
+    def input_ids(self, indices):
+        """Map predicted ids to the ids fed back to the model (-1 means skip)."""
+        indices = np.asarray(indices, dtype='int32')
+        if self.num_words:
+            replacement = -1 if self.oov_id is None else self.oov_id
+            indices = np.where(indices >= self.num_words, replacement, indices)
+        return indices
+
+    def init_state(self, images):
+        """Allocate a zero-padded id buffer for a batch of image features."""
+        return {
+            'image': np.asarray(images),
+            'sequence': np.zeros((len(images), self.max_length), dtype='int32'),
+            'length': np.zeros(len(images), dtype='int32'),
+        }
+
+    def push(self, state, tokens):
+        """Append one token id per row in place instead of re-tokenizing the text."""
+        for row, token in enumerate(tokens):
+            if token < 0:
+                continue
+            length = state['length'][row]
+            if length == self.max_length:
+                # pad_sequences truncates from the front
+                state['sequence'][row, :-1] = state['sequence'][row, 1:]
+                length -= 1
+            state['sequence'][row, length] = token
+            state['length'][row] = length + 1
+        return state
+
+    def step(self, state):
+        """Run the caption model once and return next-token scores of shape (batch, vocab)."""
+        return np.asarray(self.model_fn(state['image'], state['sequence']))
+
+    def compile(self, buckets=DEFAULT_BUCKETS, warm_up=True):
+        """
+        Replace per-step model.predict calls with retrace-free compiled functions.
+
+        Args:
+            buckets (tuple): Batch sizes to trace; other sizes are padded up
+            warm_up (bool): Run every bucket once now instead of on the first request
+
+        Returns:
+            CaptionDecoder: self, for chaining
+        """
+        self.model_fn = compile_model(self.model, buckets)
+        if warm_up:
+            self.warm_up()
+        return self
+
+    def quantize(self, buckets=DEFAULT_BUCKETS, warm_up=True):
+        """
+        Like compile(), but run the caption model as int8 dynamic-range quantized TFLite.
+
+        Returns:
+            CaptionDecoder: self, for chaining
+        """
+        self.model_fn = quantize_model(self.model, buckets)
+        if warm_up:
+            self.warm_up()
+        return self
+
+    def use_onnx(self, directory, threads=0, warm_up=True):
+        """
+        Like compile(), but run the caption model exported by export_onnx.py with ONNX Runtime.
+
+        Returns:
+            CaptionDecoder: self, for chaining
+        """
+        from onnx_runtime import OnnxFunction, onnx_path
+        self.model_fn = OnnxFunction(onnx_path('caption_model', directory), threads)
+        if warm_up:
+            self.warm_up()
+        return self
+
+    def warm_up(self):
+        """Run every bucket of the compiled, quantized or ONNX model functions once."""
+        if hasattr(self.model_fn, 'warm_up'):
+            self.model_fn.warm_up()
+
+    @staticmethod
+    def select(state, indices):
+        """Return the state restricted to (or reordered by) the given rows."""
+        return {key: value[indices] for key, value in state.items()}
+
+    def start(self, images):
+        """Create decoding state for a batch of image features, primed with the start token."""
+        state = self.init_state(images)
+        return self.push(state, np.full(len(images), self.start_id, dtype='int32'))
+
+    @staticmethod
+    def concat(states):
+        """Stack several decoding states into one batch."""
+        return {key: np.concatenate([state[key] for state in states]) for key in states[0]}
+
+    def greedy_step(self, state, captions):
+        """
+        Advance every row of a batch by one greedy token.
+
+        Args:
+            state (dict): Decoding state with one row per caption
+            captions (list): Word lists aligned with the state rows; new words are appended
+
+        Returns:
+            tuple: (state, keep) where keep holds the indices of rows still decoding;
+                the returned state only contains those rows
+        """
+        start = time.perf_counter()
+        # predict next word for every caption in one call
+        indices = np.argmax(self.step(state), axis=1)
+        keep = []
+        for row, index in enumerate(indices):
+            word = self.lookup(int(index))
+            # stop if word not found
+            if word is None:
+                continue
+            captions[row].append(word)
+            # stop if we reach end tag or the length limit
+            if word == self.end_token or len(captions[row]) >= self.max_length:
+                continue
+            keep.append(row)
+
+        keep = np.array(keep, dtype='int64')
+        if len(keep) < len(indices):
+            state = self.select(state, keep)
+        if len(keep):
+            state = self.push(state, self.input_ids(indices[keep]))
+        if self.on_step is not None:
+            self.on_step(time.perf_counter() - start, len(indices))
+        return state, keep
+
+    def decode_batch(self, images):
+        """
+        Generate captions for a batch of image features with greedy argmax.
+
+        Finished captions are dropped from the batch, so later steps only run
+        the rows that are still decoding.
+
+        Args:
+            images (np.ndarray): Image features of shape (batch, feature_dim)
+
+        Returns:
+            list: One word list per image, ending with the end token if it was produced
+        """
+        captions = [[] for _ in range(len(images))]
+        active = np.arange(len(images))
+        state = self.start(images)
+        while len(active):
+            state, keep = self.greedy_step(state, [captions[row] for row in active])
+            active = active[keep]
+        return captions
+
+    def stream(self, image):
+        """
+        Greedy-decode one image feature, yielding each word as soon as it is decoded.
+
+        Args:
+            image (np.ndarray): Image feature of shape (1, feature_dim)
+
+        Yields:
+            str: Generated words, ending with the end token if it was produced
+        """
+        words = []
+        state = self.start(image)
+        keep = [0]
+        while len(keep):
+            count = len(words)
+            state, keep = self.greedy_step(state, [words])
+            # an unknown word ends the caption without being appended
+            if len(words) > count:
+                yield words[-1]
+
+    def decode_within(self, image, deadline=None, max_tokens=None, cancel=None):
+        """
+        Greedy-decode one image feature, stopping early at a deadline, length cap or cancellation.
+
+        Args:
+            image (np.ndarray): Image feature of shape (1, feature_dim)
+            deadline (float): time.perf_counter() value after which decoding stops
+            max_tokens (int): Maximum number of words
+            cancel (threading.Event): Set to stop decoding, e.g. when the client went away
+
+        Returns:
+            tuple: (words, truncated); truncated captions have no end token
+        """
+        words = []
+        for word in self.stream(image):
+            words.append(word)
+            if word != self.end_token and limit_reached(words, deadline, max_tokens, cancel):
+                return words, True
+        return words, False
+
+    def decode(self, image):
+        """
+        Generate a caption for one image feature with greedy argmax.
+
+        Args:
+            image (np.ndarray): Image feature of shape (1, feature_dim)
+
+        Returns:
+            list: Generated words, ending with the end token if it was produced
+        """
+        return self.decode_batch(image)[0]
+
+    def valid_mask(self, vocab_size):
+        """Boolean mask over model outputs that map to a known word."""
+        mask = getattr(self, '_valid_mask', None)
+        if mask is None or len(mask) != vocab_size:
+            mask = np.zeros(vocab_size, dtype=bool)
+            limit = min(vocab_size, len(self.index_to_word))
+            mask[:limit] = [word is not None for word in self.index_to_word[:limit]]
+            self._valid_mask = mask
+        return mask
+
+    def beam_search(self, image, beam_width=3, length_penalty=1.0, early_stopping=True, cancel=None, lock=None):
+        """
+        Generate a caption for one image feature with beam search.
+
+        All live beams go through the model as one batch per step, and the
+        next beams are picked with a vectorized top-k over the beam x vocab
+        score matrix.
+
+        Args:
+            image (np.ndarray): Image feature of shape (1, feature_dim)
+            beam_width (int): Number of hypotheses kept at each step
+            length_penalty (float): Exponent on caption length used to normalize
+                log-probabilities; > 1 favours longer captions, < 1 shorter ones
+            early_stopping (bool): Stop as soon as beam_width captions have ended;
+                otherwise stop once no live beam can beat the finished ones
+            cancel (threading.Event): Set to stop searching; the best caption so far is returned
+            lock (threading.Lock): Held around each model call, for sharing the model with other threads
+
+        Returns:
+            list: Words of the best caption, ending with the end token if it was produced
+        """
+        lock = lock or contextlib.nullcontext()
+        with lock:
+            state = self.start(image)
+        beam_scores = np.zeros(1, dtype='float64')
+        beam_words = [[]]
+        finished = []
+
+        def normalized(score, length):
+            return score / (length ** length_penalty)
+
+        for _ in range(self.max_length):
+            if cancel is not None and cancel.is_set():
+                break
+            # one forward pass for every live beam
+            with lock:
+                start = time.perf_counter()
+                scores = self.step(state)
+            if self.on_step is not None:
+                self.on_step(time.perf_counter() - start, len(scores))
+            vocab_size = scores.shape[1]
+            log_probs = np.log(np.maximum(scores, 1e-12))
+            log_probs[:, ~self.valid_mask(vocab_size)] = -np.inf
+            total = (beam_scores[:, None] + log_probs).ravel()
+
+            # take 2 * beam_width so enough beams survive after some of them end
+            k = min(2 * beam_width, total.size)
+            top = np.argpartition(-total, k - 1)[:k]
+            top = top[np.argsort(-total[top])]
+            rows, indices = np.divmod(top, vocab_size)
+
+            next_rows, next_ids, next_scores, next_words = [], [], [], []
+            for row, index, score in zip(rows, indices, total[top]):
+                if not np.isfinite(score):
+                    break
+                words = beam_words[row] + [self.index_to_word[index]]
+                if index == self.end_id:
+                    finished.append((normalized(score, len(words)), words))
+                else:
+                    next_rows.append(row)
+                    next_ids.append(index)
+                    next_scores.append(score)
+                    next_words.append(words)
+                if len(next_rows) == beam_width:
+                    break
+
+            finished = sorted(finished, key=lambda item: item[0], reverse=True)[:beam_width]
+            if not next_rows:
+                break
+            if len(finished) == beam_width:
+                if early_stopping:
+                    break
+                best_live = normalized(max(next_scores), len(next_words[0]))
+                if finished[-1][0] >= best_live:
+                    break
+
+            # reorder state to follow the surviving beams, then feed their new tokens
+            state = self.select(state, np.array(next_rows))
+            with lock:
+                state = self.push(state, self.input_ids(next_ids))
+            beam_scores = np.array(next_scores, dtype='float64')
+            beam_words = next_words
+        else:
+            # ran out of steps: unfinished beams compete with the finished ones
+            finished += [(normalized(score, len(words)), words)
+                         for score, words in zip(beam_scores, beam_words) if words]
+
+        if not finished:
+            return []
+        return max(finished, key=lambda item: item[0])[1]
+
+    def predict_caption(self, image, beam_width=1, **beam_options):
+        """Return the caption text in the legacy 'startseq ... endseq' format."""
+        if beam_width > 1:
+            words = self.beam_search(image, beam_width, **beam_options)
+        else:
+            words = self.decode(image)
+        return " ".join([self.start_token] + words)
+
+
+def split_caption_model(model):
+    """
+    Split a merge-style captioning model into its inference parts.
+
+    Expects the Flickr8k layout used for my_model.keras: image feature ->
+    Dense, tokens -> Embedding -> LSTM, both branches merged and passed
+    through a Dense head. Dropout layers are identities at inference and
+    are skipped.
+
+    Args:
+        model: Loaded Keras caption model
+
+    Returns:
+        tuple: (image_model, embedding, lstm_cell, merge, head_layers)
+    """
+    embedding = next((l for l in model.layers if isinstance(l, layers.Embedding)), None)
+    lstm = next((l for l in model.layers if isinstance(l, layers.LSTM)), None)
+    merge = next((l for l in model.layers if isinstance(l, (layers.Add, layers.Concatenate))), None)
+    if embedding is None or lstm is None or merge is None:
+        raise ValueError("Caption model needs Embedding, LSTM and Add/Concatenate layers")
+
+    # the branch of the merge that does not come from the LSTM is the image conditioning
+    image_branch = [t for t in merge.input if t is not lstm.output]
+    if len(image_branch) != 1:
+        raise ValueError("Could not separate the image branch from the LSTM branch")
+    image_inputs = [t for t in model.inputs if t is not embedding.input]
+    if len(image_inputs) != 1:
+        raise ValueError("Caption model must take exactly one image input and one token input")
+    image_model = Model(inputs=image_inputs[0], outputs=image_branch[0])
+
+    head_layers = model.layers[model.layers.index(merge) + 1:]
+    return image_model, embedding, lstm.cell, merge, head_layers
+
+
+class StatefulCaptionDecoder(CaptionDecoder):
+    def __init__(self, model, tokenizer, max_length, verify=True, **kwargs):
+        """
+        Caption decoder that carries LSTM hidden and cell state between steps.
+
+        The image branch runs once per caption and each step feeds only the
+        newest token through the embedding and a single LSTM cell update, so
+        a caption costs O(L) LSTM work instead of one full padded pass per
+        step. Produces the same greedy captions as CaptionDecoder.
+
+        Args:
+            model: Loaded Keras caption model (see split_caption_model)
+            tokenizer: Fitted Keras tokenizer used to train the model
+            max_length (int): Maximum number of decode steps
+            verify (bool): Check the split model against the full one now; when False, call verify() later
+
+        Raises:
+            ValueError: If the model cannot be split, or verify finds it does not match
+        """
+        super().__init__(model, tokenizer, max_length, **kwargs)
+        (self.image_model, self.embedding, self.cell,
+         self.merge, self.head_layers) = split_caption_model(model)
+        self.units = self.cell.units
+
+        self.image_fn = lambda images: self.image_model(images, training=False)
+        self.update_fn = self.update
+        self.head_fn = self.head
+        if verify:
+            self.verify()
+
+    def update(self, tokens, h, c):
+        """Embed one token per row and run a single LSTM cell step."""
+        embedded = self.embedding(tokens, training=False)
+        _, (h, c) = self.cell(embedded, [h, c], training=False)
+        return h, c
+
+    def head(self, context, h):
+        """Merge image context with the LSTM output and score the next token."""
+        x = self.merge([context, h])
+        for layer in self.head_layers:
+            x = layer(x, training=False)
+        return x
+
+    def compile(self, buckets=DEFAULT_BUCKETS, warm_up=True, function=CompiledFunction, model_function=compile_model):
+        context_dim = self.image_model.output_shape[-1]
+        self.image_fn = model_function(self.image_model, buckets)
+        self.update_fn = function(
+            self.update, [((), 'int32'), ((self.units,), 'float32'), ((self.units,), 'float32')],
+            buckets, name='lstm_update')
+        self.head_fn = function(
+            self.head, [((context_dim,), 'float32'), ((self.units,), 'float32')],
+            buckets, name='caption_head')
+        if warm_up:
+            self.warm_up()
+        return self
+
+    def quantize(self, buckets=DEFAULT_BUCKETS, warm_up=True):
+        # image branch, LSTM cell and head all become int8 dynamic-range TFLite graphs
+        return self.compile(buckets, warm_up, function=QuantizedFunction, model_function=quantize_model)
+
+    def use_onnx(self, directory, threads=0, warm_up=True):
+        # image branch, LSTM cell and head exported as separate graphs
+        from onnx_runtime import OnnxFunction, onnx_path
+        self.image_fn = OnnxFunction(onnx_path('caption_image', directory), threads)
+        self.update_fn = OnnxFunction(onnx_path('caption_update', directory), threads)
+        self.head_fn = OnnxFunction(onnx_path('caption_head', directory), threads)
+        if warm_up:
+            self.warm_up()
+        return self
+
+    def warm_up(self):
+        for fn in (self.image_fn, self.update_fn, self.head_fn):
+            if hasattr(fn, 'warm_up'):
+                fn.warm_up()
+
+    def init_state(self, images):
+        batch_size = len(images)
+        context = self.image_fn(np.asarray(images))
+        return {
+            'context': np.asarray(context),
+            'h': np.zeros((batch_size, self.units), dtype='float32'),
+            'c': np.zeros((batch_size, self.units), dtype='float32'),
+        }
+
+    def push(self, state, tokens):
+        tokens = np.asarray(tokens, dtype='int32')
+        skip = tokens < 0
+        h, c = self.update_fn(np.maximum(tokens, 0), state['h'], state['c'])
+        # rows whose token is dropped keep their previous state, like a masked timestep
+        state['h'] = np.where(skip[:, None], state['h'], np.asarray(h))
+        state['c'] = np.where(skip[:, None], state['c'], np.asarray(c))
+        return state
+
+    def step(self, state):
+        return np.asarray(self.head_fn(state['context'], state['h']))
+
+    def verify(self, num_tokens=5, atol=1e-4):
+        """Check the split model against the full model on a random probe caption."""
+        feature_dim = self.image_model.input_shape[-1]
+        image = np.random.rand(1, feature_dim).astype('float32')
+        tokens = np.random.randint(1, len(self.index_to_word), size=num_tokens)
+
+        full = CaptionDecoder.init_state(self, image)
+        full = CaptionDecoder.push(self, full, [self.start_id])
+        stateful = self.start(image)
+        for token in tokens:
+            full = CaptionDecoder.push(self, full, [token])
+            stateful = self.push(stateful, [token])
+
+        expected = CaptionDecoder.step(self, full)
+        actual = self.step(stateful)
+        if not np.allclose(expected, actual, atol=atol):
+            raise ValueError("Stateful decoder does not match the full caption model")
@@ -0,0 +1,67 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class EmbeddingCache:
+    def __init__(self, ttl_seconds=300.0, capacity=32):
+        """
+        Short-lived in-memory cache of per-image encoder outputs.
+
+        Keys are a SHA-256 of the uploaded bytes. Entries expire ttl_seconds
+        after they were stored, and the least recently used entry is evicted
+        beyond capacity, so a client asking several questions about one image
+        pays for the vision encoder once without embeddings piling up.
+
+        Args:
+            ttl_seconds (float): Lifetime of an entry
+            capacity (int): Maximum number of entries
+        """
+        self.ttl = ttl_seconds
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(data):
+        """Return the cache key for uploaded bytes."""
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for a key, or None if it is missing or expired."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                self.counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Store a value until the TTL runs out."""
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        """Return hit/miss/expiry/eviction counters and the current size."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        stats['capacity'] = self.capacity
+        stats['ttl_seconds'] = self.ttl
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,116 @@
+"""
+Evaluate the int8 quantized CPU mode (CAPTION_QUANTIZE=1) against fp32.
+
+Each backend is loaded twice, fp32 and int8, in a fresh CPU-only process
+so resident memory is measured in isolation. Every image in the directory
+is captioned once. The report gives per-image latency, RSS after loading,
+peak RSS, and how closely the int8 captions agree with the fp32 ones:
+exact matches, plus mean word-overlap F1 for the rest.
+
+Usage:
+    python eval_quantized.py <images_dir> [backend ...]     backends: vgg16-lstm, blip
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+from collections import Counter
+import numpy as np
+from loading import load_app
+
+BACKENDS = ('vgg16-lstm', 'blip')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def rss_mb():
+    """Current resident set size of this process in MB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def measure(backend, images_dir):
+    """Load one backend with the current CAPTION_QUANTIZE setting and caption every image."""
+    start = time.perf_counter()
+    app = load_app(backend)
+    load_seconds = time.perf_counter() - start
+    loaded_rss = rss_mb()
+
+    captions, latencies = {}, []
+    for name in sorted(os.listdir(images_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(images_dir, name), 'rb') as f:
+            data = f.read()
+        start = time.perf_counter()
+        captions[name], _ = app.caption_upload(data)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'captions': captions,
+        'latency_ms': latencies,
+        'load_seconds': load_seconds,
+        'rss_mb': loaded_rss,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def run_child(backend, images_dir, quantize):
+    # the cache would answer repeat images without running either model
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1', CAPTION_CACHE='0',
+               CAPTION_QUANTIZE='1' if quantize else '0')
+    output = subprocess.run([sys.executable, __file__, '--child', backend, images_dir],
+                            capture_output=True, text=True, env=env, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def word_f1(reference, candidate):
+    """Word-overlap F1 between two captions."""
+    reference, candidate = reference.split(), candidate.split()
+    overlap = sum((Counter(reference) & Counter(candidate)).values())
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / len(candidate), overlap / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+
+def main(images_dir, backends=BACKENDS):
+    print("\n" + "="*60)
+    print("INT8 QUANTIZED vs FP32 (CPU)")
+    print("="*60)
+    for backend in backends:
+        fp32 = run_child(backend, images_dir, quantize=False)
+        int8 = run_child(backend, images_dir, quantize=True)
+        names = sorted(fp32['captions'])
+
+        print(f"\n{backend} ({len(names)} images)")
+        for label, result in (('fp32', fp32), ('int8', int8)):
+            latencies = np.array(result['latency_ms'])
+            print(f"  {label}  latency mean {latencies.mean():8.1f} ms  p50 {np.percentile(latencies, 50):8.1f} ms  "
+                  f"load {result['load_seconds']:6.1f} s  RSS {result['rss_mb']:7.0f} MB  "
+                  f"peak {result['peak_rss_mb']:7.0f} MB")
+
+        exact = sum(fp32['captions'][name] == int8['captions'][name] for name in names)
+        f1 = np.mean([word_f1(fp32['captions'][name], int8['captions'][name]) for name in names])
+        speedup = np.mean(fp32['latency_ms']) / np.mean(int8['latency_ms'])
+        print(f"  exact agreement {exact}/{len(names)}  word F1 {f1:.3f}  "
+              f"speedup {speedup:.2f}x  RSS saved {fp32['rss_mb'] - int8['rss_mb']:.0f} MB")
+        for name in [name for name in names if fp32['captions'][name] != int8['captions'][name]][:5]:
+            print(f"    {name}\n      fp32: {fp32['captions'][name]}\n      int8: {int8['captions'][name]}")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == '--child':
+        print(json.dumps(measure(sys.argv[2], sys.argv[3])))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1], sys.argv[2:] or BACKENDS)
+    else:
+        print(__doc__)
+        sys.exit(1)
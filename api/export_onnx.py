@@ -0,0 +1,228 @@
+"""
+Export the caption models to ONNX for CAPTION_RUNTIME=onnx.
+
+Writes into CAPTION_ONNX_DIR (models/onnx by default):
+  vgg16-lstm  vgg16.onnx          VGG16 up to fc2, the 4096-d image feature
+              caption_model.onnx  my_model.keras, used by the full-sequence decoder
+              caption_image.onnx, caption_update.onnx, caption_head.onnx
+                                  image branch, one LSTM cell step and the
+                                  output head, used by the stateful decoder
+  blip        blip_vision.onnx    vision encoder, pixel_values -> embeddings
+              blip_text_decoder.onnx
+                                  text decoder without a KV cache,
+                                  (input_ids, attention_mask, embeddings) -> logits
+
+Batch (and for the BLIP decoder, sequence) dimensions are dynamic. After
+exporting, every graph is run with ONNX Runtime on random inputs and
+compared with the TensorFlow / PyTorch model it came from; the script
+exits with status 1 if any output differs by more than the tolerance.
+
+Usage:
+    python export_onnx.py [backend ...]          backends: vgg16-lstm, blip
+    python export_onnx.py --check [backend ...]  only run the parity check
+"""
+
+import os
+# export and compare on the CPU, which is where ONNX Runtime runs
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+
+import sys
+import pickle
+import numpy as np
+from onnx_runtime import ONNX_DIR, OnnxFunction, onnx_path
+
+BACKENDS = ('vgg16-lstm', 'blip')
+MAX_LENGTH = 35
+CAPTION_MODEL_PATH = 'models/my_model.keras'
+TOKENIZER_PATH = 'models/tokenizer.pkl'
+BLIP_MODEL_PATH = os.path.abspath('models/blip-image-captioning-base')
+OPSET = 14
+PARITY_BATCH = 2
+# fp32 graphs with fused kernels, so outputs agree closely but not bit for bit
+RTOL, ATOL = 1e-3, 1e-4
+
+
+def load_vgg16_lstm():
+    from tensorflow.keras.applications.vgg16 import VGG16
+    from tensorflow.keras.models import Model, load_model
+    from decoding import StatefulCaptionDecoder
+
+    vgg = VGG16()
+    vgg = Model(inputs=vgg.inputs, outputs=vgg.layers[-2].output)
+    model = load_model(CAPTION_MODEL_PATH, compile=False)
+    with open(TOKENIZER_PATH, 'rb') as file:
+        tokenizer = pickle.load(file)
+    return vgg, model, StatefulCaptionDecoder(model, tokenizer, MAX_LENGTH)
+
+
+def export_vgg16_lstm(directory):
+    import tensorflow as tf
+    import tf2onnx
+
+    vgg, model, decoder = load_vgg16_lstm()
+    context_dim = decoder.image_model.output_shape[-1]
+    tf2onnx.convert.from_keras(
+        vgg, input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.float32, name='image')],
+        opset=OPSET, output_path=onnx_path('vgg16', directory))
+    tf2onnx.convert.from_keras(model, opset=OPSET, output_path=onnx_path('caption_model', directory))
+    tf2onnx.convert.from_keras(decoder.image_model, opset=OPSET,
+                               output_path=onnx_path('caption_image', directory))
+    # input order matches the positional calls in StatefulCaptionDecoder.push/step
+    tf2onnx.convert.from_function(
+        tf.function(decoder.update),
+        input_signature=[tf.TensorSpec((None,), tf.int32, name='tokens'),
+                         tf.TensorSpec((None, decoder.units), tf.float32, name='h'),
+                         tf.TensorSpec((None, decoder.units), tf.float32, name='c')],
+        opset=OPSET, output_path=onnx_path('caption_update', directory))
+    tf2onnx.convert.from_function(
+        tf.function(decoder.head),
+        input_signature=[tf.TensorSpec((None, context_dim), tf.float32, name='context'),
+                         tf.TensorSpec((None, decoder.units), tf.float32, name='h')],
+        opset=OPSET, output_path=onnx_path('caption_head', directory))
+
+
+def check_vgg16_lstm(directory):
+    vgg, model, decoder = load_vgg16_lstm()
+    rng = np.random.default_rng(0)
+    feature_dim = decoder.image_model.input_shape[-1]
+    context_dim = decoder.image_model.output_shape[-1]
+    vocab_size = len(decoder.index_to_word)
+
+    images = rng.uniform(-120, 150, (PARITY_BATCH, 224, 224, 3)).astype('float32')
+    features = rng.random((PARITY_BATCH, feature_dim), dtype='float32')
+    sequences = rng.integers(0, vocab_size, (PARITY_BATCH, MAX_LENGTH)).astype('float32')
+    tokens = rng.integers(1, vocab_size, PARITY_BATCH).astype('int32')
+    h = rng.standard_normal((PARITY_BATCH, decoder.units), dtype='float32')
+    c = rng.standard_normal((PARITY_BATCH, decoder.units), dtype='float32')
+    context = rng.standard_normal((PARITY_BATCH, context_dim), dtype='float32')
+
+    return [
+        ('vgg16', vgg(images, training=False), (images,)),
+        ('caption_model', model([features, sequences], training=False), (features, sequences)),
+        ('caption_image', decoder.image_model(features, training=False), (features,)),
+        ('caption_update', decoder.update(tokens, h, c), (tokens, h, c)),
+        ('caption_head', decoder.head(context, h), (context, h)),
+    ]
+
+
+def blip_modules(model):
+    """Wrap the BLIP vision encoder and text decoder as the modules that get exported."""
+    import torch
+
+    class Vision(torch.nn.Module):
+        def __init__(self, vision_model):
+            super().__init__()
+            self.vision_model = vision_model
+
+        def forward(self, pixel_values):
+            return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+    class TextDecoder(torch.nn.Module):
+        def __init__(self, text_decoder):
+            super().__init__()
+            self.text_decoder = text_decoder
+
+        def forward(self, input_ids, attention_mask, encoder_hidden_states):
+            # no past_key_values in or out: every call runs the whole prefix
+            return self.text_decoder(input_ids=input_ids, attention_mask=attention_mask,
+                                     encoder_hidden_states=encoder_hidden_states,
+                                     use_cache=False, return_dict=False)[0]
+
+    return Vision(model.vision_model).eval(), TextDecoder(model.text_decoder).eval()
+
+
+def load_blip():
+    from transformers import BlipForConditionalGeneration
+    model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_PATH).eval()
+    vision, text_decoder = blip_modules(model)
+    return model, vision, text_decoder, model.config.vision_config.image_size
+
+
+def export_blip(directory):
+    import torch
+
+    model, vision, text_decoder, size = load_blip()
+    pixel_values = torch.zeros((1, 3, size, size))
+    with torch.no_grad():
+        embeddings = vision(pixel_values)
+        input_ids = torch.full((1, 3), model.config.text_config.bos_token_id, dtype=torch.long)
+        torch.onnx.export(vision, (pixel_values,), onnx_path('blip_vision', directory),
+                          input_names=['pixel_values'], output_names=['embeddings'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'embeddings': {0: 'batch'}},
+                          opset_version=OPSET)
+        torch.onnx.export(text_decoder, (input_ids, torch.ones_like(input_ids), embeddings),
+                          onnx_path('blip_text_decoder', directory),
+                          input_names=['input_ids', 'attention_mask', 'embeddings'], output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'embeddings': {0: 'batch'},
+                                        'logits': {0: 'batch', 1: 'sequence'}},
+                          opset_version=OPSET)
+
+
+def check_blip(directory):
+    import torch
+
+    model, vision, text_decoder, size = load_blip()
+    generator = torch.Generator().manual_seed(0)
+    pixel_values = torch.randn((PARITY_BATCH, 3, size, size), generator=generator)
+    input_ids = torch.randint(1000, model.config.text_config.vocab_size, (PARITY_BATCH, 6), generator=generator)
+    input_ids[:, 0] = model.config.text_config.bos_token_id
+    attention_mask = torch.ones_like(input_ids)
+    with torch.no_grad():
+        embeddings = vision(pixel_values)
+        logits = text_decoder(input_ids, attention_mask, embeddings)
+    return [
+        ('blip_vision', embeddings, (pixel_values.numpy(),)),
+        ('blip_text_decoder', logits, (input_ids.numpy(), attention_mask.numpy(), embeddings.numpy())),
+    ]
+
+
+EXPORTS = {'vgg16-lstm': export_vgg16_lstm, 'blip': export_blip}
+CHECKS = {'vgg16-lstm': check_vgg16_lstm, 'blip': check_blip}
+
+
+def check_parity(backend, directory=ONNX_DIR):
+    """
+    Compare every exported graph of a backend with its native model.
+
+    Returns:
+        bool: True if all outputs are within RTOL/ATOL
+    """
+    passed = True
+    for name, expected, inputs in CHECKS[backend](directory):
+        actual = OnnxFunction(onnx_path(name, directory))(*inputs)
+        expected = expected if isinstance(expected, tuple) else (expected,)
+        actual = actual if isinstance(actual, tuple) else (actual,)
+        worst = 0.0
+        ok = len(expected) == len(actual)
+        for e, a in zip(expected, actual):
+            e = np.asarray(e)
+            worst = max(worst, float(np.max(np.abs(e - a))))
+            ok = ok and e.shape == a.shape and np.allclose(e, a, rtol=RTOL, atol=ATOL)
+        print(f"  {name:<20} max abs diff {worst:.2e}  {'ok' if ok else 'MISMATCH'}")
+        passed = passed and ok
+    return passed
+
+
+def main(backends=BACKENDS, check_only=False, directory=ONNX_DIR):
+    os.makedirs(directory, exist_ok=True)
+    passed = True
+    for backend in backends:
+        if not check_only:
+            print(f"Exporting {backend} to {directory}")
+            EXPORTS[backend](directory)
+        print(f"Parity check for {backend} (batch {PARITY_BATCH}, rtol {RTOL}, atol {ATOL})")
+        passed = check_parity(backend, directory) and passed
+    return passed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    check_only = '--check' in args
+    backends = [arg for arg in args if arg != '--check'] or BACKENDS
+    unknown = [backend for backend in backends if backend not in EXPORTS]
+    if unknown:
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(0 if main(backends, check_only) else 1)
@@ -0,0 +1,114 @@
+"""
+Memory-mapped store for precomputed VGG16 image features.
+
+features.pkl is converted once into:
+  - <prefix>.npy        float32 matrix, one 4096-d feature per row
+  - <prefix>_index.json dataset image ids in row order, plus a map from the
+                        SHA-256 of each image file to its row
+
+The matrix is opened with np.load(mmap_mode='r'), so rows are paged in on
+demand and the OS page cache is shared by every worker process instead of
+each holding a private unpickled copy.
+
+Usage:
+    python feature_store.py <features.pkl> <output_prefix> [images_dir]
+"""
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    def __init__(self, prefix):
+        """
+        Open a converted feature store read-only.
+
+        Args:
+            prefix (str): Path prefix given to convert_features_pkl
+        """
+        self.features = np.load(prefix + '.npy', mmap_mode='r')
+        with open(prefix + '_index.json', 'r') as f:
+            index = json.load(f)
+        self.ids = index['ids']
+        self.rows = {image_id: row for row, image_id in enumerate(self.ids)}
+        self.hashes = index.get('hashes', {})
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, image_id):
+        """Return the feature of a dataset image id with shape (1, dim), or None."""
+        row = self.rows.get(image_id)
+        if row is None:
+            return None
+        return np.array(self.features[row:row + 1])
+
+    def lookup_bytes(self, data):
+        """Return the feature of an uploaded image that matches a dataset image, or None."""
+        row = self.hashes.get(hashlib.sha256(data).hexdigest())
+        if row is None:
+            return None
+        return np.array(self.features[row:row + 1])
+
+
+def convert_features_pkl(pkl_path, prefix, images_dir=None):
+    """
+    Convert a pickled {image_id: feature} dict into a memory-mappable store.
+
+    Args:
+        pkl_path (str): Path to features.pkl
+        prefix (str): Output path prefix (without extension)
+        images_dir (str): Optional dataset image directory; when given, each
+            image is hashed so uploads of the same file can be matched
+
+    Returns:
+        int: Number of features written
+    """
+    with open(pkl_path, 'rb') as f:
+        features = pickle.load(f)
+
+    ids = list(features.keys())
+    dim = np.asarray(features[ids[0]]).size
+    # write straight into a memmap so the matrix is never held twice
+    matrix = np.lib.format.open_memmap(prefix + '.npy', mode='w+', dtype='float32', shape=(len(ids), dim))
+    for row, image_id in enumerate(ids):
+        matrix[row] = np.asarray(features[image_id], dtype='float32').reshape(-1)
+    matrix.flush()
+    del matrix
+
+    hashes = {}
+    if images_dir:
+        rows = {image_id: row for row, image_id in enumerate(ids)}
+        for name in os.listdir(images_dir):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in IMAGE_EXTENSIONS and stem in rows:
+                hashes[file_sha256(os.path.join(images_dir, name))] = rows[stem]
+
+    with open(prefix + '_index.json', 'w') as f:
+        json.dump({'ids': ids, 'hashes': hashes}, f)
+
+    print(f"Features saved to {prefix}.npy ({len(ids)} x {dim})")
+    print(f"Index saved to {prefix}_index.json ({len(hashes)} image hashes)")
+    return len(ids)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    convert_features_pkl(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
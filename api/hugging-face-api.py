@@ -1,15 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from PIL import Image
 import os
-from transformers import BlipProcessor, BlipForConditionalGeneration
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from transformers import BlipConfig, BlipProcessor, BlipForConditionalGeneration, StoppingCriteria, StoppingCriteriaList
 import torch
+from caption_cache import CaptionCache, model_identity
+from embedding_cache import EmbeddingCache
+from image_io import DEFAULT_MAX_UPLOAD_MB, decode_image
+from loading import ModelLoader, ModelsNotReady
+from blip_decoding import BlipStepDecoder, OnnxBlipGenerator, TokenStreamer
+from streaming import sse_stream
+from deadlines import deadline_after, limit_reached, parse_limits
+from scheduler import BatchScheduler
+from metrics import CONTENT_TYPE, METRICS, instrument, torch_module_timer
 
 app = Flask(__name__)
 CORS(app)
+# uploads are decoded from the request body in memory; larger bodies get a 413
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('CAPTION_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024)
 
 # Local model paths (absolute path recommended)
 MODEL_PATH = os.path.abspath("models/blip-image-captioning-base")
+# label for this app's metrics
+BACKEND = 'blip'
 
 # Check if all required files exist
 REQUIRED_FILES = [
@@ -25,16 +42,373 @@ for file in REQUIRED_FILES:
     if not os.path.isfile(os.path.join(MODEL_PATH, file)):
         raise FileNotFoundError(f"Missing required file: {file}")
 
-# Initialize model from local files
+# /upload_batch limits and image decode parallelism
+MAX_BATCH_FILES = int(os.environ.get('CAPTION_MAX_BATCH_FILES', 64))
+PREPROCESS_WORKERS = int(os.environ.get('CAPTION_PREPROCESS_WORKERS', min(8, os.cpu_count() or 1)))
+# load models on a background thread so the app can answer /ready immediately
+LAZY_LOAD = os.environ.get('CAPTION_LAZY_LOAD', '0') == '1'
+# caption a blank image once after loading so the first request is not the slow one
+WARMUP = os.environ.get('CAPTION_WARMUP', '0') == '1'
+# continuous batching: concurrent /upload requests share one decoder step at a time
+BATCHING = os.environ.get('CAPTION_BATCHING', '0') == '1'
+BATCH_MAX_SIZE = int(os.environ.get('CAPTION_BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('CAPTION_BATCH_MAX_WAIT_MS', 5.0))
+# /captions limits and how long an image's vision embeddings are kept for follow-up requests
+MAX_PROMPTS = 8
+MAX_SAMPLES = 10
+EMBEDDING_TTL_SECONDS = float(os.environ.get('CAPTION_EMBEDDING_TTL', 300))
+EMBEDDING_CACHE_SIZE = int(os.environ.get('CAPTION_EMBEDDING_CACHE_SIZE', 32))
+# int8 dynamic quantization of every Linear layer (CPU only)
+QUANTIZE = os.environ.get('CAPTION_QUANTIZE', '0') == '1'
+# 'native' runs PyTorch; 'onnx' runs the graphs written by export_onnx.py with ONNX Runtime
+RUNTIME = os.environ.get('CAPTION_RUNTIME', 'native')
+if RUNTIME == 'onnx':
+    from onnx_runtime import ONNX_DIR, OnnxFunction, onnx_path
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
-processor = BlipProcessor.from_pretrained(MODEL_PATH)
-model = BlipForConditionalGeneration.from_pretrained(MODEL_PATH).to(device)
+processor = None
+model = None
+onnx_generator = None
+scheduler = None
+embedding_cache = EmbeddingCache(EMBEDDING_TTL_SECONDS, EMBEDDING_CACHE_SIZE)
+preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+def load_blip():
+    global processor, model
+    # Initialize model from local files
+    processor = BlipProcessor.from_pretrained(MODEL_PATH)
+    if RUNTIME == 'onnx':
+        load_onnx()
+        return
+    model = BlipForConditionalGeneration.from_pretrained(MODEL_PATH).to(device)
+    if QUANTIZE:
+        if device != "cpu":
+            raise RuntimeError("CAPTION_QUANTIZE=1 needs the CPU device; quantized kernels are CPU-only")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # every vision tower pass (generate, the scheduler and /captions) is timed as the encoder stage
+    torch_module_timer(model.vision_model, 'encoder', BACKEND)
+
+def load_onnx():
+    global onnx_generator
+    if QUANTIZE or BATCHING:
+        raise RuntimeError("CAPTION_RUNTIME=onnx cannot be combined with CAPTION_QUANTIZE or CAPTION_BATCHING")
+    text_config = BlipConfig.from_pretrained(MODEL_PATH).text_config
+    onnx_generator = OnnxBlipGenerator(METRICS.timed('encoder', BACKEND, OnnxFunction(onnx_path('blip_vision'))),
+                                       OnnxFunction(onnx_path('blip_text_decoder')),
+                                       text_config.bos_token_id, text_config.sep_token_id,
+                                       getattr(text_config, 'max_length', None) or 20)
+    onnx_generator.on_step = METRICS.step_observer(BACKEND)
+
+def start_scheduler():
+    global scheduler
+    decoder = BlipStepDecoder(model, device)
+    decoder.on_step = METRICS.step_observer(BACKEND)
+    scheduler = BatchScheduler(decoder.encode, decoder, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+def warm_up():
+    inputs = processor(Image.new('RGB', (384, 384)), return_tensors="pt").to(device)
+    if onnx_generator is not None:
+        onnx_generator.generate(inputs['pixel_values'].cpu().numpy())
+        return
+    model.generate(**inputs)
+
+def shutdown():
+    """Stop this module's background threads so an unloaded model can be freed."""
+    if scheduler is not None:
+        scheduler.close()
+    preprocess_pool.shutdown(wait=True)
+
+loader = ModelLoader()
+loader.add('blip', load_blip)
+if BATCHING:
+    loader.add('scheduler', start_scheduler)
+if WARMUP:
+    loader.add('warmup', warm_up)
+loader.start(background=LAZY_LOAD)
+
+# content-addressed caption cache; an empty CAPTION_CACHE_DIR keeps it in memory only
+caption_cache = None
+if os.environ.get('CAPTION_CACHE', '1') == '1':
+    if RUNTIME == 'onnx':
+        # ONNX Runtime captions can differ slightly from PyTorch ones
+        cache_model_id = model_identity('blip-onnx', MODEL_PATH, ONNX_DIR)
+    else:
+        cache_model_id = model_identity('blip-int8' if QUANTIZE else 'blip', MODEL_PATH)
+    caption_cache = CaptionCache(cache_model_id,
+                                 capacity=int(os.environ.get('CAPTION_CACHE_SIZE', 1024)),
+                                 directory=os.environ.get('CAPTION_CACHE_DIR', './caption_cache') or None)
+
+
+def load_image(data):
+    """Decode upload bytes, decoding large JPEGs at reduced scale close to BLIP's input size."""
+    size = processor.image_processor.size
+    with METRICS.time('image_decode', BACKEND):
+        return decode_image(data, draft_size=(size['height'], size['width']))
+
+def pixel_values_for(image):
+    """Resize and normalize a decoded image into a BLIP pixel_values batch of one."""
+    with METRICS.time('preprocess', BACKEND):
+        return processor(image, return_tensors="pt")['pixel_values']
+
+class CancelCriteria(StoppingCriteria):
+    def __init__(self, cancel):
+        """Stops model.generate once a threading.Event is set."""
+        self.cancel = cancel
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def generate_ids(pixel_values, deadline=None, max_tokens=None, on_token=None, cancel=None):
+    """
+    Generate caption token ids within the request's latency budget and length cap.
+
+    Args:
+        pixel_values (torch.Tensor): Preprocessed image batch of one
+        deadline (float): time.perf_counter() value after which generation stops
+        max_tokens (int): Maximum number of generated tokens
+        on_token (callable): Called with each token id as soon as it is generated
+        cancel (threading.Event): Set to stop generation, e.g. when the client went away
+
+    Returns:
+        tuple: (token ids without BOS, truncated)
+    """
+    if scheduler is not None:
+        future = scheduler.submit(pixel_values.numpy(), on_token=on_token, deadline=deadline, max_tokens=max_tokens,
+                                  cancel=cancel)
+        return future.result(), future.truncated
+    if onnx_generator is not None:
+        return onnx_generator.generate(pixel_values.numpy(), deadline, max_tokens, on_token, cancel)[0]
+    options = {}
+    if max_tokens is not None:
+        # the cap only shortens captions, it never lifts the model's own length limit
+        options['max_new_tokens'] = min(max_tokens, (model.generation_config.max_length or 20) - 1)
+    if deadline is not None:
+        options['max_time'] = max(deadline - time.perf_counter(), 0.0)
+    if cancel is not None:
+        options['stopping_criteria'] = StoppingCriteriaList([CancelCriteria(cancel)])
+    # the streamer also times every decoder step
+    streamer = TokenStreamer(on_token, METRICS.step_observer(BACKEND))
+    ids = model.generate(pixel_values=pixel_values.to(device), streamer=streamer, **options)[0].tolist()[1:]
+    finished = bool(ids) and ids[-1] == model.config.text_config.sep_token_id
+    return ids, not finished and limit_reached(ids, deadline, max_tokens, cancel)
+
+def generate_caption(image, deadline=None, max_tokens=None, cancel=None):
+    pixel_values = pixel_values_for(image)
+    ids, truncated = generate_ids(pixel_values, deadline, max_tokens, cancel=cancel)
+    return processor.decode(ids, skip_special_tokens=True), truncated
+
+def parse_options(form):
+    """Read the optional budget_ms and max_tokens fields; raises ValueError on bad values."""
+    return parse_limits(form)
+
+def cache_key_for(data, max_tokens=None):
+    # a full caption is only a valid answer under the cap it was generated with
+    return caption_cache.key(data) if max_tokens is None else caption_cache.key(data, max_tokens=max_tokens)
+
+def caption_upload(data, budget_ms=None, max_tokens=None, cancel=None):
+    """
+    Caption uploaded image bytes, using the cache when possible.
 
+    Args:
+        budget_ms (float): Optional latency budget; generation stops when it runs out
+        max_tokens (int): Optional caption length cap in tokens
+        cancel (threading.Event): Set to stop generation, e.g. when the client went away
+
+    Returns:
+        tuple: (caption, truncated); truncated is True if the budget, cap or cancel cut generation short
+
+    Raises:
+        ModelsNotReady: If BLIP is still loading and the caption is not cached
+        ValueError: If the bytes are not a decodable image
+    """
+    deadline = deadline_after(budget_ms)
+    # repeat uploads are answered from the cache without running the model
+    cache_key = None
+    if caption_cache is not None:
+        cache_key = cache_key_for(data, max_tokens)
+        cached = caption_cache.get(cache_key)
+        if cached is not None:
+            METRICS.count('captions', BACKEND)
+            return cached, False
+    loader.require()
+    image = load_image(data)
+    caption, truncated = generate_caption(image, deadline, max_tokens, cancel)
+    # a caption cut short is not the model's full answer, so it is not cached
+    if cache_key is not None and not truncated:
+        caption_cache.put(cache_key, caption)
+    METRICS.count('captions', BACKEND)
+    return caption, truncated
+
+def caption_stream(data, budget_ms=None, max_tokens=None):
+    """
+    Start captioning uploaded image bytes and return a generator of stream events.
+
+    Returns:
+        generator: ('token', text) with the new text after each generated token,
+            then ('caption', {'caption': text, 'truncated': bool}) like /upload returns
+
+    Raises:
+        ModelsNotReady: If BLIP is still loading and the caption is not cached
+        ValueError: If the bytes are not a decodable image
+    """
+    deadline = deadline_after(budget_ms)
+    cache_key = None
+    if caption_cache is not None:
+        cache_key = cache_key_for(data, max_tokens)
+        cached = caption_cache.get(cache_key)
+        if cached is not None:
+            METRICS.count('captions', BACKEND)
+            return iter([('caption', {'caption': cached, 'truncated': False})])
+    loader.require()
+    pixel_values = pixel_values_for(load_image(data))
+
+    # token ids arrive from the scheduler or generate call on a helper thread; None marks the end
+    tokens = queue.Queue()
+    result = Future()
+    def run():
+        try:
+            result.set_result(generate_ids(pixel_values, deadline, max_tokens, on_token=tokens.put))
+        except Exception as e:
+            result.set_exception(e)
+        tokens.put(None)
+    threading.Thread(target=run, name='generate-stream', daemon=True).start()
+
+    def events():
+        ids, text = [], ''
+        for token in iter(tokens.get, None):
+            ids.append(token)
+            # word pieces only become text once decoded together with their prefix
+            decoded = processor.decode(ids, skip_special_tokens=True)
+            if len(decoded) > len(text) and decoded.startswith(text):
+                yield 'token', decoded[len(text):]
+                text = decoded
+        ids, truncated = result.result()
+        caption = processor.decode(ids, skip_special_tokens=True)
+        if cache_key is not None and not truncated:
+            caption_cache.put(cache_key, caption)
+        METRICS.count('captions', BACKEND)
+        yield 'caption', {'caption': caption, 'truncated': truncated}
+    return events()
+
+def vision_embeddings(data):
+    """Return BLIP vision embeddings for upload bytes, reusing them if the image was seen recently."""
+    key = embedding_cache.key(data)
+    embeddings = embedding_cache.get(key)
+    if embeddings is None:
+        pixel_values = pixel_values_for(load_image(data)).to(device)
+        with torch.no_grad():
+            embeddings = model.vision_model(pixel_values=pixel_values)[0]
+        embedding_cache.put(key, embeddings)
+    return embeddings
+
+def generate_from_embeddings(embeddings, prompt='', num_samples=0, temperature=1.0, top_p=0.9):
+    """
+    Run the BLIP text decoder on precomputed vision embeddings.
+
+    Args:
+        embeddings (torch.Tensor): Vision embeddings of one image, shape (1, tokens, dim)
+        prompt (str): Conditional prefix the caption continues; '' for unconditional
+        num_samples (int): Number of additional captions drawn with nucleus sampling
+        temperature (float): Sampling temperature
+        top_p (float): Nucleus sampling probability mass
+
+    Returns:
+        dict: The prompt, its greedy caption and any sampled captions
+    """
+    # same decoder input generate() builds: BOS in place of [CLS], trailing [SEP] dropped
+    input_ids = processor.tokenizer(prompt, return_tensors="pt").input_ids
+    input_ids[:, 0] = model.config.text_config.bos_token_id
+    input_ids = input_ids[:, :-1].to(device)
+    options = {
+        'input_ids': input_ids,
+        'attention_mask': torch.ones_like(input_ids),
+        'encoder_hidden_states': embeddings,
+        'encoder_attention_mask': torch.ones(embeddings.shape[:2], dtype=torch.long, device=device),
+        'eos_token_id': model.config.text_config.sep_token_id,
+        'pad_token_id': model.config.text_config.pad_token_id,
+    }
+    with torch.no_grad():
+        streamer = TokenStreamer(on_step=METRICS.step_observer(BACKEND))
+        result = {'prompt': prompt, 'caption': processor.decode(
+            model.text_decoder.generate(**options, streamer=streamer)[0], skip_special_tokens=True)}
+        if num_samples:
+            # generate() repeats the embeddings for every returned sequence
+            outputs = model.text_decoder.generate(**options, do_sample=True, num_return_sequences=num_samples,
+                                                  temperature=temperature, top_p=top_p)
+            result['samples'] = processor.batch_decode(outputs, skip_special_tokens=True)
+    return result
+
+def parse_caption_options(form):
+    """Read /captions fields: prompt (repeatable), num_samples, temperature and top_p."""
+    prompts = form.getlist('prompt') or ['']
+    if len(prompts) > MAX_PROMPTS:
+        raise ValueError(f'At most {MAX_PROMPTS} prompts per request')
+    try:
+        num_samples = int(form.get('num_samples', 0))
+        temperature = float(form.get('temperature', 1.0))
+        top_p = float(form.get('top_p', 0.9))
+    except ValueError:
+        raise ValueError('num_samples must be an integer, temperature and top_p numbers')
+    if not 0 <= num_samples <= MAX_SAMPLES:
+        raise ValueError(f'num_samples must be between 0 and {MAX_SAMPLES}')
+    if temperature <= 0 or not 0 < top_p <= 1:
+        raise ValueError('temperature must be positive and top_p in (0, 1]')
+    return {'prompts': prompts, 'num_samples': num_samples, 'temperature': temperature, 'top_p': top_p}
+
+def caption_variants(data, prompts=('',), num_samples=0, temperature=1.0, top_p=0.9):
+    """
+    Caption one image for several prompts, encoding it with the vision tower at most once.
+
+    Raises:
+        ModelsNotReady: If BLIP is still loading
+        ValueError: If the bytes are not a decodable image
+        NotImplementedError: If BLIP runs on ONNX Runtime
+    """
+    loader.require()
+    if onnx_generator is not None:
+        # prompts and sampling need the PyTorch text decoder's generate()
+        raise NotImplementedError("/captions needs CAPTION_RUNTIME=native")
+    embeddings = vision_embeddings(data)
+    results = [generate_from_embeddings(embeddings, prompt, num_samples, temperature, top_p) for prompt in prompts]
+    METRICS.count('captions', BACKEND, len(results) * (1 + num_samples))
+    return results
+
+
+instrument(app, BACKEND, ('upload_file', 'upload_stream', 'captions', 'upload_batch'))
 
 @app.route('/logo192.png')
 def ignore_logo():
     return '', 204
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f"File too large (limit {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)"}), 413
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = loader.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    if caption_cache is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(enabled=True, **caption_cache.stats())), 200
+
+@app.route('/scheduler', methods=['GET'])
+def scheduler_metrics():
+    if scheduler is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(enabled=True, **scheduler.metrics())), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+@app.route('/embedding_cache', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats()), 200
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -44,24 +418,146 @@ def upload_file():
     if not file or file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    file_path = os.path.join('uploads', file.filename)
     try:
-        file.save(file_path)
-        image = Image.open(file_path).convert('RGB')
-        
+        options = parse_options(request.form)
         # Generate caption
-        inputs = processor(image, return_tensors="pt").to(device)
-        outputs = model.generate(**inputs)
-        caption = processor.decode(outputs[0], skip_special_tokens=True)
-        
-        return jsonify({'caption': caption}), 200
-    
+        caption, truncated = caption_upload(file.read(), **options)
+        return jsonify({'caption': caption, 'truncated': truncated}), 200
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e), 'status': loader.status()}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['file']
+    if not file or file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        options = parse_options(request.form)
+        events = caption_stream(file.read(), **options)
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e), 'status': loader.status()}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    # server-sent events: one message per token, then a 'done' event with the caption
+    return Response(sse_stream(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/captions', methods=['POST'])
+def captions():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['file']
+    if not file or file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        options = parse_caption_options(request.form)
+        results = caption_variants(file.read(), **options)
+        return jsonify({'captions': results}), 200
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e), 'status': loader.status()}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except NotImplementedError as e:
+        return jsonify({'error': str(e)}), 501
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def preprocess(data):
+    """Decode upload bytes into BLIP pixel values, or return the exception."""
+    try:
+        return pixel_values_for(load_image(data))
+    except Exception as e:
+        return e
+
+def caption_batch(uploads, budget_ms=None, max_tokens=None):
+    """
+    Caption several uploads with one batched generate call, using the cache when possible.
+
+    Args:
+        uploads (list): (filename, data) pairs
+
+    Returns:
+        list: One dict per upload with its filename and either 'caption' or 'error'
+
+    Raises:
+        ValueError: If budget_ms or max_tokens is set
+    """
+    # batched generation runs every caption to completion, so per-request limits cannot be honoured
+    if budget_ms is not None or max_tokens is not None:
+        raise ValueError('budget_ms and max_tokens are not supported by /upload_batch')
+
+    results = [{'filename': filename} for filename, _ in uploads]
+    pending = []
+    for position, (_, data) in enumerate(uploads):
+        cache_key = None
+        if caption_cache is not None:
+            cache_key = caption_cache.key(data)
+            cached = caption_cache.get(cache_key)
+            if cached is not None:
+                results[position]['caption'] = cached
+                continue
+        if not loader.ready:
+            results[position]['error'] = 'Models are still loading'
+            continue
+        pending.append((position, cache_key, data))
+
+    # decode and preprocess in parallel, then one batched generate call
+    batch = []
+    for (position, cache_key, _), pixels in zip(pending, preprocess_pool.map(lambda item: preprocess(item[2]), pending)):
+        if isinstance(pixels, Exception):
+            results[position]['error'] = str(pixels)
+        else:
+            batch.append((position, cache_key, pixels))
+
+    if batch:
+        try:
+            # the processor's tensors are on the CPU; only the PyTorch model needs them on its device
+            pixel_values = torch.cat([pixels for _, _, pixels in batch])
+            if onnx_generator is not None:
+                outputs = [ids for ids, _ in onnx_generator.generate(pixel_values.numpy())]
+            else:
+                outputs = model.generate(pixel_values=pixel_values.to(device))
+                # generate() cannot stream a batch, so only the tokens are counted here
+                pad_id = model.config.text_config.pad_token_id
+                METRICS.count('tokens', BACKEND, int((outputs[:, 1:] != pad_id).sum()))
+            captions = processor.batch_decode(outputs, skip_special_tokens=True)
+        except Exception as e:
+            captions = [e] * len(batch)
+        for (position, cache_key, _), caption in zip(batch, captions):
+            if isinstance(caption, Exception):
+                results[position]['error'] = str(caption)
+                continue
+            results[position]['caption'] = caption
+            if cache_key is not None:
+                caption_cache.put(cache_key, caption)
+    METRICS.count('captions', BACKEND, sum('caption' in result for result in results))
+    return results
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'error': 'No files part'}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({'error': f'At most {MAX_BATCH_FILES} files per batch'}), 400
+
+    try:
+        results = caption_batch([(file.filename, file.read()) for file in files], **parse_options(request.form))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results}), 200
 
 if __name__ == "__main__":
-    os.makedirs('uploads', exist_ok=True)
     app.run()
\ No newline at end of file
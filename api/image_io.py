@@ -0,0 +1,50 @@
+import io
+from PIL import Image, UnidentifiedImageError
+
+# default cap on request bodies, overridable with CAPTION_MAX_UPLOAD_MB
+DEFAULT_MAX_UPLOAD_MB = 16
+
+
+def decode_image(data, target_size=None, draft_size=None, draft=True):
+    """
+    Decode uploaded image bytes in memory, without touching the filesystem.
+
+    Matches tensorflow.keras load_img: the image is converted to RGB and,
+    when target_size is given, resized with nearest-neighbour sampling.
+    JPEGs much larger than the size they are headed for are decoded at
+    1/2, 1/4 or 1/8 scale in the DCT domain (the largest reduction that
+    still covers that size) before the final resize, which is far cheaper
+    in time and memory than decoding every pixel of a phone photo.
+
+    Args:
+        data (bytes): Raw image file contents
+        target_size (tuple): Optional (height, width) to resize to
+        draft_size (tuple): (height, width) the caller resizes to afterwards;
+            defaults to target_size
+        draft (bool): Allow reduced-scale JPEG decoding
+
+    Returns:
+        PIL.Image.Image: Decoded RGB image
+
+    Raises:
+        ValueError: If the bytes are not a decodable image, or it has more
+            pixels than PIL's decompression bomb limit (Image.MAX_IMAGE_PIXELS)
+    """
+    draft_size = draft_size or target_size
+    try:
+        image = Image.open(io.BytesIO(data))
+        if draft and draft_size is not None:
+            # only JPEG supports this; other formats ignore it
+            image.draft('RGB', (draft_size[1], draft_size[0]))
+        # PIL decodes lazily; load now so truncated or corrupt pixel data fails here, not in resize
+        image.load()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError(f"Could not decode image: {str(e)}")
+
+    if target_size is not None:
+        width_height = (target_size[1], target_size[0])
+        if image.size != width_height:
+            image = image.resize(width_height, Image.NEAREST)
+    return image
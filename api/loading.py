@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+import importlib.util
+from collections import OrderedDict
+
+
+# app module behind each backend name
+APP_FILES = {'vgg16-lstm': 'api.py', 'blip': 'hugging-face-api.py'}
+
+
+class ModelsNotReady(RuntimeError):
+    """Raised when a request needs a model that has not finished loading."""
+
+
+class ModelLoader:
+    def __init__(self):
+        """
+        Runs model loading steps in order and tracks their state.
+
+        Steps run on the calling thread (eager startup) or on a background
+        thread, so the app can accept health checks and report readiness
+        while weights are still loading.
+        """
+        self.steps = OrderedDict()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+
+    def add(self, name, fn):
+        """Register a loading step; steps run in registration order."""
+        self.steps[name] = {'fn': fn, 'state': 'pending', 'seconds': None, 'error': None}
+
+    def _run(self):
+        for name, step in self.steps.items():
+            with self.lock:
+                step['state'] = 'loading'
+            start = time.perf_counter()
+            try:
+                step['fn']()
+                state, error = 'ready', None
+            except Exception as e:
+                state, error = 'failed', str(e)
+                print(f"Failed to load {name}: {error}")
+            with self.lock:
+                step['state'] = state
+                step['error'] = error
+                step['seconds'] = round(time.perf_counter() - start, 3)
+            if state == 'failed':
+                # later steps depend on earlier ones, so stop here
+                break
+        self.done.set()
+
+    def start(self, background=False):
+        """Run all steps now, or on a daemon thread when background is True."""
+        if background:
+            self.thread = threading.Thread(target=self._run, name='model-loader', daemon=True)
+            self.thread.start()
+        else:
+            self._run()
+            if not self.ready:
+                # eager startup fails fast, like loading at import time did
+                failed = {name: step['error'] for name, step in self.steps.items() if step['error']}
+                raise RuntimeError(f"Model loading failed: {failed}")
+
+    @property
+    def ready(self):
+        """True once every step has loaded successfully."""
+        with self.lock:
+            return all(step['state'] == 'ready' for step in self.steps.values())
+
+    def require(self):
+        """Raise ModelsNotReady unless every step has loaded."""
+        if not self.ready:
+            raise ModelsNotReady("Models are still loading")
+
+    def wait(self, timeout=None):
+        """Block until loading has finished (successfully or not)."""
+        return self.done.wait(timeout)
+
+    def status(self):
+        """Return overall readiness and the state of every step."""
+        with self.lock:
+            steps = {
+                name: {key: step[key] for key in ('state', 'seconds', 'error') if step[key] is not None}
+                for name, step in self.steps.items()
+            }
+        return {'ready': all(step['state'] == 'ready' for step in steps.values()), 'models': steps}
+
+
+def load_app(name, intra_op_threads=None):
+    """
+    Import one of the Flask app modules (which loads its models) and return it.
+
+    Args:
+        name (str): Backend name, a key of APP_FILES
+        intra_op_threads (int): Inference threads; sized before the framework runs its first op
+
+    Raises:
+        ValueError: If the backend name is unknown
+    """
+    if name not in APP_FILES:
+        raise ValueError(f"Unknown backend: {name}")
+    if intra_op_threads:
+        if name == 'vgg16-lstm':
+            import tensorflow as tf
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        else:
+            import torch
+            torch.set_num_threads(intra_op_threads)
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), APP_FILES[name])
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
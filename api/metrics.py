@@ -0,0 +1,167 @@
+"""
+Per-stage latency histograms and request counters in Prometheus text format.
+
+Stages, labelled by backend:
+  request_read   parsing the multipart upload off the socket
+  image_decode   decoding the upload bytes to an RGB image
+  preprocess     resizing and normalizing into the encoder's input
+  encoder        VGG16 / BLIP vision forward pass (one batch)
+  decode_step    one decoder step, advancing every caption in the batch by a token
+  total          the whole /upload request
+
+Counters: captions served (including cache hits), tokens generated and
+requests answered with an error status. An observation is a bisect and
+two increments under a lock, so collection can stay on under full load.
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+
+# upper bounds in seconds, from sub-millisecond decode steps up to slow cold requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNTERS = {
+    'captions': 'Captions served, including cache hits.',
+    'tokens': 'Tokens generated by the caption decoders.',
+    'errors': 'Caption requests answered with an error status.',
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one slot per bucket plus +Inf; made cumulative only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Process-wide stage histograms and counters, keyed by (name, backend)."""
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, backend, seconds):
+        """Record one duration for a stage."""
+        key = (stage, backend)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, name, backend, amount=1):
+        """Add to one of the COUNTERS."""
+        key = (name, backend)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def time(self, stage, backend):
+        """Time the enclosed block as one observation of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, backend, time.perf_counter() - start)
+
+    def timed(self, stage, backend, fn):
+        """Wrap a callable so every call is observed as a stage."""
+        def call(*args, **kwargs):
+            with self.time(stage, backend):
+                return fn(*args, **kwargs)
+        return call
+
+    def step_observer(self, backend):
+        """
+        Callback for decoder on_step hooks.
+
+        Returns:
+            callable: (seconds, tokens) -> None; seconds is None for a step that was not timed
+        """
+        def on_step(seconds, tokens):
+            if seconds is not None:
+                self.observe('decode_step', backend, seconds)
+            self.count('tokens', backend, tokens)
+        return on_step
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self.lock:
+            histograms = {key: (list(h.counts), h.sum) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+
+        lines = ['# HELP caption_stage_seconds Time spent in each captioning stage.',
+                 '# TYPE caption_stage_seconds histogram']
+        for (stage, backend), (counts, total) in sorted(histograms.items()):
+            labels = f'backend="{backend}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'caption_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'caption_stage_seconds_sum{{{labels}}} {total}')
+            lines.append(f'caption_stage_seconds_count{{{labels}}} {cumulative}')
+        for name, description in COUNTERS.items():
+            lines.append(f'# HELP caption_{name}_total {description}')
+            lines.append(f'# TYPE caption_{name}_total counter')
+            for (counter, backend), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f'caption_{name}_total{{backend="{backend}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def torch_module_timer(module, stage, backend):
+    """Observe every forward pass of a torch module as a stage, wherever it is called from."""
+    starts = threading.local()
+
+    def before(module, inputs):
+        starts.value = time.perf_counter()
+
+    def after(module, inputs, output):
+        METRICS.observe(stage, backend, time.perf_counter() - starts.value)
+
+    module.register_forward_pre_hook(before)
+    module.register_forward_hook(after)
+
+
+def instrument(app, backend, endpoints, total_endpoints=('upload_file',)):
+    """
+    Time upload reads and whole requests, and count error responses, on a Flask app.
+
+    Args:
+        app: Flask app
+        backend: Backend label, or a callable returning it for the current request
+        endpoints (tuple): Endpoint names that take an upload
+        total_endpoints (tuple): Endpoints whose whole request is observed as 'total'
+    """
+    label = backend if callable(backend) else (lambda: backend)
+
+    @app.before_request
+    def read_upload():
+        if request.endpoint not in endpoints:
+            return
+        g.metrics_start = time.perf_counter()
+        # touching request.files parses the multipart body, reading the whole upload
+        request.files
+        METRICS.observe('request_read', label(), time.perf_counter() - g.metrics_start)
+
+    @app.after_request
+    def record_request(response):
+        if request.endpoint in endpoints and 'metrics_start' in g:
+            if response.status_code >= 400:
+                METRICS.count('errors', label())
+            if request.endpoint in total_endpoints:
+                METRICS.observe('total', label(), time.perf_counter() - g.metrics_start)
+        return response
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import onnxruntime as ort
+
+# exported graphs (see export_onnx.py) and ONNX Runtime intra-op threads, 0 for its default
+ONNX_DIR = os.environ.get('CAPTION_ONNX_DIR', 'models/onnx')
+ORT_THREADS = int(os.environ.get('CAPTION_ORT_THREADS', 0))
+
+# graph files written by export_onnx.py
+ONNX_FILES = {
+    'vgg16': 'vgg16.onnx',
+    'caption_model': 'caption_model.onnx',
+    'caption_image': 'caption_image.onnx',
+    'caption_update': 'caption_update.onnx',
+    'caption_head': 'caption_head.onnx',
+    'blip_vision': 'blip_vision.onnx',
+    'blip_text_decoder': 'blip_text_decoder.onnx',
+}
+
+ONNX_DTYPES = {
+    'tensor(float)': np.float32,
+    'tensor(int32)': np.int32,
+    'tensor(int64)': np.int64,
+}
+
+
+def onnx_path(name, directory=ONNX_DIR):
+    """Path of one exported graph."""
+    return os.path.join(directory, ONNX_FILES[name])
+
+
+def make_session(path, threads=ORT_THREADS):
+    """
+    Open an ONNX Runtime CPU session with every graph optimization enabled.
+
+    Args:
+        path (str): .onnx file
+        threads (int): Intra-op threads, 0 for ONNX Runtime's default
+
+    Returns:
+        onnxruntime.InferenceSession
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = threads
+    # the serving code calls one graph at a time, so inter-op parallelism only adds threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+class OnnxFunction:
+    def __init__(self, path, threads=ORT_THREADS):
+        """
+        Exported graph behind the same call interface as CompiledFunction.
+
+        Positional inputs are fed to the graph inputs in order and cast to
+        their declared dtypes; the batch dimension is dynamic, so there is
+        no padding to buckets.
+
+        Args:
+            path (str): .onnx file
+            threads (int): Intra-op threads, 0 for ONNX Runtime's default
+        """
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.session = make_session(path, threads)
+        self.inputs = self.session.get_inputs()
+
+    def __call__(self, *inputs):
+        feeds = {spec.name: np.asarray(value, dtype=ONNX_DTYPES.get(spec.type, np.float32))
+                 for spec, value in zip(self.inputs, inputs)}
+        outputs = self.session.run(None, feeds)
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def warm_up(self):
+        """Run the graph once on zeros so the first request does not pay for allocation."""
+        zeros = []
+        for spec in self.inputs:
+            # dynamic dimensions are strings or None; use 1 for them
+            shape = [dim if isinstance(dim, int) else 1 for dim in spec.shape]
+            zeros.append(np.zeros(shape, dtype=ONNX_DTYPES.get(spec.type, np.float32)))
+        self(*zeros)
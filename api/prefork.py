@@ -0,0 +1,177 @@
+"""
+Pre-fork server mode for the caption APIs.
+
+The parent process loads the model weights once, binds the listening
+socket and forks CAPTION_WORKERS inference workers. Each worker serves
+the Flask app on the shared socket, so the kernel hands every new
+connection to an idle worker. Weights are inherited copy-on-write. The
+parent also freezes the garbage collector before forking, so the weight
+pages stay shared. Dead workers are re-forked from the loaded parent, and
+SIGUSR1 prints a per-worker memory report (RSS, PSS and USS from
+/proc/<pid>/smaps_rollup).
+
+Only the PyTorch BLIP backend can be pre-forked. Building the Keras
+models for vgg16-lstm already runs eager TensorFlow ops and starts its
+thread pools, and TensorFlow is not fork-safe after that; ONNX Runtime
+sessions start their thread pools when created. Serve vgg16-lstm, or
+CAPTION_RUNTIME=onnx, with a single process or with asgi.py instead.
+
+CAPTION_WARMUP runs in each worker after the fork. CAPTION_BATCHING and
+CAPTION_LAZY_LOAD are disabled, because threads do not survive fork().
+
+Usage:
+    CAPTION_BACKEND=blip CAPTION_WORKERS=4 python prefork.py [host] [port]
+    kill -USR1 <parent pid>                 # memory-per-worker report
+    python prefork.py --report <parent pid>
+"""
+
+import os
+import gc
+import sys
+import signal
+from werkzeug.serving import make_server
+from loading import load_app
+
+BACKEND = os.environ.get('CAPTION_BACKEND', 'blip')
+WORKERS = int(os.environ.get('CAPTION_WORKERS', os.cpu_count() or 1))
+# each worker gets its share of the cores so workers do not oversubscribe them
+INTRA_OP_THREADS = int(os.environ.get('CAPTION_INTRA_OP_THREADS', max(1, (os.cpu_count() or 1) // WORKERS)))
+
+
+def memory_usage(pid):
+    """
+    Resident memory of one process from /proc/<pid>/smaps_rollup.
+
+    Returns:
+        dict: rss, pss (shared pages split between sharers), uss (private) and shared, in MB
+    """
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024.0
+    private = values.get('Private_Clean', 0.0) + values.get('Private_Dirty', 0.0)
+    return {
+        'rss': values.get('Rss', 0.0),
+        'pss': values.get('Pss', 0.0),
+        'uss': private,
+        'shared': values.get('Shared_Clean', 0.0) + values.get('Shared_Dirty', 0.0),
+    }
+
+
+def child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def memory_report(parent_pid):
+    """Print RSS/PSS/USS for the parent and every worker, and the total PSS actually used."""
+    pids = [parent_pid] + child_pids(parent_pid)
+    print("\n" + "="*60)
+    print(f"MEMORY PER WORKER (MB), {len(pids) - 1} workers")
+    print("="*60)
+    total_pss = total_rss = 0.0
+    for pid in pids:
+        usage = memory_usage(pid)
+        total_pss += usage['pss']
+        total_rss += usage['rss']
+        label = 'parent' if pid == parent_pid else 'worker'
+        print(f"{label:<7} {pid:>7}  RSS {usage['rss']:8.1f}  PSS {usage['pss']:8.1f}  "
+              f"USS {usage['uss']:8.1f}  shared {usage['shared']:8.1f}")
+    # RSS counts shared weights once per process; PSS sums to the real footprint
+    print(f"total   PSS {total_pss:8.1f} MB  (sum of RSS {total_rss:8.1f} MB)")
+    print("="*60 + "\n")
+    sys.stdout.flush()
+
+
+class PreforkServer:
+    def __init__(self, app_module, host='127.0.0.1', port=5000, workers=WORKERS, warm_up=False):
+        """
+        Fork workers from an already loaded app module and keep them running.
+
+        Args:
+            app_module: Loaded app module exposing a Flask app as `api` or `app`
+            host (str): Interface to bind
+            port (int): Port to bind
+            workers (int): Number of worker processes
+            warm_up (bool): Caption a blank image in each worker before it serves
+        """
+        self.module = app_module
+        self.wsgi_app = getattr(app_module, 'api', None) or app_module.app
+        self.workers = workers
+        self.warm_up = warm_up
+        # bound once in the parent; every worker accepts on the same socket
+        self.server = make_server(host, port, self.wsgi_app)
+        self.children = set()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        # worker: default signal handling, then serve until killed
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        try:
+            if self.warm_up:
+                self.module.warm_up()
+            self.server.serve_forever()
+        finally:
+            os._exit(0)
+
+    def _stop(self, signum, frame):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: memory_report(os.getpid()))
+
+        # keep the collector from touching (and so un-sharing) the loaded objects
+        gc.collect()
+        gc.freeze()
+        for _ in range(self.workers):
+            self._spawn()
+        host, port = self.server.server_address[:2]
+        print(f"Serving {BACKEND} on http://{host}:{port} with {self.workers} workers (parent {os.getpid()})")
+        sys.stdout.flush()
+
+        while True:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                return
+            except InterruptedError:
+                continue
+            self.children.discard(pid)
+            print(f"Worker {pid} exited with status {status}, forking a replacement")
+            self._spawn()
+
+
+def main(host='127.0.0.1', port=5000):
+    if BACKEND != 'blip' or os.environ.get('CAPTION_RUNTIME', 'native') != 'native':
+        sys.exit("prefork.py serves only CAPTION_BACKEND=blip on the native runtime: "
+                 "other backends start TensorFlow or ONNX Runtime threads before the fork")
+    warm_up = os.environ.get('CAPTION_WARMUP', '0') == '1'
+    # threads (model loader, batching scheduler) do not survive fork(), so load
+    # eagerly in this thread and leave warm-up to the workers
+    os.environ['CAPTION_LAZY_LOAD'] = '0'
+    os.environ['CAPTION_BATCHING'] = '0'
+    os.environ['CAPTION_WARMUP'] = '0'
+    app_module = load_app(BACKEND, INTRA_OP_THREADS)
+    PreforkServer(app_module, host, port, warm_up=warm_up).run()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--report':
+        memory_report(int(sys.argv[2]))
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1',
+             int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
@@ -0,0 +1,134 @@
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+from compiled import DEFAULT_BUCKETS, CompiledFunction, compile_model
+
+# TFLite interpreter threads; defaults to TensorFlow's own choice
+NUM_THREADS = int(os.environ.get('CAPTION_TFLITE_THREADS', 0)) or None
+
+
+class QuantizedFunction(CompiledFunction):
+    def __init__(self, fn, input_specs, buckets=DEFAULT_BUCKETS, name=None):
+        """
+        Int8 dynamic-range quantized version of CompiledFunction.
+
+        Every bucket's concrete function is converted to TFLite with
+        weights stored as int8 and activations quantized on the fly, so
+        Dense and LSTM matrix multiplies run as int8 kernels on CPU and the
+        weights take a quarter of the memory. Calls pad to buckets exactly
+        like CompiledFunction. Each bucket's interpreter is guarded by its
+        own lock, since TFLite interpreters must not be invoked from two
+        threads at once.
+
+        Args:
+            fn (callable): Function of batch-first tensors
+            input_specs (list): (shape_without_batch, dtype) per positional input
+            buckets (tuple): Batch sizes to convert
+            name (str): Name used in logs
+        """
+        super().__init__(fn, input_specs, buckets, name)
+        # passing the traced function's owner selects the current converter path
+        self.trackable = tf.Module()
+        self.trackable.function = self.function
+        self.interpreters = {}
+        self.locks = {}
+        self.input_indices = {}
+        self.output_indices = {}
+        for bucket, concrete in self.concrete.items():
+            # models converted from bare concrete functions carry no SignatureDef, so
+            # tensors are addressed by the names of the traced inputs and outputs
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], self.trackable)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            interpreter = tf.lite.Interpreter(model_content=converter.convert(), num_threads=NUM_THREADS)
+            interpreter.allocate_tensors()
+            self.interpreters[bucket] = interpreter
+            self.locks[bucket] = threading.Lock()
+            self.input_indices[bucket] = tensor_indices(
+                interpreter.get_input_details(), concrete.inputs[:len(input_specs)])
+            self.output_indices[bucket] = tensor_indices(
+                interpreter.get_output_details(), tf.nest.flatten(concrete.outputs))
+        # the float graphs are only needed for conversion
+        self.concrete = {}
+
+    def _run(self, inputs, batch_size):
+        bucket = self.bucket_for(batch_size)
+        interpreter = self.interpreters[bucket]
+        with self.locks[bucket]:
+            for index, value, (shape, dtype) in zip(self.input_indices[bucket], inputs, self.input_specs):
+                buffer = np.zeros((bucket,) + shape, dtype=dtype.as_numpy_dtype)
+                buffer[:batch_size] = value
+                interpreter.set_tensor(index, buffer)
+            interpreter.invoke()
+            # get_tensor copies, so the results stay valid once the lock is released
+            outputs = [interpreter.get_tensor(index)[:batch_size] for index in self.output_indices[bucket]]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def tensor_indices(details, tensors):
+    """
+    Interpreter tensor indices in the order of a concrete function's tensors.
+
+    TFLite names each tensor after the graph tensor it was converted from;
+    if the names do not line up, the interpreter's own order is used.
+    """
+    by_name = {detail['name'].split(':')[0]: detail['index'] for detail in details}
+    names = [tensor.name.split(':')[0] for tensor in tensors]
+    if all(name in by_name for name in names):
+        return [by_name[name] for name in names]
+    return [detail['index'] for detail in details]
+
+
+def quantize_model(model, buckets=DEFAULT_BUCKETS):
+    """
+    Quantize a Keras model for inference with one TFLite interpreter per bucket.
+
+    Args:
+        model: Keras model with fully defined input shapes (apart from the batch)
+        buckets (tuple): Batch sizes to convert
+
+    Returns:
+        QuantizedFunction: Callable taking one array per model input
+    """
+    specs = [(tensor.shape[1:], tensor.dtype) for tensor in model.inputs]
+    if len(specs) == 1:
+        fn = lambda x: model(x, training=False)
+    else:
+        fn = lambda *xs: model(list(xs), training=False)
+    return QuantizedFunction(fn, specs, buckets, name=model.name)
+
+
+class DenseQuantizedModel:
+    def __init__(self, model, buckets=DEFAULT_BUCKETS):
+        """
+        Model with only the fully connected layers after its Flatten layer quantized.
+
+        The convolutional trunk stays a float32 CompiledFunction; the dense
+        head (fc1/fc2 for VGG16, which hold most of its weights) becomes a
+        QuantizedFunction.
+
+        Args:
+            model: Keras model with a Flatten layer followed by dense layers
+            buckets (tuple): Batch sizes to trace and convert
+
+        Raises:
+            ValueError: If the model has no Flatten layer
+        """
+        flatten = next((layer for layer in model.layers if isinstance(layer, tf.keras.layers.Flatten)), None)
+        if flatten is None:
+            raise ValueError(f"{model.name} has no Flatten layer to split at")
+        trunk = tf.keras.Model(inputs=model.inputs, outputs=flatten.input, name=model.name + '_trunk')
+        x = inputs = tf.keras.Input(shape=flatten.input.shape[1:])
+        for layer in model.layers[model.layers.index(flatten):]:
+            x = layer(x)
+        head = tf.keras.Model(inputs=inputs, outputs=x, name=model.name + '_head')
+
+        self.trunk_fn = compile_model(trunk, buckets)
+        self.head_fn = quantize_model(head, buckets)
+
+    def __call__(self, images):
+        return self.head_fn(self.trunk_fn(images))
+
+    def warm_up(self):
+        self.trunk_fn.warm_up()
+        self.head_fn.warm_up()
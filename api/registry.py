@@ -0,0 +1,274 @@
+import os
+import gc
+import sys
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+from loading import APP_FILES, load_app
+
+CNN_ENCODER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'CNN_encoder')
+ENCODER_MODEL_PATH = os.environ.get('CAPTION_ENCODER_MODEL', 'models/custom_encoder_feature_extractor.keras')
+
+BACKENDS = tuple(APP_FILES) + ('cnn-encoder',)
+# attributes holding each backend's framework models, for weight accounting
+MODEL_ATTRIBUTES = {'vgg16-lstm': ('vgg_model', 'model'), 'blip': ('model',), 'cnn-encoder': ('model',)}
+# backends built with Keras, whose global state keeps released models alive until cleared
+KERAS_BACKENDS = ('vgg16-lstm', 'cnn-encoder')
+
+
+def rss_mb():
+    """
+    Current resident set size of this process in MB, or None where it cannot be read.
+
+    Uses psutil when it is installed and /proc/self/status on Linux. The
+    peak from peak_rss_mb() is not a substitute: it never goes down, so
+    differences of it say nothing about what a load added or an unload freed.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where it cannot be read (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def memory_delta(before, after):
+    return None if before is None or after is None else round(after - before, 1)
+
+
+class BackendNotLoaded(LookupError):
+    """Raised when a request names a backend that is not loaded."""
+
+
+def weight_bytes(model):
+    """Bytes held by the parameters of a PyTorch module or Keras model (0 for anything else)."""
+    if model is None:
+        return 0
+    if hasattr(model, 'parameters'):
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    if hasattr(model, 'weights'):
+        # sized from shape and dtype so large weights are not copied out of the framework
+        return sum(int(np.prod(w.shape)) * np.dtype(getattr(w.dtype, 'as_numpy_dtype', w.dtype)).itemsize
+                   for w in model.weights)
+    return 0
+
+
+class FeatureEncoder:
+    def __init__(self, model_path=ENCODER_MODEL_PATH):
+        """
+        CNN_encoder feature extractor served from upload bytes.
+
+        Args:
+            model_path (str): Trained feature extractor model
+
+        Raises:
+            RuntimeError: If the model could not be loaded
+        """
+        if CNN_ENCODER_DIR not in sys.path:
+            sys.path.insert(0, CNN_ENCODER_DIR)
+        from extract_features import FeatureExtractor
+        from utils import preprocess_image_bytes
+        extractor = FeatureExtractor(model_path)
+        if extractor.model is None:
+            raise RuntimeError(f"Feature extractor could not be loaded from {model_path}")
+        self.model = extractor.model
+        self.feature_dim = extractor.feature_dim
+        self.preprocess = preprocess_image_bytes
+
+    def features(self, data):
+        """Feature vector of one uploaded image; raises ValueError if it cannot be decoded."""
+        return self.model.predict(self.preprocess(data), verbose=0).flatten()
+
+
+class ModelEntry:
+    def __init__(self, name, backend, version, load_seconds, rss_mb):
+        """One loaded version of a backend, with the memory it added when loaded (None if unknown)."""
+        self.name = name
+        self.backend = backend
+        self.version = version
+        self.loaded_at = time.time()
+        self.load_seconds = load_seconds
+        self.rss_mb = rss_mb
+        self.weights_mb = sum(weight_bytes(getattr(backend, attribute, None))
+                              for attribute in MODEL_ATTRIBUTES[name]) / (1024 * 1024)
+        # requests currently using this version; it is only released once they finish
+        self.active = 0
+
+    def status(self):
+        return {
+            'version': self.version,
+            'loaded_at': round(self.loaded_at, 3),
+            'load_seconds': round(self.load_seconds, 3),
+            'rss_mb': self.rss_mb,
+            'weights_mb': round(self.weights_mb, 1),
+            'active_requests': self.active,
+        }
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Named caption and feature backends that load, hot-swap and unload at runtime.
+
+        Loading a backend that is already loaded builds the new version next
+        to the old one and swaps it in atomically: requests that started on
+        the old version finish on it, new requests get the new one, and the
+        old version is released once its last request is done.
+
+        Loads run one at a time, so each model's resident memory is the RSS
+        the process gained while loading it. The first model of a framework
+        also pays for the framework's own libraries.
+        """
+        self.entries = {}
+        self.loading = {}
+        self.versions = {}
+        self.lock = threading.Condition()
+        self.load_lock = threading.Lock()
+
+    def _build(self, name):
+        if name == 'cnn-encoder':
+            return FeatureEncoder()
+        module = load_app(name)
+        module.loader.wait()
+        if not module.loader.ready:
+            module.shutdown()
+            raise RuntimeError(f"{name} failed to load: {module.loader.status()['models']}")
+        return module
+
+    def load(self, name):
+        """
+        Load a backend, or hot-swap in a fresh copy if it is already loaded.
+
+        Returns:
+            dict: Status of the new version
+
+        Raises:
+            ValueError: If the backend name is unknown
+        """
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown backend: {name} (choose from {', '.join(BACKENDS)})")
+        with self.load_lock:
+            with self.lock:
+                self.loading[name] = {'state': 'loading'}
+            gc.collect()
+            before = rss_mb()
+            start = time.perf_counter()
+            try:
+                backend = self._build(name)
+            except Exception as e:
+                with self.lock:
+                    self.loading[name] = {'state': 'failed', 'error': str(e)}
+                raise
+            load_seconds = time.perf_counter() - start
+            added = memory_delta(before, rss_mb())
+            with self.lock:
+                self.versions[name] = self.versions.get(name, 0) + 1
+                entry = ModelEntry(name, backend, self.versions[name], load_seconds, added)
+                old = self.entries.get(name)
+                self.entries[name] = entry
+                del self.loading[name]
+        if old is not None:
+            self._release(old)
+        return entry.status()
+
+    def load_async(self, name):
+        """Load or hot-swap a backend on a background thread; progress shows in status()."""
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown backend: {name} (choose from {', '.join(BACKENDS)})")
+
+        def run():
+            try:
+                self.load(name)
+            except Exception as e:
+                print(f"Failed to load {name}: {str(e)}")
+
+        threading.Thread(target=run, name=f'load-{name}', daemon=True).start()
+
+    def unload(self, name):
+        """
+        Remove a backend and release it once its in-flight requests finish.
+
+        Returns:
+            dict: Resident memory the process gave back, in MB (None if unknown)
+
+        Raises:
+            BackendNotLoaded: If the backend is not loaded
+        """
+        with self.load_lock:
+            with self.lock:
+                entry = self.entries.pop(name, None)
+            if entry is None:
+                raise BackendNotLoaded(f"{name} is not loaded")
+            before = rss_mb()
+            self._release(entry)
+            freed = memory_delta(rss_mb(), before)
+            return {'rss_freed_mb': freed}
+
+    def _release(self, entry):
+        with self.lock:
+            while entry.active:
+                self.lock.wait()
+        shutdown = getattr(entry.backend, 'shutdown', None)
+        if shutdown is not None:
+            shutdown()
+        entry.backend = None
+        if entry.name in KERAS_BACKENDS:
+            import tensorflow as tf
+            tf.keras.backend.clear_session()
+        gc.collect()
+
+    @contextmanager
+    def use(self, name):
+        """
+        Hold the current version of a backend for the duration of one request.
+
+        Raises:
+            BackendNotLoaded: If the backend is not loaded
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                raise BackendNotLoaded(f"{name} is not loaded (loaded: {', '.join(sorted(self.entries)) or 'none'})")
+            entry.active += 1
+        try:
+            yield entry.backend
+        finally:
+            with self.lock:
+                entry.active -= 1
+                self.lock.notify_all()
+
+    def loaded(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def status(self):
+        """Loaded versions with their memory, loads in progress or failed, and the process totals."""
+        process, peak = rss_mb(), peak_rss_mb()
+        with self.lock:
+            models = {name: entry.status() for name, entry in self.entries.items()}
+            loading = dict(self.loading)
+        return {
+            'models': models,
+            'loading': loading,
+            'process': {'rss_mb': None if process is None else round(process, 1),
+                        'peak_rss_mb': None if peak is None else round(peak, 1)},
+        }
@@ -0,0 +1,282 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from deadlines import limit_reached
+
+
+class CaptionRequest:
+    def __init__(self, image, beam_width=1, length_penalty=1.0, feature=None, on_token=None,
+                 deadline=None, max_tokens=None, cancel=None):
+        """
+        One image waiting for a caption.
+
+        Args:
+            image (np.ndarray): Preprocessed image of shape (1, height, width, channels)
+            beam_width (int): Beam width, 1 for greedy decoding
+            length_penalty (float): Length penalty used by beam search
+            feature (np.ndarray): Precomputed image feature of shape (1, dim); skips the encoder
+            on_token (callable): Called on the scheduler thread with each word as it is decoded
+                (greedy decoding only); must not block
+            deadline (float): time.perf_counter() value after which decoding stops early
+            max_tokens (int): Stop early once the caption has this many tokens
+            cancel (threading.Event): Set to stop decoding early, e.g. when the client went away
+        """
+        self.image = image
+        self.feature = feature
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+        self.on_token = on_token
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.cancel = cancel
+        self.truncated = False
+        self.future = Future()
+        self.words = []
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchScheduler:
+    def __init__(self, encoder, decoder, max_batch_size=16, max_wait_ms=5.0, history=1000, beam_workers=1):
+        """
+        Cross-request micro-batching for encoder and decoder inference.
+
+        Requests arriving within max_wait_ms of each other are encoded in one
+        batched forward pass. Greedy captions then join a shared in-flight
+        decoding batch that is stepped together; captions leave the batch as
+        soon as they emit the end token, and new requests are admitted between
+        steps while there is room. Beam search requests are encoded with the
+        rest but searched on their own worker threads.
+
+        The decoder is shared: TFLite interpreters, Keras predict() and the
+        BLIP text decoder must not run from two threads at once, so every
+        model call goes through one decoder lock. A beam search takes the
+        lock once per step, so its steps interleave with the greedy batch's
+        instead of holding the batch up for the whole search.
+
+        Args:
+            encoder (callable): Maps a batch of preprocessed images to image features
+            decoder: CaptionDecoder, StatefulCaptionDecoder or BlipStepDecoder instance
+            max_batch_size (int): Maximum images per encoder pass and captions in flight
+            max_wait_ms (float): How long to hold the first request while the batch fills
+            history (int): Number of recent batches/requests kept for metrics
+            beam_workers (int): Threads running beam searches; their model calls take
+                turns with the greedy batch, so only their top-k bookkeeping overlaps
+        """
+        self.encoder = encoder
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.decoder_lock = threading.Lock()
+        self.encode_batch_sizes = deque(maxlen=history)
+        self.decode_batch_sizes = deque(maxlen=history)
+        self.queue_waits = deque(maxlen=history)
+        self.requests_served = 0
+        self.requests_failed = 0
+        self.tokens_generated = 0
+        self.requests_truncated = 0
+
+        self.beam_pool = ThreadPoolExecutor(max_workers=beam_workers, thread_name_prefix='beam-search')
+        self.thread = threading.Thread(target=self._run, name='caption-scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, image, beam_width=1, length_penalty=1.0, feature=None, on_token=None,
+               deadline=None, max_tokens=None, cancel=None):
+        """
+        Queue an image (or its precomputed feature) and return a Future resolving to its caption words.
+
+        Once resolved, the Future's truncated attribute is True if decoding was
+        cut short by the deadline, max_tokens or cancel; the words then have no end token.
+        """
+        request = CaptionRequest(image, beam_width, length_penalty, feature, on_token, deadline, max_tokens, cancel)
+        self.queue.put(request)
+        return request.future
+
+    def caption(self, image, beam_width=1, length_penalty=1.0, feature=None):
+        """Queue an image (or its precomputed feature) and block until its caption words are ready."""
+        return self.submit(image, beam_width, length_penalty, feature).result()
+
+    def close(self):
+        """Stop the scheduler thread after the captions already queued or in flight are finished."""
+        self.queue.put(None)
+        self.thread.join()
+        self.beam_pool.shutdown(wait=True)
+
+    def _collect(self, capacity, block):
+        """Take up to capacity queued requests, waiting for the batch window when blocking."""
+        batch = []
+        if block:
+            batch.append(self.queue.get())
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < capacity:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        while len(batch) < capacity:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _finish(self, request, error=None):
+        request.future.truncated = request.truncated
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(request.words)
+        with self.lock:
+            if error is not None:
+                self.requests_failed += 1
+            else:
+                self.requests_served += 1
+                self.requests_truncated += request.truncated
+
+    def _admit(self, requests):
+        """Encode newly arrived requests in one pass and return the decoding state for greedy ones."""
+        started = time.perf_counter()
+        # requests whose budget ran out (or that were cancelled) while queued are answered without running the models
+        for request in requests:
+            if ((request.deadline is not None and started >= request.deadline) or
+                    (request.cancel is not None and request.cancel.is_set())):
+                request.truncated = True
+                self._finish(request)
+        requests = [r for r in requests if not r.truncated]
+
+        to_encode = [r for r in requests if r.feature is None]
+        with self.lock:
+            if to_encode:
+                self.encode_batch_sizes.append(len(to_encode))
+            self.queue_waits.extend(started - r.enqueued_at for r in requests)
+
+        if to_encode:
+            encoded = self.encoder(np.concatenate([r.image for r in to_encode]))
+            for request, feature in zip(to_encode, encoded):
+                request.feature = feature[None]
+        features = [r.feature[0] for r in requests]
+
+        greedy = [(r, f) for r, f in zip(requests, features) if r.beam_width == 1]
+        state = None
+        if greedy:
+            with self.decoder_lock:
+                state = self.decoder.start(np.stack([f for _, f in greedy]))
+        # beam search already batches its beams; off this thread it only waits for single steps.
+        # Submitted last, so a failure above leaves none of these requests half-answered
+        for request, feature in zip(requests, features):
+            if request.beam_width > 1:
+                self.beam_pool.submit(self._beam_search, request, feature)
+        return [request for request, _ in greedy], state
+
+    def _beam_search(self, request, feature):
+        try:
+            request.words = self.decoder.beam_search(
+                feature[None], request.beam_width, request.length_penalty, cancel=request.cancel,
+                lock=self.decoder_lock)
+            request.truncated = request.cancel is not None and request.cancel.is_set()
+            self._finish(request)
+        except Exception as e:
+            self._finish(request, e)
+
+    def _run(self):
+        in_flight = []
+        state = None
+        closing = False
+        while True:
+            capacity = self.max_batch_size - len(in_flight)
+            new = self._collect(capacity, block=not in_flight and not closing) if capacity > 0 else []
+            if None in new:
+                # close() was called; finish what was queued before it, then exit
+                closing = True
+                new = [request for request in new if request is not None]
+            if new:
+                try:
+                    admitted, new_state = self._admit(new)
+                    if admitted:
+                        state = new_state if state is None else self.decoder.concat([state, new_state])
+                        in_flight += admitted
+                except Exception as e:
+                    # only the newly arrived requests fail; captions in flight carry on
+                    for request in new:
+                        if not request.future.done():
+                            self._finish(request, e)
+            if not in_flight:
+                if closing and self.queue.empty():
+                    return
+                continue
+
+            try:
+                with self.lock:
+                    self.decode_batch_sizes.append(len(in_flight))
+                    self.tokens_generated += len(in_flight)
+                lengths = [len(r.words) for r in in_flight]
+                with self.decoder_lock:
+                    state, keep = self.decoder.greedy_step(state, [r.words for r in in_flight])
+                for request, length in zip(in_flight, lengths):
+                    if request.on_token is not None and len(request.words) > length:
+                        request.on_token(request.words[-1])
+                kept = set(keep.tolist())
+                for row, request in enumerate(in_flight):
+                    if row not in kept:
+                        self._finish(request)
+                in_flight = [in_flight[row] for row in keep]
+
+                # captions past their deadline or length cap stop here, unfinished
+                remaining = []
+                for row, request in enumerate(in_flight):
+                    if limit_reached(request.words, request.deadline, request.max_tokens, request.cancel):
+                        request.truncated = True
+                        self._finish(request)
+                    else:
+                        remaining.append(row)
+                if len(remaining) < len(in_flight):
+                    state = self.decoder.select(state, np.array(remaining, dtype='int64'))
+                    in_flight = [in_flight[row] for row in remaining]
+                if not in_flight:
+                    state = None
+            except Exception as e:
+                for request in in_flight:
+                    self._finish(request, e)
+                in_flight = []
+                state = None
+
+    def metrics(self):
+        """
+        Summarize recent batching behaviour.
+
+        Returns:
+            dict: Request counters, encoder/decoder batch size and queue wait percentiles
+        """
+        def summary(values, scale=1.0):
+            if not values:
+                return {'count': 0}
+            values = np.asarray(values) * scale
+            return {
+                'count': len(values),
+                'mean': float(np.mean(values)),
+                'p50': float(np.percentile(values, 50)),
+                'p99': float(np.percentile(values, 99)),
+                'max': float(np.max(values)),
+            }
+
+        with self.lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'queue_depth': self.queue.qsize(),
+                'requests_served': self.requests_served,
+                'requests_failed': self.requests_failed,
+                'requests_truncated': self.requests_truncated,
+                'tokens_generated': self.tokens_generated,
+                'encode_batch_size': summary(list(self.encode_batch_sizes)),
+                'decode_batch_size': summary(list(self.decode_batch_sizes)),
+                'queue_wait_ms': summary(list(self.queue_waits), 1000.0),
+            }
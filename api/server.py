@@ -0,0 +1,207 @@
+"""
+One serving process for every backend, behind a model registry.
+
+VGG16+LSTM, BLIP and the CNN_encoder feature extractor are loaded as named
+backends of a ModelRegistry. Each request picks its backend with the
+`backend` form field; models can be loaded, hot-swapped and unloaded
+while the server keeps running, and /models reports the resident memory
+each one added.
+
+Usage:
+    CAPTION_MODELS=vgg16-lstm,blip python server.py [host] [port]
+
+Endpoints:
+    POST   /upload          file, backend (default CAPTION_DEFAULT_BACKEND) and that backend's options
+    POST   /upload_stream   the same, answered as server-sent events, one per token
+    POST   /upload_batch    files (repeated), backend and beam options; one result per file
+    POST   /captions        file, backend=blip, prompts and sampling options
+    POST   /features        file, backend=cnn-encoder
+    GET    /models          loaded versions, per-model memory and loads in progress
+    POST   /models/<name>   load, or hot-swap a fresh copy of, a backend (in the background)
+    DELETE /models/<name>   unload a backend
+    GET    /ready
+    GET    /metrics         stage latencies and counters of every backend, Prometheus text format
+"""
+
+import os
+import sys
+from contextlib import ExitStack
+from flask import Flask, Response, request, jsonify
+from flask_cors import CORS
+from image_io import DEFAULT_MAX_UPLOAD_MB
+from loading import ModelsNotReady
+from metrics import CONTENT_TYPE, METRICS, instrument
+from registry import BackendNotLoaded, ModelRegistry
+from streaming import sse_stream
+
+# backends loaded at startup, and the one /upload uses when the request names none
+STARTUP_MODELS = [name for name in os.environ.get('CAPTION_MODELS', 'vgg16-lstm,blip').split(',') if name]
+DEFAULT_BACKEND = os.environ.get('CAPTION_DEFAULT_BACKEND', STARTUP_MODELS[0] if STARTUP_MODELS else 'vgg16-lstm')
+LAZY_LOAD = os.environ.get('CAPTION_LAZY_LOAD', '0') == '1'
+# endpoints that only one backend serves default to it
+ENDPOINT_BACKENDS = {'captions': 'blip', 'features': 'cnn-encoder'}
+
+app = Flask(__name__)
+CORS(app)
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('CAPTION_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024)
+
+registry = ModelRegistry()
+for name in STARTUP_MODELS:
+    if LAZY_LOAD:
+        registry.load_async(name)
+    else:
+        registry.load(name)
+
+
+def uploaded_file():
+    """Return the bytes of the 'file' part, or None if it is missing or empty."""
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return None
+    return file.read()
+
+def requested_backend():
+    """Backend named by the request's backend field, or the endpoint's default."""
+    return request.form.get('backend', ENDPOINT_BACKENDS.get(request.endpoint, DEFAULT_BACKEND))
+
+# the backend apps time their own stages; the routes here add read, total and error metrics
+instrument(app, requested_backend, ('upload_file', 'upload_stream', 'upload_batch', 'captions'))
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f"File too large (limit {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)"}), 413
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    missing = [name for name in STARTUP_MODELS if not registry.loaded(name)]
+    return jsonify({'ready': not missing, 'missing': missing}), 200 if not missing else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify(registry.status()), 200
+
+@app.route('/models/<name>', methods=['POST'])
+def load_model(name):
+    try:
+        registry.load_async(name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # the current version, if any, keeps serving until the new one is swapped in
+    return jsonify({'loading': name}), 202
+
+@app.route('/models/<name>', methods=['DELETE'])
+def unload_model(name):
+    try:
+        return jsonify(dict(unloaded=name, **registry.unload(name))), 200
+    except BackendNotLoaded as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    data = uploaded_file()
+    if data is None:
+        return jsonify({'error': 'No file part'}), 400
+    name = requested_backend()
+    try:
+        with registry.use(name) as backend:
+            if not hasattr(backend, 'caption_upload'):
+                return jsonify({'error': f"{name} does not caption images"}), 400
+            options = backend.parse_options(request.form)
+            caption, truncated = backend.caption_upload(data, **options)
+    except BackendNotLoaded as e:
+        return jsonify({'error': str(e)}), 404
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e)}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'backend': name, 'caption': caption, 'truncated': truncated}), 200
+
+@app.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    data = uploaded_file()
+    if data is None:
+        return jsonify({'error': 'No file part'}), 400
+    name = requested_backend()
+    with ExitStack() as stack:
+        try:
+            backend = stack.enter_context(registry.use(name))
+            if not hasattr(backend, 'caption_stream'):
+                return jsonify({'error': f"{name} does not caption images"}), 400
+            events = backend.caption_stream(data, **backend.parse_options(request.form))
+        except BackendNotLoaded as e:
+            return jsonify({'error': str(e)}), 404
+        except ModelsNotReady as e:
+            return jsonify({'error': str(e)}), 503
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        response = Response(sse_stream(events), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # the version stays in use until the stream is closed, so a swap or unload waits for it
+        response.call_on_close(stack.pop_all().close)
+        return response
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'error': 'No files part'}), 400
+    name = requested_backend()
+    try:
+        with registry.use(name) as backend:
+            if not hasattr(backend, 'caption_batch'):
+                return jsonify({'error': f"{name} does not caption images"}), 400
+            if len(files) > backend.MAX_BATCH_FILES:
+                return jsonify({'error': f'At most {backend.MAX_BATCH_FILES} files per batch'}), 400
+            results = backend.caption_batch([(file.filename, file.read()) for file in files],
+                                            **backend.parse_options(request.form))
+    except BackendNotLoaded as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'backend': name, 'results': results}), 200
+
+@app.route('/captions', methods=['POST'])
+def captions():
+    data = uploaded_file()
+    if data is None:
+        return jsonify({'error': 'No file part'}), 400
+    name = requested_backend()
+    try:
+        with registry.use(name) as backend:
+            if not hasattr(backend, 'caption_variants'):
+                return jsonify({'error': f"{name} does not caption with prompts"}), 400
+            results = backend.caption_variants(data, **backend.parse_caption_options(request.form))
+    except BackendNotLoaded as e:
+        return jsonify({'error': str(e)}), 404
+    except ModelsNotReady as e:
+        return jsonify({'error': str(e)}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except NotImplementedError as e:
+        return jsonify({'error': str(e)}), 501
+    return jsonify({'backend': name, 'captions': results}), 200
+
+@app.route('/features', methods=['POST'])
+def features():
+    data = uploaded_file()
+    if data is None:
+        return jsonify({'error': 'No file part'}), 400
+    name = requested_backend()
+    try:
+        with registry.use(name) as backend:
+            if not hasattr(backend, 'features'):
+                return jsonify({'error': f"{name} does not extract features"}), 400
+            vector = backend.features(data)
+    except BackendNotLoaded as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'backend': name, 'dim': len(vector), 'features': vector.tolist()}), 200
+
+if __name__ == "__main__":
+    app.run(sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1',
+            int(sys.argv[2]) if len(sys.argv) > 2 else 5000, threaded=True)
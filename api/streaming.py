@@ -0,0 +1,29 @@
+import json
+
+
+def format_event(data, event=None):
+    """Format one server-sent event with a JSON payload."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def sse_stream(events):
+    """
+    Turn caption stream events into server-sent event messages.
+
+    Args:
+        events (iterable): ('token', text) for each decoded token, then ('caption', result)
+            with the final response body, e.g. {'caption': text, 'truncated': False}
+
+    Yields:
+        str: A data message per token, then a 'done' event with the result, or an
+            'error' event if captioning fails part-way
+    """
+    try:
+        for kind, payload in events:
+            if kind == 'token':
+                yield format_event({'token': payload})
+            else:
+                yield format_event(payload, event='done')
+    except Exception as e:
+        yield format_event({'error': str(e)}, event='error')